@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmark of longest prefix match ASN lookups. Builds a PrefixTable from
+    a synthetic routing table about the size of a full IPv4 and IPv6 table,
+    with prefix lengths spread as they are in the global routing table, then
+    reports lookups per second for random hop IPs through the trie alone
+    and through an ASNEnricher, where hop IPs repeat as they do over many
+    traces and most lookups are cached.
+
+'''
+
+import sys
+import random
+import ipaddress
+from time import perf_counter
+from twisted_mtr import asn
+
+
+IPV4_PREFIXES = 950000
+IPV6_PREFIXES = 200000
+# Share of IPv4 prefixes of each length, most of the table is /24s
+IPV4_LENGTHS = ((24, 0.6), (23, 0.1), (22, 0.12), (21, 0.05), (20, 0.05),
+                (19, 0.03), (18, 0.02), (17, 0.01), (16, 0.02))
+IPV6_LENGTHS = ((48, 0.55), (44, 0.1), (40, 0.08), (36, 0.07), (32, 0.2))
+LOOKUPS = 200000
+HOP_IPS = 20000
+
+
+def random_prefixes(rng, count, bits, lengths, base, base_length):
+    for prefix_length, share in lengths:
+        for _ in range(int(count * share)):
+            key = base | (rng.getrandbits(prefix_length - base_length) <<
+                          (bits - prefix_length))
+            yield key, prefix_length, rng.randint(1, 400000)
+
+
+def build_table(rng):
+    table = asn.PrefixTable()
+    start = perf_counter()
+    for key, prefix_length, origin in random_prefixes(
+            rng, IPV4_PREFIXES, 32, IPV4_LENGTHS, 0, 0):
+        table.add(f'{ipaddress.IPv4Address(key)}/{prefix_length}', origin)
+    # IPv6 prefixes are all within 2000::/3
+    for key, prefix_length, origin in random_prefixes(
+            rng, IPV6_PREFIXES, 128, IPV6_LENGTHS, 1 << 125, 3):
+        table.add(f'{ipaddress.IPv6Address(key)}/{prefix_length}', origin)
+    return table, perf_counter() - start
+
+
+def bench_lookups(lookup, ips):
+    start = perf_counter()
+    for ip in ips:
+        lookup(ip)
+    return len(ips) / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+
+    rng = random.Random(0)
+    table, elapsed = build_table(rng)
+    sys.stdout.write(f'loaded {len(table)} prefixes in {elapsed:.1f}s\n')
+    ipv4 = [str(ipaddress.IPv4Address(rng.getrandbits(32)))
+            for _ in range(LOOKUPS)]
+    ipv6 = [str(ipaddress.IPv6Address((1 << 125) | rng.getrandbits(125)))
+            for _ in range(LOOKUPS)]
+    hop_ips = ipv4[:HOP_IPS]
+    repeated = [rng.choice(hop_ips) for _ in range(LOOKUPS)]
+    enricher = asn.ASNEnricher(table)
+    for name, lookup, ips in (
+            ('trie ipv4', table.lookup, ipv4),
+            ('trie ipv6', table.lookup, ipv6),
+            ('enricher ipv4 hops', enricher.lookup, repeated)):
+        rate = bench_lookups(lookup, ips)
+        sys.stdout.write(f'{name:<20} {rate:>10.0f} lookups/s\n')
+    stats = enricher.stats()
+    sys.stdout.write(f'enricher cache hits {stats["hits"]} misses '
+                     f'{stats["misses"]}\n')
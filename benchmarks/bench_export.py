@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmark of exporting completed traces. Compares serialising each trace
+    to JSON as it completes with a TraceExporter writing batches as NDJSON
+    or in the columnar format. Reports the microseconds spent per trace in
+    the reactor thread and in the writer thread, where TraceExporter builds
+    and writes batches, and the bytes written per trace.
+
+'''
+
+import os
+import sys
+import json
+import tempfile
+import ipaddress
+from time import perf_counter
+from twisted_mtr import export
+
+
+TRACES = 50000
+HOPS = 15
+BATCH_ROWS = 65536
+
+
+def make_traces():
+    traces = []
+    for i in range(TRACES):
+        target = ipaddress.IPv4Address(0x0a000000 + i)
+        hops = [(hop_num, f'10.{hop_num}.{i % 200}.1' if hop_num % 5 else
+                 None, hop_num * 1000 + i % 100)
+                for hop_num in range(1, HOPS + 1)]
+        traces.append((1000.0 + i, target, 'icmp', -1, hops))
+    return traces
+
+
+def bench_json_per_trace(traces, path):
+    start = perf_counter()
+    with open(path, 'wt') as f:
+        for ts, target_ip, protocol, port, hops in traces:
+            f.write(json.dumps({'ts': ts, 'target_ip': str(target_ip),
+                                'protocol': protocol, 'port': port,
+                                'hops': hops}) + '\n')
+    return perf_counter() - start, 0
+
+
+def bench_batches(traces, writer):
+    # Write in the reactor thread so the time in each thread can be measured
+    exporter = export.TraceExporter(writer, max_rows=BATCH_ROWS,
+                                    max_delay=3600, threaded=False)
+    writer_time = 0
+    write_batch = exporter.write_batch
+
+    def _timed_write_batch(pending):
+        nonlocal writer_time
+        start = perf_counter()
+        rows = write_batch(pending)
+        writer_time += perf_counter() - start
+        return rows
+
+    exporter.write_batch = _timed_write_batch
+    start = perf_counter()
+    for trace in traces:
+        exporter.add(*trace)
+    exporter.flush_call.cancel()
+    exporter.flush_call = None
+    exporter.close()
+    return perf_counter() - start - writer_time, writer_time
+
+
+if __name__ == '__main__':
+
+    traces = make_traces()
+    directory = tempfile.mkdtemp()
+    for name, func in (
+            ('json per trace', lambda path: bench_json_per_trace(traces,
+                                                                 path)),
+            ('ndjson batches', lambda path: bench_batches(
+                traces, export.NDJSONWriter(path))),
+            ('columnar batches', lambda path: bench_batches(
+                traces, export.ColumnarWriter(path)))):
+        path = os.path.join(directory, name.replace(' ', '-'))
+        reactor_time, writer_time = func(path)
+        size = os.path.getsize(path)
+        os.unlink(path)
+        sys.stdout.write(
+            f'{name:<18} reactor {reactor_time / TRACES * 1e6:>6.2f} '
+            f'us/trace  writer {writer_time / TRACES * 1e6:>6.2f} '
+            f'us/trace  {size / TRACES:>6.1f} bytes/trace\n')
+    os.rmdir(directory)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+'''
+    Microbenchmark for the mtr-packet response parser. Feeds chunks containing
+    many response lines into TraceRoute.outReceived(), as happens when
+    hundreds of probes are in flight and mtr-packet output is coalesced, and
+    reports the number of response lines parsed per second.
+
+'''
+
+import sys
+import ipaddress
+from time import perf_counter
+from twisted_mtr import mtr
+
+
+LINES = 200000
+CHUNK_SIZES = (1, 10, 100, 1000)
+
+
+class NullTransport:
+
+    def write(self, data):
+        pass
+
+
+def noop(*a):
+    pass
+
+
+def bench(lines_per_chunk):
+    app_mtr = mtr.TraceRoute(local_ipv4=ipaddress.IPv4Address('10.0.0.1'))
+    app_mtr.makeConnection(NullTransport())
+    request = ['send-probe', 'ip-4', '10.0.0.2', 'ttl', '1']
+    # Allow every request to be in flight at once
+    app_mtr.inflight_window = LINES
+    for _ in range(LINES):
+        app_mtr.mtr_request(noop, noop, request, None)
+    response = 'ttl-expired ip-4 10.0.0.1 round-trip-time 400'
+    responses = [f'{c} {response}\n'.encode() for c in range(LINES)]
+    chunks = [b''.join(responses[i:i + lines_per_chunk])
+              for i in range(0, LINES, lines_per_chunk)]
+    start = perf_counter()
+    for chunk in chunks:
+        app_mtr.outReceived(chunk)
+    elapsed = perf_counter() - start
+    # Cancel the timeouts for any requests that were not answered
+    app_mtr.timeouts.clear()
+    return LINES / elapsed
+
+
+if __name__ == '__main__':
+
+    for lines_per_chunk in CHUNK_SIZES:
+        rate = bench(lines_per_chunk)
+        sys.stdout.write(f'{lines_per_chunk:>5} lines per chunk: '
+                         f'{rate:>12,.0f} lines/sec\n')
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+'''
+    Microbenchmark of the Python overhead of making send-probe requests.
+    Compares building the request as a list of strings for every probe, as
+    mtr_request() accepts, with probe_request() and with appending the TTL to
+    a send-probe template encoded once per trace, as trace() does, and
+    reports the microseconds spent per probe.
+
+'''
+
+import sys
+import ipaddress
+from time import perf_counter
+from twisted_mtr import mtr
+
+
+PROBES = 200000
+TTLS = 30
+
+
+class NullTransport:
+
+    def write(self, data):
+        pass
+
+
+def noop(*a):
+    pass
+
+
+def make_traceroute():
+    app_mtr = mtr.TraceRoute(local_ipv4=ipaddress.IPv4Address('10.0.0.1'))
+    app_mtr.makeConnection(NullTransport())
+    # Allow every request to be in flight at once
+    app_mtr.inflight_window = PROBES
+    return app_mtr
+
+
+def bench_list(app_mtr, target):
+    local_ip = str(app_mtr.local_ipv4)
+    for i in range(PROBES):
+        request = [
+            'send-probe',
+            'local-ip-4', local_ip,
+            'ip-4', str(target),
+            'timeout', str(app_mtr.REQUEST_TIMEOUT),
+            'protocol', 'icmp',
+            'ttl', str(i % TTLS + 1)
+        ]
+        app_mtr.mtr_request(noop, noop, request, None)
+
+
+def bench_probe_request(app_mtr, target):
+    for i in range(PROBES):
+        request, wait = app_mtr.probe_request(target, 'icmp', -1,
+                                              i % TTLS + 1)
+        app_mtr.mtr_request(noop, noop, request, None, wait)
+
+
+def bench_template(app_mtr, target):
+    template = app_mtr.probe_template(target, 'icmp', -1,
+                                      app_mtr.REQUEST_TIMEOUT)
+    for i in range(PROBES):
+        app_mtr.mtr_request(noop, noop, template + b'%d' % (i % TTLS + 1),
+                            None)
+
+
+def bench(func):
+    app_mtr = make_traceroute()
+    target = ipaddress.IPv4Address('10.0.0.2')
+    start = perf_counter()
+    func(app_mtr, target)
+    elapsed = perf_counter() - start
+    # Cancel the timeouts for the requests that were never answered
+    app_mtr.timeouts.clear()
+    return elapsed / PROBES * 1000000
+
+
+if __name__ == '__main__':
+
+    for name, func in (('list per probe', bench_list),
+                       ('probe_request()', bench_probe_request),
+                       ('template per trace', bench_template)):
+        sys.stdout.write(f'{name:<20} {bench(func):>6.2f} us/probe\n')
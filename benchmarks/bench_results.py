@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+'''
+    Benchmark of the memory used to keep completed traces. Compares the
+    default list of (hop_num, hop_ip, rtt) tuples with TraceResult and reports
+    the bytes used per trace.
+
+'''
+
+import sys
+import random
+import ipaddress
+import tracemalloc
+from twisted_mtr import results
+
+
+TRACES = 50000
+HOPS = 15
+ROUTERS = 5000
+
+
+def make_hops(rand):
+    # Hop IPs are new str objects for every trace, as when they are sliced
+    # from mtr-packet response lines
+    hops = []
+    for hop_num in range(1, HOPS + 1):
+        if rand.random() < 0.1:
+            hops.append((hop_num, None, None))
+        else:
+            router = rand.randrange(ROUTERS)
+            hop_ip = f'10.{router // 256}.{router % 256}.1'
+            hops.append((hop_num, hop_ip, rand.randrange(100, 200000)))
+    return hops
+
+
+def measure(compact):
+    rand = random.Random(1)
+    target_ip = ipaddress.IPv4Address('10.255.0.1')
+    table = results.AddressTable()
+    tracemalloc.start()
+    kept = []
+    for _ in range(TRACES):
+        hops = make_hops(rand)
+        if compact:
+            hops = results.TraceResult.from_hops(0.0, target_ip, 'icmp', -1,
+                                                 hops, table)
+        kept.append(hops)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / TRACES
+
+
+if __name__ == '__main__':
+
+    tuples = measure(False)
+    compact = measure(True)
+    sys.stdout.write(f'list of tuples: {tuples:>8,.0f} bytes per trace\n')
+    sys.stdout.write(f'TraceResult:    {compact:>8,.0f} bytes per trace\n')
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+'''
+    End to end throughput and latency benchmark of TraceRoute against the
+    in-process FakeMTRPacket. Every scenario traces the same set of generated
+    targets with simulated RTTs scaled down by TIME_SCALE and reports probes
+    and traces per CPU second, p50 and p99 trace completion latency in
+    milliseconds of wall time, CPU microseconds per probe and the memory
+    allocated by TraceRoute for each probe in flight, measured with a
+    tracemalloc snapshot diff of MEMORY_FILES taken near the most probes in
+    flight so the memory of the fake and the benchmark itself is excluded.
+
+'''
+
+import sys
+import time
+import ipaddress
+import tracemalloc
+from twisted.internet import defer, task
+from twisted_mtr import mtr, testing
+
+
+TARGETS = 2000
+CONCURRENCY = 200
+TIME_SCALE = 0.01
+# Modules whose allocations count towards the memory per probe in flight
+MEMORY_FILES = ('*/twisted_mtr/mtr.py', '*/twisted_mtr/timeouts.py')
+# Probes in flight grow by this factor before another snapshot is taken
+SNAPSHOT_GROWTH = 1.25
+
+
+SCENARIOS = (
+    ('sequential', dict(mode='sequential'), dict()),
+    ('parallel', dict(mode='parallel'), dict()),
+    ('parallel, loss 5%', dict(mode='parallel'), dict(loss=0.05)),
+    ('parallel, reordered', dict(mode='parallel'), dict(jitter=20000)),
+    ('parallel, exhausted', dict(mode='parallel'), dict(max_probes=256)),
+    ('parallel, split writes', dict(mode='parallel'), dict(split=True)),
+    ('parallel, no coalescing', dict(mode='parallel'), dict(coalesce=False)),
+)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(trace_kwargs, fake_kwargs, memory=False):
+    app_mtr = mtr.TraceRoute(local_ipv4=ipaddress.IPv4Address('10.0.0.0'),
+                             coalesce=False)
+    fake = testing.FakeMTRPacket(app_mtr, time_scale=TIME_SCALE,
+                                 **fake_kwargs)
+    targets = iter([ipaddress.IPv4Address(f'172.16.{i // 256}.{i % 256}')
+                    for i in range(TARGETS)])
+    latencies = []
+    done = defer.Deferred()
+    active = [0]
+
+    def _start_next():
+        target = next(targets, None)
+        if target is None:
+            if not active[0]:
+                done.callback(None)
+            return
+        active[0] += 1
+        started = time.perf_counter()
+        app_mtr.trace(lambda *a: _finished(started),
+                      lambda *a: _finished(started), target, **trace_kwargs)
+
+    def _finished(started):
+        latencies.append(time.perf_counter() - started)
+        active[0] -= 1
+        _start_next()
+
+    if memory:
+        memory_filters = [tracemalloc.Filter(True, pattern)
+                          for pattern in MEMORY_FILES]
+        tracemalloc.start()
+        baseline = tracemalloc.take_snapshot().filter_traces(memory_filters)
+        measured = {'inflight': 0, 'bytes': 0}
+        respond = fake.respond
+
+        def _measured_respond(*args, **kwargs):
+            respond(*args, **kwargs)
+            if fake.in_flight < measured['inflight'] * SNAPSHOT_GROWTH + 1:
+                return
+            snapshot = tracemalloc.take_snapshot()
+            snapshot = snapshot.filter_traces(memory_filters)
+            measured['inflight'] = fake.in_flight
+            measured['bytes'] = sum(
+                stat.size_diff
+                for stat in snapshot.compare_to(baseline, 'filename'))
+
+        fake.respond = _measured_respond
+    cpu = time.process_time()
+    for _ in range(CONCURRENCY):
+        _start_next()
+    yield done
+    cpu = time.process_time() - cpu
+    per_probe = 0
+    if memory:
+        tracemalloc.stop()
+        per_probe = measured['bytes'] / max(1, measured['inflight'])
+    return {
+        'probes': fake.probes,
+        'cpu': cpu,
+        'latencies': latencies,
+        'per_probe': per_probe,
+    }
+
+
+@defer.inlineCallbacks
+def main():
+    header = (f'{"scenario":<24} {"probes/s":>10} {"traces/s":>9} '
+              f'{"p50 ms":>8} {"p99 ms":>8} {"cpu us/probe":>13} '
+              f'{"bytes/probe":>12}\n')
+    sys.stdout.write(header)
+    for name, trace_kwargs, fake_kwargs in SCENARIOS:
+        timing = yield defer.inlineCallbacks(run)(trace_kwargs, fake_kwargs)
+        memory = yield defer.inlineCallbacks(run)(trace_kwargs, fake_kwargs,
+                                                   memory=True)
+        probes, cpu = timing['probes'], timing['cpu']
+        latencies = timing['latencies']
+        p50 = percentile(latencies, 50) * 1000
+        p99 = percentile(latencies, 99) * 1000
+        per_probe = memory['per_probe']
+        sys.stdout.write(f'{name:<24} {probes / cpu:>10,.0f} '
+                         f'{TARGETS / cpu:>9,.0f} {p50:>8.1f} {p99:>8.1f} '
+                         f'{cpu / probes * 1000000:>13.1f} '
+                         f'{per_probe:>12,.0f}\n')
+
+
+if __name__ == '__main__':
+
+    task.react(lambda _reactor: main())
@@ -1,9 +1,56 @@
 import os
 import sys
+import json
+import shutil
+import tempfile
 import ipaddress
 import unittest
-from twisted.internet import reactor
-from twisted_mtr import errors, mtr, utils
+from unittest import mock
+from twisted.internet import defer, reactor, task
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.python.failure import Failure
+from twisted.internet.testing import StringTransport
+from twisted_mtr import (asn, cache, changes, continuous, errors, export,
+                         metrics, mtr, multipath, pool, results, rtt,
+                         scheduler, stopset, store, testing, timeouts, utils,
+                         workers)
+
+
+class FakeTransport:
+    '''
+        Stands in for the mtr-packet process transport, records written lines.
+    '''
+
+    def __init__(self):
+        self.lines = []
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.lines.extend(data.decode().splitlines())
+
+    def loseConnection(self):
+        pass
+
+    def sent(self):
+        # Returns the sent requests as (counter, ttl) tuples
+        return [(int(l.split()[0]), int(l.split()[-1])) for l in self.lines]
+
+
+# Simulated path to 10.0.0.4, hops respond with ttl-expired or no-reply
+FAKE_PATH = {
+    1: 'ttl-expired ip-4 10.0.0.1 round-trip-time 100',
+    2: 'no-reply',
+    3: 'ttl-expired ip-4 10.0.0.3 round-trip-time 300',
+}
+FAKE_TARGET_REPLY = 'reply ip-4 10.0.0.4 round-trip-time 400'
+
+
+def fake_response(line):
+    # Generates the mtr-packet response to a send-probe request line
+    parts = line.split()
+    ttl = int(parts[-1])
+    return f'{parts[0]} {FAKE_PATH.get(ttl, FAKE_TARGET_REPLY)}\n'.encode()
 
 
 class TwstedMTRTestCase(unittest.TestCase):
@@ -47,6 +94,1128 @@ class TwstedMTRTestCase(unittest.TestCase):
             utils.parse_ip('2404:6800:4015:802::200e')
         )
 
+    def patch_reactor(self):
+        # Replaces the reactor used by the library with a fake clock
+        clock = task.Clock()
+        for module in (mtr, timeouts, continuous, scheduler, export):
+            patcher = mock.patch.object(module, 'reactor', clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return clock
+
+    def make_traceroute(self, **kwargs):
+        clock = self.patch_reactor()
+        # Most tests check the lines written as soon as requests are made
+        kwargs.setdefault('coalesce_writes', False)
+        app_mtr = mtr.TraceRoute(local_ipv4=ipaddress.IPv4Address('10.0.0.0'),
+                                 **kwargs)
+        app_mtr.makeConnection(FakeTransport())
+        return app_mtr, clock
+
+    def run_fake_trace(self, **kwargs):
+        app_mtr, clock = self.make_traceroute()
+        results = []
+        app_mtr.trace(lambda *a: results.append(a), self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'), **kwargs)
+        # Answer every request in reverse order of sending until done
+        answered = 0
+        while not results:
+            pending = app_mtr.transport.lines[answered:]
+            self.assertTrue(pending)
+            answered = len(app_mtr.transport.lines)
+            for line in reversed(pending):
+                app_mtr.outReceived(fake_response(line))
+        return app_mtr, results[0]
+
+    def test_trace_sequential(self):
+        app_mtr, result = self.run_fake_trace()
+        ts, target_ip, protocol, port, hops = result
+        self.assertEqual(hops, [(1, '10.0.0.1', 100), (2, None, None),
+                                (3, '10.0.0.3', 300), (4, '10.0.0.4', 400)])
+        self.assertEqual([t for c, t in app_mtr.transport.sent()],
+                         [1, 2, 3, 4])
+
+    def test_trace_parallel(self):
+        sequential_mtr, sequential = self.run_fake_trace()
+        app_mtr, parallel = self.run_fake_trace(mode='parallel', window=3)
+        self.assertEqual(sequential[1:], parallel[1:])
+        # Three probes are sent up front, the window then slides along
+        self.assertEqual([t for c, t in app_mtr.transport.sent()][:3],
+                         [1, 2, 3])
+        self.assertLessEqual(max(t for c, t in app_mtr.transport.sent()), 6)
+        # Errors for probes past the target are ignored once the trace
+        # completed, the errback (self.fail) is not called
+        for c in list(app_mtr.requests):
+            app_mtr.outReceived(f'{c} no-route\n'.encode())
+        self.assertEqual(app_mtr.requests, {})
+        with self.assertRaises(errors.MTRError):
+            app_mtr.trace(None, None, ipaddress.IPv4Address('10.0.0.4'),
+                          mode='parallel', window=0)
+        with self.assertRaises(errors.MTRError):
+            app_mtr.trace(None, None, ipaddress.IPv4Address('10.0.0.4'),
+                          mode='unknown')
+        # TTLs out of range are rejected before anything is registered
+        for ttl in (0, app_mtr.MAX_TTL + 1):
+            with self.assertRaises(errors.MTRError):
+                app_mtr.trace(None, None, ipaddress.IPv4Address('10.0.0.4'),
+                              ttl=ttl)
+        self.assertEqual(app_mtr.traces, {})
+
+    def test_out_received_framing(self):
+        app_mtr, clock = self.make_traceroute()
+        responses = []
+        for _ in range(3):
+            app_mtr.mtr_request(lambda c, r, l, e: responses.append((c, l)),
+                                self.fail, ['send-probe', 'ttl', '1'], None)
+        # Two complete lines and a partial line in one chunk
+        app_mtr.outReceived(b'0 reply ip-4 10.0.0.1 round-trip-time 1\n'
+                            b'1 no-reply\n2 ttl-exp')
+        self.assertEqual(responses, [
+            (0, ['reply', 'ip-4', '10.0.0.1', 'round-trip-time', '1']),
+            (1, ['no-reply']),
+        ])
+        # The partial line is completed by the next chunk
+        app_mtr.outReceived(b'ired ip-4 10.0.0.2 round-trip-time 2\n\n')
+        self.assertEqual(responses[2], (
+            2, ['ttl-expired', 'ip-4', '10.0.0.2', 'round-trip-time', '2']
+        ))
+        self.assertEqual(app_mtr.buffer, b'')
+        self.assertEqual(app_mtr.requests, {})
+        # Overlong partial lines are discarded, with or without a complete
+        # line before them in the same chunk
+        for prefix in (b'', b'3 no-reply\n'):
+            app_mtr.outReceived(prefix + b'x' * (app_mtr.MAX_LINE_LENGTH + 1))
+            self.assertEqual(app_mtr.buffer, b'')
+
+    def test_pool(self):
+        app_mtr, clock = self.make_traceroute()
+        with self.assertRaises(errors.MTRError):
+            pool.TraceRoutePool(local_ipv4=app_mtr.local_ipv4, size=0)
+        app_pool = pool.TraceRoutePool(local_ipv4=app_mtr.local_ipv4, size=3)
+        for worker in app_pool.workers:
+            worker.makeConnection(FakeTransport())
+        self.assertEqual(app_pool.queue_depths(), [0, 0, 0])
+        results = []
+        for i in range(1, 5):
+            app_pool.trace(lambda *a: results.append(a), self.fail,
+                           ipaddress.IPv4Address(f'10.0.0.{i}'))
+        # Traces are spread over the least busy processes
+        self.assertEqual(app_pool.queue_depths(), [2, 1, 1])
+        worker = app_pool.workers[1]
+        worker.outReceived(b'0 reply ip-4 10.0.0.2 round-trip-time 1\n')
+        self.assertEqual(app_pool.queue_depths(), [2, 0, 1])
+        self.assertEqual(results[0][1], ipaddress.IPv4Address('10.0.0.2'))
+        self.assertIs(app_pool.get_worker(), worker)
+        # Identical traces in flight are coalesced on a single process
+        app_pool = pool.TraceRoutePool(local_ipv4=app_mtr.local_ipv4, size=4,
+                                       coalesce_writes=False)
+        for worker in app_pool.workers:
+            worker.makeConnection(FakeTransport())
+        results = []
+        for _ in range(4):
+            app_pool.trace(lambda *a: results.append(a), self.fail,
+                           ipaddress.IPv4Address('10.0.0.9'))
+        self.assertEqual(app_pool.queue_depths(), [1, 0, 0, 0])
+        worker = app_pool.workers[0]
+        self.assertEqual(len(worker.transport.lines), 1)
+        worker.outReceived(b'0 reply ip-4 10.0.0.9 round-trip-time 1\n')
+        self.assertEqual(len(results), 4)
+        self.assertEqual(app_pool.queue_depths(), [0, 0, 0, 0])
+
+    def test_timeouts(self):
+        for timeout_manager in (timeouts.TimeoutWheel,
+                                timeouts.CallLaterTimeouts):
+            app_mtr, clock = self.make_traceroute(
+                timeout_manager=timeout_manager)
+            errors = []
+            for _ in range(3):
+                app_mtr.mtr_request(lambda *a: None,
+                                    lambda c, r, e, x: errors.append((c, e)),
+                                    ['send-probe', 'ttl', '1'], None)
+            app_mtr.outReceived(b'1 no-reply\n')
+            self.assertEqual(len(app_mtr.timeouts), 2)
+            clock.advance(app_mtr.WAIT_TIMEOUT - 0.1)
+            self.assertEqual(errors, [])
+            clock.advance(1)
+            # The requests without a response time out together
+            self.assertEqual(errors, [(0, 'timeout'), (2, 'timeout')])
+            self.assertEqual(app_mtr.requests, {})
+            self.assertEqual(len(app_mtr.timeouts), 0)
+            self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_trace_timeout_retry(self):
+        app_mtr, clock = self.make_traceroute()
+        results = []
+        app_mtr.trace(lambda *a: results.append(a), self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'), ttl=4)
+        self.assertEqual(app_mtr.transport.sent(), [(0, 4)])
+        # No response from mtr-packet, the probe is retried
+        clock.advance(app_mtr.WAIT_TIMEOUT + 1)
+        clock.advance(app_mtr.RETRY_WAIT)
+        self.assertEqual(app_mtr.transport.sent(), [(0, 4), (1, 4)])
+        app_mtr.outReceived(fake_response(app_mtr.transport.lines[-1]))
+        self.assertEqual(results[0][-1], [(1, None, None), (2, None, None),
+                                          (3, None, None),
+                                          (4, '10.0.0.4', 400)])
+
+    def test_inflight_window(self):
+        app_mtr, clock = self.make_traceroute()
+        app_mtr.inflight_window = 4
+        responses = []
+        for i in range(6):
+            app_mtr.mtr_request(lambda c, r, l, e: responses.append(e),
+                                self.fail, ['send-probe', 'ttl', '1'], i)
+        self.assertEqual(len(app_mtr.transport.lines), 4)
+        self.assertEqual((app_mtr.window_size(), app_mtr.queue_length()),
+                         (4, 2))
+        # A burst of probes-exhausted only halves the window once and the
+        # requests are queued again ahead of the waiting ones
+        app_mtr.outReceived(b'0 probes-exhausted\n1 probes-exhausted\n')
+        self.assertEqual((app_mtr.window_size(), app_mtr.queue_length()),
+                         (2, 4))
+        queued = list(app_mtr.retries) + list(app_mtr.queue)
+        self.assertEqual([q[3] for q in queued], [0, 1, 4, 5])
+        # Answered requests make room for queued ones in order and grow the
+        # window again
+        app_mtr.outReceived(b'2 no-reply\n3 no-reply\n')
+        self.assertEqual(responses, [2, 3])
+        self.assertGreater(app_mtr.inflight_window, 2)
+        self.assertEqual(app_mtr.transport.sent()[4:],
+                         [(4, 1), (5, 1), (6, 1)])
+        app_mtr.outReceived(b'4 no-reply\n5 no-reply\n6 no-reply\n')
+        app_mtr.outReceived(b'7 no-reply\n')
+        self.assertEqual(responses, [2, 3, 0, 1, 4, 5])
+        self.assertEqual(app_mtr.outstanding(), 0)
+        # Until the first decrease the window doubles for every window's
+        # worth of answered requests
+        app_mtr, clock = self.make_traceroute()
+        app_mtr.inflight_window = 4
+        for i in range(12):
+            app_mtr.mtr_request(lambda c, r, l, e: None, self.fail,
+                                ['send-probe', 'ttl', '1'], i)
+        app_mtr.outReceived(b''.join(b'%d no-reply\n' % c
+                                     for c in range(4)))
+        self.assertEqual(app_mtr.window_size(), 8)
+        self.assertEqual(len(app_mtr.transport.lines), 12)
+
+    def test_trace_many(self):
+        app_mtr, clock = self.make_traceroute()
+        consumed = []
+
+        def _targets():
+            for i in range(1, 6):
+                consumed.append(i)
+                yield f'10.0.0.{i}'
+            yield 'invalid'
+
+        results = []
+        bulk = app_mtr.trace_many(_targets(), concurrency=2)
+        # Only enough targets for the concurrency limit are taken
+        self.assertEqual(consumed, [1, 2])
+        bulk.next().addCallback(results.append)
+        app_mtr.outReceived(b'1 reply ip-4 10.0.0.2 round-trip-time 1\n')
+        self.assertEqual(results[0][0], True)
+        self.assertEqual(results[0][1][1], ipaddress.IPv4Address('10.0.0.2'))
+        self.assertEqual(consumed, [1, 2, 3])
+        # Completed traces which are not consumed count towards concurrency
+        app_mtr.outReceived(b'0 no-route\n2 reply ip-4 10.0.0.3 '
+                            b'round-trip-time 1\n')
+        self.assertEqual(consumed, [1, 2, 3])
+
+        async def _consume():
+            async for result in bulk:
+                results.append(result)
+                # Answer every outstanding probe with a reply from the target
+                for c, ttl in app_mtr.transport.sent():
+                    if c in app_mtr.requests:
+                        app_mtr.outReceived(
+                            f'{c} reply ip-4 10.0.0.9 round-trip-time 1\n'
+                            .encode())
+
+        finished = []
+        defer.ensureDeferred(_consume()).addCallback(finished.append)
+        self.assertEqual(finished, [None])
+        self.assertEqual(consumed, [1, 2, 3, 4, 5])
+        self.assertEqual([success for success, _ in results],
+                         [True, False, True, True, True, False])
+        self.assertEqual(results[1][1][0], ipaddress.IPv4Address('10.0.0.1'))
+        self.assertEqual(results[-1][1][0], 'invalid')
+        self.assertTrue(bulk.done())
+
+    def test_cache(self):
+        trace_cache = cache.TraceCache(max_age=30, max_entries=2)
+        app_mtr, clock = self.make_traceroute(cache=trace_cache)
+        results = []
+        target = ipaddress.IPv4Address('10.0.0.1')
+        app_mtr.trace(lambda *a: results.append(a), self.fail, target)
+        app_mtr.outReceived(b'0 reply ip-4 10.0.0.1 round-trip-time 1\n')
+        app_mtr.trace(lambda *a: results.append(a), self.fail, target)
+        # The second trace was answered from the cache without a probe
+        self.assertEqual(len(app_mtr.transport.lines), 1)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(trace_cache.stats(), {'entries': 1, 'hits': 1,
+                                               'misses': 1, 'evictions': 0})
+        # Different protocols, ports and TTLs are cached separately
+        app_mtr.trace(lambda *a: results.append(a), self.fail, target,
+                      protocol='tcp', port=80)
+        app_mtr.trace(lambda *a: results.append(a), self.fail, target,
+                      ttl=2)
+        self.assertEqual(len(app_mtr.transport.lines), 3)
+        app_mtr.outReceived(b'1 reply ip-4 10.0.0.1 round-trip-time 1\n'
+                            b'2 reply ip-4 10.0.0.1 round-trip-time 1\n')
+        # The least recently used entry was evicted
+        self.assertEqual(trace_cache.evictions, 1)
+        self.assertIsNone(trace_cache.get((target, 'icmp', -1, 1)))
+        # Entries go stale after max_age seconds
+        ts = results[-1][0]
+        with mock.patch.object(cache, 'time', return_value=ts + 31):
+            self.assertIsNone(trace_cache.get((target, 'icmp', -1, 2)))
+        self.assertEqual(len(trace_cache), 1)
+
+    def test_coalesce(self):
+        app_mtr, clock = self.make_traceroute()
+        results, failures = [], []
+        target = ipaddress.IPv4Address('10.0.0.1')
+        for _ in range(3):
+            app_mtr.trace(lambda *a: results.append(a),
+                          lambda *a: failures.append(a), target)
+        # Only one trace is sent, the others join it
+        self.assertEqual(len(app_mtr.transport.lines), 1)
+        app_mtr.outReceived(b'0 reply ip-4 10.0.0.1 round-trip-time 1\n')
+        self.assertEqual(len(results), 3)
+        self.assertIs(results[0][-1], results[2][-1])
+        self.assertEqual(app_mtr.traces, {})
+        # Errors are passed to every subscriber
+        for _ in range(2):
+            app_mtr.trace(lambda *a: results.append(a),
+                          lambda *a: failures.append(a), target)
+        app_mtr.outReceived(b'1 network-down\n')
+        self.assertEqual(len(failures), 2)
+        # Coalescing can be disabled
+        app_mtr.coalesce = False
+        for _ in range(2):
+            app_mtr.trace(lambda *a: results.append(a), self.fail, target)
+        self.assertEqual(len(app_mtr.transport.lines), 4)
+
+    def test_stop_set(self):
+        stop_set = stopset.StopSet(start_ttl=3)
+        app_mtr, clock = self.make_traceroute(stop_set=stop_set)
+        # Both targets are 4 hops away over the same routers
+        routers = ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+        def _trace(target):
+            results = []
+            sent = len(app_mtr.transport.lines)
+            app_mtr.trace(lambda *a: results.append(a), self.fail,
+                          ipaddress.IPv4Address(target))
+            answered = sent
+            while not results:
+                lines = app_mtr.transport.lines[answered:]
+                answered += len(lines)
+                for line in lines:
+                    c, ttl = line.split()[0], int(line.split()[-1])
+                    if ttl <= len(routers):
+                        response = (f'{c} ttl-expired ip-4 {routers[ttl - 1]}'
+                                    f' round-trip-time {ttl}\n')
+                    else:
+                        response = (f'{c} reply ip-4 {target} '
+                                    f'round-trip-time 4\n')
+                    app_mtr.outReceived(response.encode())
+            probed = [t for c, t in app_mtr.transport.sent()[sent:]]
+            return probed, results[0][-1]
+
+        full = [(1, '10.0.0.1', 1), (2, '10.0.0.2', 2), (3, '10.0.0.3', 3)]
+        # With empty stop sets the whole path is probed
+        probed, hops = _trace('10.0.0.4')
+        self.assertEqual(sorted(probed), [1, 2, 3, 4])
+        self.assertEqual(hops, full + [(4, '10.0.0.4', 4)])
+        # Another target in the same prefix stops at both known hops
+        probed, hops = _trace('10.0.0.5')
+        self.assertEqual(sorted(probed), [2, 3])
+        self.assertEqual(hops, full)
+        # The same target is stitched with its reply
+        probed, hops = _trace('10.0.0.4')
+        self.assertEqual(sorted(probed), [2, 3])
+        self.assertEqual(hops, full + [(4, '10.0.0.4', 4)])
+        self.assertEqual(stop_set.stats()['local_hits'], 2)
+        self.assertEqual(stop_set.stats()['global_hits'], 2)
+        # A target closer than the start TTL is cut at its reply
+        routers = ['10.0.0.1']
+        probed, hops = _trace('10.1.0.1')
+        self.assertEqual(hops, [(1, '10.0.0.1', 1), (2, '10.1.0.1', 4)])
+        # Concurrent identical traces share a single Doubletree trace
+        results = []
+        sent = first = len(app_mtr.transport.lines)
+        for _ in range(2):
+            app_mtr.trace(lambda *a: results.append(a), self.fail,
+                          ipaddress.IPv4Address('10.2.0.1'))
+        while len(results) < 2:
+            lines = app_mtr.transport.lines[sent:]
+            sent += len(lines)
+            for line in lines:
+                c, ttl = line.split()[0], int(line.split()[-1])
+                response = (f'{c} ttl-expired ip-4 10.0.0.1' if ttl == 1
+                            else f'{c} reply ip-4 10.2.0.1')
+                app_mtr.outReceived(f'{response} round-trip-time 1\n'
+                                    .encode())
+        probed = [t for c, t in app_mtr.transport.sent()[first:]]
+        self.assertEqual(sorted(probed), sorted(set(probed)))
+        self.assertEqual(results[0][-1], [(1, '10.0.0.1', 1),
+                                          (2, '10.2.0.1', 1)])
+        self.assertIs(results[0][-1], results[1][-1])
+        self.assertEqual(app_mtr.traces, {})
+
+    def test_rtt_estimator(self):
+        estimator = rtt.RTTEstimator(floor=1, ceiling=5)
+        app_mtr, clock = self.make_traceroute(rtt_estimator=estimator)
+        results = []
+
+        def _timeouts():
+            return [int(l.split()[7]) for l in app_mtr.transport.lines]
+
+        # With no samples probes use the ceiling
+        app_mtr.trace(lambda *a: results.append(a), self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'), ttl=3)
+        self.assertEqual(_timeouts(), [5])
+        app_mtr.outReceived(b'0 ttl-expired ip-4 10.0.0.3 '
+                            b'round-trip-time 2000000\n')
+        app_mtr.outReceived(b'1 reply ip-4 10.0.0.4 '
+                            b'round-trip-time 20000\n')
+        # Known hops use their own estimate, unknown hops the target's
+        app_mtr.trace(lambda *a: results.append(a), self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'), ttl=2,
+                      mode='parallel', window=3)
+        self.assertEqual(_timeouts()[2:], [1, 5, 1])
+        self.assertEqual(estimator.timeout('10.0.0.9', 1), 5)
+        self.assertAlmostEqual(estimator.rto('10.0.0.4', 4), 0.06)
+        # The wait for mtr-packet to respond scales with the timeout
+        clock.advance(app_mtr.wait_margin + 1.5)
+        self.assertEqual(sorted(app_mtr.requests), [3])
+        with self.assertRaises(errors.MTRError):
+            rtt.RTTEstimator(floor=3, ceiling=2)
+
+    def test_compact_results(self):
+        sequential_mtr, sequential = self.run_fake_trace()
+        app_mtr, clock = self.make_traceroute(compact=True)
+        traces = []
+        app_mtr.trace(lambda *a: traces.append(a), self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'))
+        while not traces:
+            line = app_mtr.transport.lines[-1]
+            app_mtr.outReceived(fake_response(line))
+        hops = traces[0][-1]
+        self.assertIsInstance(hops, results.TraceResult)
+        self.assertEqual(hops, sequential[-1])
+        self.assertEqual(list(hops), sequential[-1])
+        self.assertEqual(len(hops), 4)
+        hop_num, hop_ip, ms = hops[-1]
+        self.assertEqual((hop_num, hop_ip, ms), (4, '10.0.0.4', 400))
+        self.assertEqual(hops[1].hop_ip, None)
+        self.assertEqual(hops[1:3], sequential[-1][1:3])
+        self.assertEqual(hops.target_ip, ipaddress.IPv4Address('10.0.0.4'))
+        with self.assertRaises(IndexError):
+            hops[4]
+        # Addresses are interned in a shared table
+        table = results.AddressTable()
+        first = results.TraceResult.from_hops(
+            0, ipaddress.IPv6Address('::2'), 'icmp', -1,
+            [(1, '::1', 1), (2, '::2', 2)], table)
+        second = results.TraceResult.from_hops(
+            0, ipaddress.IPv6Address('::3'), 'icmp', -1,
+            [(1, '::1', 1), (2, None, None), (3, '::3', 3)], table)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(first.addresses[0], second.addresses[0])
+        self.assertEqual(list(second), [(1, '::1', 1), (2, None, None),
+                                        (3, '::3', 3)])
+        # Full tables are rotated so they can't grow without limit
+        self.assertIs(table.rotated(), table)
+        table.max_size = 3
+        rotated = table.rotated()
+        self.assertIsNot(rotated, table)
+        self.assertEqual((len(rotated), rotated.max_size), (0, 3))
+        self.assertEqual(second[0].hop_ip, '::1')
+        app_mtr.address_table = results.AddressTable(1)
+        for target in ('10.0.0.4', '10.0.0.5'):
+            app_mtr.compact_result(0, ipaddress.IPv4Address(target), 'icmp',
+                                   -1, [(1, target, 1)])
+            self.assertEqual(len(app_mtr.address_table), 1)
+
+    def test_on_hop(self):
+        streamed = []
+
+        def _on_hop(target_ip, hop_num, hop_ip, ms):
+            streamed.append((hop_num, hop_ip, ms))
+
+        app_mtr, clock = self.make_traceroute(cache=cache.TraceCache())
+        results = []
+        target = ipaddress.IPv4Address('10.0.0.4')
+        app_mtr.trace(lambda *a: results.append(a), self.fail, target,
+                      mode='parallel', window=4, on_hop=_on_hop)
+        # Hops are streamed in order as soon as they are known
+        app_mtr.outReceived(fake_response(app_mtr.transport.lines[1]))
+        self.assertEqual(streamed, [])
+        app_mtr.outReceived(fake_response(app_mtr.transport.lines[0]))
+        self.assertEqual(streamed, [(1, '10.0.0.1', 100), (2, None, None)])
+        for line in app_mtr.transport.lines[2:4]:
+            app_mtr.outReceived(fake_response(line))
+        self.assertEqual(streamed, results[0][-1])
+        # Cached traces are streamed too
+        streamed.clear()
+        app_mtr.trace(lambda *a: results.append(a), self.fail, target,
+                      on_hop=_on_hop, keep_hops=False)
+        self.assertEqual(streamed, results[0][-1])
+        self.assertEqual(results[1][-1], [])
+        # Streaming only traces don't keep their hops
+        streamed.clear()
+        app_mtr.trace(lambda *a: results.append(a), self.fail, target,
+                      ttl=4, on_hop=_on_hop, keep_hops=False)
+        app_mtr.outReceived(fake_response(app_mtr.transport.lines[-1]))
+        self.assertEqual(streamed, [(4, '10.0.0.4', 400)])
+        self.assertEqual(results[2][-1], [])
+
+    def test_continuous(self):
+        app_mtr, clock = self.make_traceroute()
+        mtr_session = app_mtr.trace_continuous(
+            ipaddress.IPv4Address('10.0.0.4'), interval=2)
+        # The path is discovered first
+        for line in app_mtr.transport.lines[:4]:
+            app_mtr.outReceived(fake_response(line))
+        self.assertEqual([h['hop_ip'] for h in mtr_session.snapshot()],
+                         ['10.0.0.1', None, '10.0.0.3', '10.0.0.4'])
+        # Then every hop is probed every interval
+        rtts = {1: [200, 100], 3: [300, 600]}
+        for round_num in range(2):
+            sent = len(app_mtr.transport.lines)
+            clock.advance(2)
+            self.assertEqual([t for c, t in app_mtr.transport.sent()[sent:]],
+                             [1, 2, 3, 4])
+            for c, ttl in app_mtr.transport.sent()[sent:]:
+                if ttl in rtts:
+                    response = (f'{c} ttl-expired ip-4 10.0.0.{ttl} '
+                                f'round-trip-time {rtts[ttl][round_num]}\n')
+                    app_mtr.outReceived(response.encode())
+                elif ttl == 2:
+                    app_mtr.outReceived(f'{c} no-reply\n'.encode())
+        # The send-probe request is encoded once and reused every round
+        self.assertEqual(list(mtr_session.templates),
+                         [app_mtr.REQUEST_TIMEOUT])
+        hop1, hop2, hop3, hop4 = mtr_session.snapshot()
+        self.assertEqual((hop1['sent'], hop1['received']), (3, 3))
+        self.assertEqual((hop1['best'], hop1['worst'], hop1['last']),
+                         (100, 200, 100))
+        self.assertAlmostEqual(hop1['avg'], 400 / 3)
+        self.assertAlmostEqual(hop3['jitter_avg'], 150)
+        self.assertEqual(hop3['jitter'], 300)
+        self.assertEqual(hop2['loss'], 100.0)
+        # Probes still in flight are not counted as lost
+        self.assertEqual((hop4['sent'], hop4['loss']), (1, 0.0))
+        self.assertIn('10.0.0.3', mtr_session.report())
+        # The target replying at a lower TTL shortens the path
+        sent = len(app_mtr.transport.lines)
+        clock.advance(2)
+        c, ttl = app_mtr.transport.sent()[sent + 2]
+        app_mtr.outReceived(f'{c} reply ip-4 10.0.0.4 round-trip-time 1\n'
+                            .encode())
+        self.assertEqual(len(mtr_session.snapshot()), 3)
+        mtr_session.stop()
+        sent = len(app_mtr.transport.lines)
+        clock.advance(10)
+        self.assertEqual(len(app_mtr.transport.lines), sent)
+
+    def test_fake_mtr_packet(self):
+        clock = self.patch_reactor()
+        topology = testing.Topology(paths={
+            '10.0.0.4': [('10.0.0.1', 100), (None, None), ('10.0.0.3', 300)],
+        }, target_rtt=100)
+        app_mtr = mtr.TraceRoute(local_ipv4=ipaddress.IPv4Address('10.0.0.0'),
+                                 coalesce=False)
+        fake = testing.FakeMTRPacket(app_mtr, topology, clock=clock,
+                                     jitter=50, max_probes=2, split=True)
+        results = []
+        for mode in ('sequential', 'parallel'):
+            app_mtr.trace(lambda *a: results.append(a[-1]), self.fail,
+                          ipaddress.IPv4Address('10.0.0.4'), mode=mode,
+                          window=4)
+        clock.pump([1] * 30)
+        self.assertEqual([[h[:2] for h in hops] for hops in results],
+                         [[(1, '10.0.0.1'), (2, None), (3, '10.0.0.3'),
+                           (4, '10.0.0.4')]] * 2)
+        self.assertEqual(results[0][0][2] // 100, 1)
+        self.assertGreater(fake.probes, 8)
+        self.assertEqual(fake.in_flight, 0)
+        # Generated paths are stable and share their first hops
+        topology = testing.Topology(seed=1)
+        first = topology.path('172.16.0.1')
+        self.assertEqual(first, topology.generate('172.16.0.1'))
+        self.assertEqual(first[:4], topology.path('172.16.0.2')[:4])
+
+    def test_metrics(self):
+        collector = metrics.Metrics()
+        app_mtr, clock = self.make_traceroute(metrics=collector)
+        results = []
+        app_mtr.trace(lambda *a: results.append(a), self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'), ttl=4)
+        self.assertEqual(collector.snapshot()['in_flight'], 1)
+        # Time out, then probes-exhausted, then a reply, both are retried
+        clock.advance(app_mtr.WAIT_TIMEOUT + 1)
+        clock.advance(app_mtr.RETRY_WAIT)
+        app_mtr.outReceived(b'1 probes-exhausted\n')
+        clock.advance(app_mtr.RETRY_WAIT)
+        app_mtr.outReceived(fake_response(app_mtr.transport.lines[-1]))
+        self.assertTrue(results)
+        snapshot = collector.snapshot()
+        self.assertEqual(snapshot['in_flight'], 0)
+        self.assertEqual(snapshot['probes_sent'], 3)
+        self.assertEqual(snapshot['responses'],
+                         {'probes-exhausted': 1, 'reply': 1})
+        self.assertEqual((snapshot['timeouts'], snapshot['retries']), (1, 2))
+        self.assertEqual(snapshot['rtt']['count'], 1)
+        self.assertEqual(snapshot['rtt']['buckets'][1000], 1)
+        self.assertEqual(snapshot['latency']['count'], 2)
+        text = collector.prometheus()
+        self.assertIn('twisted_mtr_responses_total{type="reply"} 1\n', text)
+        self.assertIn('twisted_mtr_rtt_seconds_bucket{le="0.001"} 1\n', text)
+        self.assertIn('twisted_mtr_rtt_seconds_sum 0.0004\n', text)
+        self.assertIn('twisted_mtr_timeouts_total 1\n', text)
+        # Buffered requests are timed from when they are written
+        app_mtr, clock = self.make_traceroute(metrics=metrics.Metrics(),
+                                              coalesce_writes=True)
+        app_mtr.trace(lambda *a: None, self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'))
+        self.assertEqual(app_mtr.sent_at, {0: None})
+        clock.advance(0)
+        self.assertIsInstance(app_mtr.sent_at[0], float)
+
+    def test_write_coalescing(self):
+        app_mtr, clock = self.make_traceroute(coalesce_writes=True)
+        for i in range(1, 4):
+            app_mtr.trace(lambda *a: None, self.fail,
+                          ipaddress.IPv4Address(f'10.0.1.{i}'),
+                          mode='parallel', window=5)
+        # Lines are written at once at the end of the reactor iteration
+        self.assertEqual(app_mtr.transport.lines, [])
+        clock.advance(0)
+        self.assertEqual(len(app_mtr.transport.lines), 15)
+        self.assertEqual(app_mtr.transport.writes, 1)
+        # Or as soon as the buffer is full
+        app_mtr.WRITE_BUFFER_SIZE = 1
+        app_mtr.trace(lambda *a: None, self.fail,
+                      ipaddress.IPv4Address('10.0.1.4'), mode='parallel',
+                      window=2)
+        self.assertEqual(app_mtr.transport.writes, 3)
+        # Nothing is sent while the transport is paused
+        app_mtr.pauseProducing()
+        app_mtr.trace(lambda *a: None, self.fail,
+                      ipaddress.IPv4Address('10.0.1.5'), mode='parallel',
+                      window=2)
+        clock.advance(0)
+        self.assertEqual(len(app_mtr.transport.lines), 17)
+        self.assertEqual(app_mtr.queue_length(), 2)
+        app_mtr.resumeProducing()
+        self.assertEqual(len(app_mtr.transport.lines), 19)
+        self.assertEqual(app_mtr.queue_length(), 0)
+
+    def test_workers(self):
+        # Worker side, requests are read from stdin and traced
+        app_mtr, clock = self.make_traceroute()
+        worker = workers.TraceWorker(app_mtr)
+        worker_stdout = StringTransport()
+        worker.makeConnection(worker_stdout)
+        worker.dataReceived(b'[7, "10.0.0.4", "icmp", -1, 1, "parallel", 4]\n'
+                            b'[8, "::1", "icmp", -1, 1, "sequential", null]\n')
+        for line in app_mtr.transport.lines:
+            app_mtr.outReceived(fake_response(line))
+        # Results are binary frames of a header then a store record, or the
+        # error of a failed trace
+        output = worker_stdout.value()
+        request_id, success, length = workers.RESULT_HEADER.unpack_from(
+            output)
+        self.assertEqual((request_id, success), (8, 0))
+        error = output[:workers.RESULT_HEADER.size + length]
+        result = output[len(error):]
+        request_id, success, length = workers.RESULT_HEADER.unpack_from(
+            result)
+        self.assertEqual((request_id, success), (7, 1))
+        ts, target_ip, protocol, port, hops = store.decode_record(
+            result[workers.RESULT_HEADER.size:])
+        self.assertEqual((target_ip, protocol, port),
+                         (ipaddress.IPv4Address('10.0.0.4'), 'icmp', -1))
+        self.assertEqual(hops, [(1, '10.0.0.1', 100), (2, None, None),
+                                (3, '10.0.0.3', 300), (4, '10.0.0.4', 400)])
+        # Supervisor side, requests go to the least busy worker and results
+        # are passed to the callbacks
+        supervisor = workers.TraceSupervisor(
+            local_ipv4=ipaddress.IPv4Address('10.0.0.0'), workers=2,
+            compact=True)
+        for worker_process in supervisor.workers:
+            worker_process.makeConnection(StringTransport())
+        got = []
+        for target in ('10.0.0.4', '10.0.0.5', '10.0.0.6'):
+            supervisor.trace(lambda *a: got.append(a),
+                             lambda *a: got.append(a),
+                             ipaddress.IPv4Address(target))
+        self.assertEqual(supervisor.queue_depths(), [2, 1])
+        first, second = supervisor.workers
+        self.assertEqual(json.loads(first.transport.value().splitlines()[0]),
+                         [0, '10.0.0.4', 'icmp', -1, 1, 'sequential', None])
+        # Frames are reassembled across chunks
+        record = result[workers.RESULT_HEADER.size:]
+        frames = (workers.encode_result(0, 1, record) +
+                  workers.encode_result(2, 0, b'no route'))
+        first.outReceived(frames[:5])
+        first.outReceived(frames[5:-3])
+        first.outReceived(frames[-3:])
+        ts, target_ip, protocol, port, hops = got[0]
+        self.assertIsInstance(hops, results.TraceResult)
+        self.assertEqual(hops[3], (4, '10.0.0.4', 400))
+        self.assertEqual(got[1][2], 'no route')
+        self.assertEqual(first.buffer, b'')
+        # Invalid arguments fail in the supervisor, not in a worker
+        for kwargs in (dict(protocol='udp'), dict(protocol='sctp'),
+                       dict(ttl=0), dict(mode='parallel', window=0)):
+            with self.assertRaises(errors.MTRError):
+                supervisor.trace(None, None,
+                                 ipaddress.IPv4Address('10.0.0.7'), **kwargs)
+        self.assertEqual(supervisor.queue_depths(), [0, 1])
+        # Requests a worker never answered fail if the worker exits
+        second.processEnded(None)
+        self.assertEqual(got[2][2], 'worker exited')
+        self.assertEqual(supervisor.queue_depths(), [0, 0])
+
+    def test_respawn(self):
+        app_mtr, clock = self.make_traceroute(mtr_binary_path='mtr-packet',
+                                              respawn=True)
+        crashed = Failure(ProcessTerminated(exitCode=1))
+        spawned = []
+
+        def _spawn():
+            spawned.append(FakeTransport())
+            app_mtr.makeConnection(spawned[-1])
+
+        results = []
+        with mock.patch.object(app_mtr, 'spawn', side_effect=_spawn):
+            # The first request on connecting is a health check, which is
+            # sent outside of the in flight window
+            self.assertEqual(app_mtr.transport.lines[0],
+                             '0 check-support feature send-probe')
+            self.assertEqual(app_mtr.requests, {})
+            app_mtr.outReceived(b'0 feature-support support ok\n')
+            app_mtr.trace(lambda *a: results.append(a), self.fail,
+                          ipaddress.IPv4Address('10.0.0.4'),
+                          mode='parallel', window=3)
+            app_mtr.outReceived(fake_response(app_mtr.transport.lines[1]))
+            # mtr-packet dies, the requests in flight are replayed after it
+            # is respawned
+            app_mtr.processEnded(crashed)
+            self.assertEqual(app_mtr.queue_length(), 3)
+            clock.advance(app_mtr.RESPAWN_DELAY)
+            self.assertEqual(len(spawned), 1)
+            self.assertEqual([l.split()[-1] for l in spawned[0].lines],
+                             ['send-probe', '2', '3', '4'])
+            self.assertEqual(spawned[0].lines[0].split()[0], '5')
+            # The respawn backoff doubles until a health check passes
+            app_mtr.processEnded(crashed)
+            clock.advance(app_mtr.RESPAWN_DELAY)
+            self.assertEqual(len(spawned), 1)
+            clock.advance(app_mtr.RESPAWN_DELAY)
+            self.assertEqual(len(spawned), 2)
+            self.assertEqual(app_mtr.respawn_delay, 4)
+            for line in spawned[1].lines:
+                if 'check-support' in line:
+                    app_mtr.outReceived(f'{line.split()[0]} feature-support '
+                                        f'support ok\n'.encode())
+                else:
+                    app_mtr.outReceived(fake_response(line))
+            self.assertEqual(app_mtr.respawn_delay, app_mtr.RESPAWN_DELAY)
+            self.assertEqual(app_mtr.respawns, 0)
+            self.assertEqual(results[0][-1], [(1, '10.0.0.1', 100),
+                                              (2, None, None),
+                                              (3, '10.0.0.3', 300),
+                                              (4, '10.0.0.4', 400)])
+            # An unanswered health check kills mtr-packet without shrinking
+            # the in flight window
+            window = app_mtr.window_size()
+            with mock.patch.object(spawned[1], 'signalProcess',
+                                   create=True) as signal_process:
+                clock.advance(app_mtr.health_check_interval)
+                clock.advance(app_mtr.WAIT_TIMEOUT)
+            signal_process.assert_called_once_with('KILL')
+            self.assertEqual(app_mtr.window_size(), window)
+            # A clean exit is not respawned
+            app_mtr.processEnded(Failure(ProcessDone(0)))
+            clock.advance(app_mtr.MAX_RESPAWN_DELAY)
+            self.assertEqual(len(spawned), 2)
+            # Nor is anything after MAX_RESPAWNS respawns in a row
+            app_mtr.respawns = app_mtr.MAX_RESPAWNS
+            app_mtr.processEnded(crashed)
+            clock.advance(app_mtr.MAX_RESPAWN_DELAY)
+            self.assertEqual(len(spawned), 2)
+            # Or once stopped
+            app_mtr.respawns = 0
+            app_mtr.stop()
+            app_mtr.processEnded(crashed)
+            clock.advance(app_mtr.MAX_RESPAWN_DELAY)
+            self.assertEqual(len(spawned), 2)
+
+    def test_rate_limit(self):
+        app_mtr, clock = self.make_traceroute()
+        app_mtr.rate_limiter = scheduler.TokenBucket(10, burst=2)
+        app_mtr.trace(lambda *a: None, self.fail,
+                      ipaddress.IPv4Address('10.0.0.4'), mode='parallel',
+                      window=5)
+        self.assertEqual(len(app_mtr.transport.lines), 2)
+        clock.advance(0.1)
+        self.assertEqual(len(app_mtr.transport.lines), 3)
+        clock.advance(0.2)
+        self.assertEqual(len(app_mtr.transport.lines), 5)
+
+    def test_scheduler(self):
+        clock = self.patch_reactor()
+        started = []
+
+        class FakeTracer:
+
+            def trace(self, callback, errback, ip_address, **kwargs):
+                started.append((str(ip_address), callback, clock.seconds()))
+
+        trace_scheduler = scheduler.TraceScheduler(
+            FakeTracer(), interval=10, jitter=0.1, max_active=1, seed=1)
+        for i in range(3):
+            trace_scheduler.add(ipaddress.IPv4Address(f'10.0.1.{i}'))
+        self.assertEqual(len(trace_scheduler), 3)
+        # Targets are spread over the first interval, one runs at a time
+        clock.advance(10)
+        self.assertEqual(len(started), 1)
+        self.assertEqual(trace_scheduler.queue_lengths(), {1: 2})
+        # On demand traces start ahead of waiting periodic traces
+        got = []
+        trace_scheduler.trace(lambda *a: got.append(a), None,
+                              ipaddress.IPv4Address('10.0.2.1'))
+        started[0][1](0, None, 'icmp', -1, [])
+        clock.advance(0)
+        self.assertEqual(started[1][0], '10.0.2.1')
+        started[1][1](0, None, 'icmp', -1, [])
+        self.assertEqual(len(got), 1)
+        for _ in range(2):
+            clock.advance(0)
+            started[-1][1](0, None, 'icmp', -1, [])
+        self.assertEqual(len(started), 4)
+        # Periodic targets are traced again an interval, give or take the
+        # jitter, after their last trace started
+        first_target, _, first_started = started[0]
+        trace_scheduler.remove(ipaddress.IPv4Address('10.0.1.2'))
+        clock.advance(first_started + 9 - clock.seconds())
+        self.assertEqual(len(started), 4)
+        clock.advance(2)
+        self.assertEqual(started[4][0], first_target)
+        self.assertTrue(first_started + 9 <= started[4][2] <=
+                        first_started + 11)
+        trace_scheduler.stop()
+        # Any exception starting a trace frees its slot and is passed to the
+        # errback
+
+        class BrokenTracer:
+
+            def trace(self, callback, errback, ip_address, **kwargs):
+                raise OSError('broken pipe')
+
+        trace_scheduler = scheduler.TraceScheduler(BrokenTracer(),
+                                                   max_active=1)
+        failed = []
+        for i in range(2):
+            trace_scheduler.trace(None, lambda *a: failed.append(a[2]),
+                                  ipaddress.IPv4Address(f'10.0.3.{i}'))
+            clock.advance(0)
+        self.assertEqual(failed, ['broken pipe', 'broken pipe'])
+        self.assertEqual(trace_scheduler.active, 0)
+        trace_scheduler.stop()
+
+    def test_multipath(self):
+        self.assertEqual([multipath.probes_needed(k, 0.95) for k in (1, 2, 3)],
+                         [6, 11, 16])
+        clock = self.patch_reactor()
+        topology = testing.Topology(paths={
+            '10.0.0.9': [
+                ('10.0.0.1', 100),
+                [('10.1.0.1', 200), ('10.1.0.2', 210)],
+                [('10.2.0.1', 300), ('10.2.0.2', 310), ('10.2.0.3', 320)],
+            ],
+        }, target_rtt=100)
+        app_mtr = mtr.TraceRoute(local_ipv4=ipaddress.IPv4Address('10.0.0.0'))
+        fake = testing.FakeMTRPacket(app_mtr, topology, clock=clock)
+        results = []
+        for protocol, port in (('udp', None), ('tcp', 80)):
+            app_mtr.trace_multipath(lambda *a: results.append(a), self.fail,
+                                    ipaddress.IPv4Address('10.0.0.9'),
+                                    protocol=protocol, port=port)
+        clock.pump([0.01] * 100)
+        self.assertEqual(len(results), 2)
+        for result in results:
+            hops = result[-1]
+            self.assertEqual([hop_num for hop_num, _ in hops], [1, 2, 3, 4])
+            self.assertEqual(hops[0][1], (('10.0.0.1', 100),))
+            self.assertEqual([ip for ip, _ in hops[1][1]],
+                             ['10.1.0.1', '10.1.0.2'])
+            self.assertEqual([ip for ip, _ in hops[2][1]],
+                             ['10.2.0.1', '10.2.0.2', '10.2.0.3'])
+            self.assertEqual(hops[3][1], (('10.0.0.9', 400),))
+        # Flow identifiers are added to the send-probe requests
+        template = app_mtr.probe_template(
+            ipaddress.IPv4Address('10.0.0.9'), 'udp', 33434, 5,
+            extra_args=['local-port', '33000'])
+        self.assertTrue(template.endswith(b' protocol udp port 33434 '
+                                          b'local-port 33000 ttl '))
+        # The probe budget limits the trace
+        probes = fake.probes
+        app_mtr.trace_multipath(lambda *a: results.append(a), self.fail,
+                                ipaddress.IPv4Address('10.0.0.9'),
+                                max_probes=10)
+        clock.pump([0.01] * 100)
+        self.assertEqual(fake.probes - probes, 10)
+        self.assertEqual([hop_num for hop_num, _ in results[2][-1]], [1, 2])
+        # icmp probes can't be kept on one path so they are rejected
+        with self.assertRaises(errors.MTRError):
+            app_mtr.trace_multipath(None, None,
+                                    ipaddress.IPv4Address('10.0.0.9'),
+                                    protocol='icmp')
+        # Every probe of a flow has the same protocol, source and destination
+        # ports at every TTL, so it hashes to the same path
+        app_mtr, clock = self.make_traceroute()
+        app_mtr.trace_multipath(None, None, ipaddress.IPv4Address('10.0.0.9'),
+                                window=3)
+        flows = {}
+        for line in app_mtr.transport.lines:
+            args = line.split()
+            self.assertNotIn('bit-pattern', args)
+            flows.setdefault(args[args.index('local-port') + 1], set()).add(
+                ' '.join(args[1:-2]))
+        self.assertEqual(len(flows), multipath.probes_needed(1, 0.95))
+        self.assertEqual([len(requests) for requests in flows.values()],
+                         [1] * len(flows))
+        self.assertEqual(len(app_mtr.transport.lines), 3 * len(flows))
+
+    def test_trace_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        trace_store = store.TraceStore(directory, segment_size=200)
+        target = ipaddress.IPv4Address('10.0.0.4')
+        hops = [(1, '10.0.0.1', 100), (2, None, None), (3, '10.0.0.3', 300),
+                (4, '10.0.0.4', 400)]
+        for i in range(5):
+            trace_store.add(1000.0 + i, target, 'udp', 33434, hops)
+        v6_hops = [(1, 'fe80::1', 50), (2, '2001:db8::1', 60)]
+        trace_store.add(2000.0, ipaddress.IPv6Address('2001:db8::1'), 'icmp',
+                        -1, results.TraceResult.from_hops(
+                            2000.0, '2001:db8::1', 'icmp', -1, v6_hops))
+        self.assertEqual(trace_store.latest(target),
+                         (1004.0, target, 'udp', 33434, hops))
+        self.assertEqual(trace_store.latest('2001:db8::1')[-1], v6_hops)
+        self.assertIsNone(trace_store.latest('10.0.0.5'))
+        self.assertEqual([ts for ts, *_ in trace_store.history(target)],
+                         [1004.0, 1003.0, 1002.0, 1001.0, 1000.0])
+        self.assertEqual(trace_store.targets_via('10.0.0.3'), {'10.0.0.4'})
+        self.assertEqual(trace_store.targets_via('fe80::1'), {'2001:db8::1'})
+        # Records never span segments
+        self.assertGreater(len(trace_store.segments), 1)
+        # Reopening rebuilds the indexes and drops a torn record at the end
+        trace_store.close()
+        last = max(os.listdir(directory))
+        with open(os.path.join(directory, last), 'ab') as f:
+            f.write(store.encode_record(3000.0, target, 'udp', 33434,
+                                        hops)[:20])
+        trace_store = store.TraceStore(directory, segment_size=200)
+        self.assertEqual(trace_store.records, 6)
+        self.assertEqual(len(list(trace_store.scan())), 6)
+        self.assertEqual(trace_store.latest(target)[0], 1004.0)
+        # Segments are only kept mapped, holding a file open, for reads and
+        # no more than MAX_MAPPED at once
+        segments = trace_store.segments.values()
+        self.assertEqual([s for s in segments if s.map is not None],
+                         list(trace_store.mapped.values()))
+        self.assertEqual(len(trace_store.mapped), 1)
+        trace_store.MAX_MAPPED = 2
+        self.assertEqual(len(list(trace_store.history(target))), 5)
+        self.assertEqual(len([s for s in segments if s.map is not None]), 2)
+        # Compaction keeps the newest records of each target
+        trace_store.add(3000.0, target, 'udp', 33434, hops)
+        trace_store.compact(keep=2)
+        self.assertEqual([ts for ts, *_ in trace_store.scan()],
+                         [1004.0, 2000.0, 3000.0])
+        self.assertEqual(len(trace_store.segments), 2)
+        self.assertEqual(trace_store.latest(target)[0], 3000.0)
+        # A crash after the compacted segment replaced the last old segment
+        # is finished when the store is next opened
+        for i in range(3):
+            trace_store.add(4000.0 + i, target, 'udp', 33434, hops)
+        with mock.patch.object(store.os, 'unlink', side_effect=OSError):
+            with self.assertRaises(OSError):
+                trace_store.compact(keep=10)
+        self.assertTrue([name for name in os.listdir(directory)
+                         if name.startswith('compacted-')])
+        trace_store.close()
+        trace_store = store.TraceStore(directory, segment_size=200)
+        self.assertEqual([ts for ts, *_ in trace_store.scan()],
+                         [1004.0, 2000.0, 3000.0, 4000.0, 4001.0, 4002.0])
+        names = sorted(os.listdir(directory))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(name.startswith('segment-') for name in names))
+        trace_store.close()
+        # A compacted segment with no marker was never finished and is
+        # removed
+        with open(os.path.join(directory, names[-1] + '.compact'),
+                  'wb') as f:
+            f.write(b'partial')
+        trace_store = store.TraceStore(directory, segment_size=200)
+        self.assertEqual(trace_store.records, 6)
+        self.assertEqual(sorted(os.listdir(directory)), names)
+        trace_store.close()
+
+    def test_path_changes(self):
+        events = []
+        detector = changes.PathChangeDetector(callback=events.append)
+        target = ipaddress.IPv4Address('10.0.0.4')
+
+        def _trace(*hops):
+            return detector.update(1000.0, target, 'icmp', -1,
+                                   [(i + 1, ip, rtt)
+                                    for i, (ip, rtt) in enumerate(hops)])
+
+        path = [('10.0.0.1', 100), ('10.0.0.2', 200), (None, None),
+                ('10.0.0.4', 400)]
+        self.assertEqual(_trace(*path), [])
+        self.assertEqual(len(detector), 1)
+        self.assertEqual(_trace(*path), [])
+        # A hop replying for the first time and a replaced hop
+        kinds = [(e.kind, e.hop_num, e.old, e.new) for e in _trace(
+            ('10.0.0.1', 100), ('10.9.0.2', 200), ('10.0.0.3', 300),
+            ('10.0.0.4', 400))]
+        self.assertEqual(kinds, [('hop-replaced', 2, '10.0.0.2', '10.9.0.2'),
+                                 ('hop-added', 3, None, '10.0.0.3')])
+        self.assertEqual(events[0].target_ip, target)
+        # Hops which don't reply are tolerated up to the silent limit
+        quiet = [('10.0.0.1', 100), (None, None), ('10.0.0.3', 300),
+                 ('10.0.0.4', 400)]
+        self.assertEqual(_trace(*quiet), [])
+        self.assertEqual(_trace(*quiet), [])
+        self.assertEqual([e.kind for e in _trace(*quiet)], ['hop-removed'])
+        # So are traces which end early without reaching the target
+        self.assertEqual(_trace(('10.0.0.1', 100), (None, None)), [])
+        # A shorter path to the target is reported at once
+        added, event = _trace(('10.0.0.1', 100), ('10.0.0.4', 400))
+        self.assertEqual((added.kind, added.new), ('hop-added', '10.0.0.4'))
+        self.assertEqual((event.kind, event.old, event.new),
+                         ('length-changed', 4, 2))
+        # RTT shifts need several traces in a row, a spike is ignored
+        self.assertEqual(_trace(('10.0.0.1', 100), ('10.0.0.4', 90000)), [])
+        self.assertEqual(_trace(('10.0.0.1', 100), ('10.0.0.4', 400)), [])
+        for _ in range(2):
+            self.assertEqual(
+                _trace(('10.0.0.1', 100), ('10.0.0.4', 90000)), [])
+        event, = _trace(('10.0.0.1', 100), ('10.0.0.4', 90000))
+        self.assertEqual((event.kind, event.hop_num, event.new),
+                         ('rtt-shift', 2, 90000))
+        self.assertEqual(len(events), 6)
+        detector.forget(target)
+        self.assertEqual(len(detector), 0)
+
+    def test_asn(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'pfx2as.txt')
+        with open(path, 'wt') as f:
+            f.write('# prefix length asn\n'
+                    '10.0.0.0\t8\t64500\n'
+                    '10.1.0.0\t16\t64501_64502\n'
+                    '10.1.2.0\t24\t64503\n'
+                    '10.1.2.128/25 {64504,64505}\n'
+                    '\n'
+                    '2001:db8::/32 64510\n')
+        table = asn.PrefixTable.load(path)
+        self.assertEqual(len(table), 5)
+        self.assertEqual(table.lookup('10.9.9.9'), (64500, '10.0.0.0/8'))
+        self.assertEqual(table.lookup('10.1.9.9'), (64501, '10.1.0.0/16'))
+        self.assertEqual(table.lookup('10.1.2.3'), (64503, '10.1.2.0/24'))
+        self.assertEqual(table.lookup(ipaddress.IPv4Address('10.1.2.200')),
+                         (64504, '10.1.2.128/25'))
+        self.assertEqual(table.lookup('2001:db8::1'),
+                         (64510, '2001:db8::/32'))
+        self.assertIsNone(table.lookup('192.0.2.1'))
+        self.assertIsNone(table.lookup('2001:db9::1'))
+        # Shorter prefixes added later don't replace longer ones
+        table.add('10.1.0.0/12', 64520)
+        self.assertEqual(table.lookup('10.1.9.9')[0], 64501)
+        self.assertEqual(table.lookup('10.2.0.1')[0], 64520)
+        with open(path, 'at') as f:
+            f.write('10.0.0.0/33 64500\n')
+        with self.assertRaises(errors.MTRError):
+            asn.PrefixTable.load(path)
+        enricher = asn.ASNEnricher(table, cache_size=2)
+        results = []
+        callback = enricher.wrap(lambda *a: results.append(a))
+        callback(1000.0, ipaddress.IPv4Address('10.1.2.3'), 'icmp', -1,
+                 [(1, '192.0.2.1', 100), (2, '10.200.0.1', 200),
+                  (3, None, None), (4, '10.2.0.1', 300),
+                  (5, '10.1.9.9', 400), (6, '10.1.2.3', 500)])
+        hops = results[0][-1]
+        self.assertEqual(hops[1], asn.EnrichedHop(2, '10.200.0.1', 200,
+                                                  64500, '10.0.0.0/8'))
+        self.assertEqual(hops[2].asn, None)
+        self.assertEqual(enricher.as_path(hops),
+                         [(64500, 2, 2), (64520, 4, 4), (64501, 5, 5),
+                          (64503, 6, 6)])
+        enricher.enrich([(1, '10.200.0.1', 100), (2, '10.1.2.3', 200)])
+        self.assertEqual(enricher.stats(), {'entries': 2, 'hits': 1,
+                                            'misses': 6, 'evictions': 4})
+
+    def test_export(self):
+        clock = self.patch_reactor()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        columnar_path = os.path.join(directory, 'traces.mtrb')
+        ndjson_path = os.path.join(directory, 'traces.ndjson')
+        exporter = export.TraceExporter(export.ColumnarWriter(columnar_path),
+                                        max_rows=8, max_delay=5,
+                                        threaded=False)
+        ndjson_exporter = export.TraceExporter(
+            export.NDJSONWriter(ndjson_path), threaded=False)
+        target = ipaddress.IPv4Address('10.0.0.4')
+        hops = [(1, '10.0.0.1', 100), (2, None, None), (3, '10.0.0.3', 300),
+                (4, '10.0.0.4', 400)]
+        for i in range(3):
+            for e in (exporter, ndjson_exporter):
+                e.add(1000.0 + i, target, 'udp', 33434, hops)
+        # The size limit wrote the first 2 traces, the third waits for the
+        # time limit
+        self.assertEqual(exporter.batches_written, 1)
+        self.assertEqual(exporter.rows_written, 8)
+        self.assertEqual(exporter.rows, 4)
+        clock.advance(5)
+        self.assertEqual(exporter.batches_written, 2)
+        self.assertEqual(exporter.pending, [])
+        exporter.add(2000.0, ipaddress.IPv6Address('2001:db8::1'), 'icmp',
+                     -1, [(1, 'fe80::1', 50)])
+        flushed = []
+        exporter.close().addCallback(flushed.append)
+        ndjson_exporter.close()
+        self.assertEqual(flushed, [None])
+        batches = list(export.read_batches(columnar_path))
+        self.assertEqual([len(batch) for batch in batches], [8, 4, 1])
+        first = batches[0]
+        self.assertEqual(list(first.columns['trace']), [0] * 4 + [1] * 4)
+        self.assertEqual(list(first.columns['rtt'][:4]), [100, -1, 300, 400])
+        self.assertEqual(first.strings[first.columns['hop_ip'][2]],
+                         '10.0.0.3')
+        traces = [trace for batch in batches for trace in batch.traces()]
+        self.assertEqual(traces[2], (1002.0, '10.0.0.4', 'udp', 33434, hops))
+        self.assertEqual(traces[3], (2000.0, '2001:db8::1', 'icmp', -1,
+                                     [(1, 'fe80::1', 50)]))
+        with open(ndjson_path, 'rt') as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], {'ts': 1000.0, 'target_ip': '10.0.0.4',
+                                    'protocol': 'udp', 'port': 33434,
+                                    'hops': [list(hop) for hop in hops]})
+
     def test_traceroute(self):
 
         done = {'icmp4': False, 'icmp6': False, 'tcp4': False, 'tcp6': False}
@@ -0,0 +1,292 @@
+import gzip
+import socket
+import logging
+from array import array
+from collections import OrderedDict, namedtuple
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('asn', level=logging.INFO)
+
+
+# A hop decorated with the origin ASN and prefix of its IP, both None if the
+# hop did not reply or its IP is not in any prefix
+EnrichedHop = namedtuple('EnrichedHop', ('hop_num', 'hop_ip', 'rtt', 'asn',
+                                         'prefix'))
+
+
+class PrefixTrie:
+    '''
+        Radix trie of the prefixes of one address family, used for longest
+        prefix matches. The first "stride" bits of an address index a root
+        table directly, prefixes no longer than the stride are expanded into
+        every root slot they cover and longer prefixes are kept in binary
+        subtries below their root slot, so most lookups only walk the bits
+        after the stride. Nodes are stored in flat arrays rather than as
+        objects: node n has its two children at children[2n] and
+        children[2n + 1] and the index of the value of the prefix ending at
+        the node at values[n], -1 if there is none. Node 0 means no node.
+    '''
+
+    STRIDE = 16           # Bits of an address indexing the root table
+
+    def __init__(self, bits, stride=None):
+        self.bits = bits
+        self.stride = self.STRIDE if stride is None else stride
+        if not 1 <= self.stride <= min(bits, 24):
+            raise MTRError(f'stride must be between 1 and 24, '
+                           f'got: {self.stride}')
+        slots = 1 << self.stride
+        self.root_values = array('i', (-1,)) * slots
+        self.root_lengths = array('b', (-1,)) * slots
+        self.root_nodes = array('i', (0,)) * slots
+        self.children = array('i', (0, 0))
+        self.values = array('i', (-1,))
+
+    def new_node(self):
+        self.children.extend((0, 0))
+        self.values.append(-1)
+        return len(self.values) - 1
+
+    def insert(self, key, prefix_length, value):
+        slot = key >> (self.bits - self.stride)
+        if prefix_length <= self.stride:
+            # Expand the prefix into each root slot it covers unless a longer
+            # prefix is already there
+            first = slot & ~((1 << (self.stride - prefix_length)) - 1)
+            for i in range(first, first + (1 << (self.stride -
+                                                 prefix_length))):
+                if self.root_lengths[i] <= prefix_length:
+                    self.root_values[i] = value
+                    self.root_lengths[i] = prefix_length
+            return
+        node = self.root_nodes[slot]
+        if not node:
+            node = self.new_node()
+            self.root_nodes[slot] = node
+        for depth in range(self.stride, prefix_length):
+            i = 2 * node + ((key >> (self.bits - 1 - depth)) & 1)
+            child = self.children[i]
+            if not child:
+                child = self.new_node()
+                self.children[i] = child
+            node = child
+        self.values[node] = value
+
+    def lookup(self, key):
+        '''
+            Returns the value of the longest prefix containing the address
+            "key" as an int, or -1 if no prefix contains it.
+        '''
+        shift = self.bits - self.stride
+        slot = key >> shift
+        best = self.root_values[slot]
+        node = self.root_nodes[slot]
+        if not node:
+            return best
+        children = self.children
+        values = self.values
+        shift -= 1
+        while shift >= 0:
+            node = children[2 * node + ((key >> shift) & 1)]
+            if not node:
+                break
+            value = values[node]
+            if value >= 0:
+                best = value
+            shift -= 1
+        return best
+
+
+class PrefixTable:
+    '''
+        Maps IPv4 and IPv6 prefixes to their origin ASN with a PrefixTrie for
+        each address family.
+    '''
+
+    FAMILIES = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+    def __init__(self):
+        self.tries = {version: PrefixTrie(bits)
+                      for version, (family, bits) in self.FAMILIES.items()}
+        self.prefixes = []
+        self.asns = []
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    @staticmethod
+    def parse_ip(ip):
+        # Returns (version, int) for an IP address or string, parsing strings
+        # with inet_pton as it is much faster than the ipaddress module
+        if not isinstance(ip, str):
+            return ip.version, int(ip)
+        if ':' in ip:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip),
+                                     'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+
+    def add(self, prefix, asn):
+        '''
+            Adds a prefix, such as '1.1.1.0/24', originated by an ASN. Host
+            bits set in the prefix are ignored. Adding a prefix again replaces
+            its ASN.
+        '''
+        address, _, prefix_length = prefix.partition('/')
+        try:
+            version, key = self.parse_ip(address)
+        except OSError as e:
+            raise ValueError(f'invalid prefix address: {address}') from e
+        family, bits = self.FAMILIES[version]
+        prefix_length = int(prefix_length) if prefix_length else bits
+        if not 0 <= prefix_length <= bits:
+            raise ValueError(f'invalid prefix length: {prefix_length}')
+        key &= ~((1 << (bits - prefix_length)) - 1)
+        address = socket.inet_ntop(family, key.to_bytes(bits // 8, 'big'))
+        self.prefixes.append(f'{address}/{prefix_length}')
+        self.asns.append(asn)
+        self.tries[version].insert(key, prefix_length,
+                                   len(self.prefixes) - 1)
+
+    def lookup(self, ip):
+        '''
+            Returns an (asn, prefix) tuple for the longest prefix containing
+            the IP address or string "ip", or None.
+        '''
+        try:
+            version, key = self.parse_ip(ip)
+        except OSError as e:
+            raise MTRError(f'Invalid IP address: {ip}') from e
+        value = self.tries[version].lookup(key)
+        if value < 0:
+            return None
+        return self.asns[value], self.prefixes[value]
+
+    @staticmethod
+    def parse_asn(asn):
+        # Multi-origin prefixes are written as 13335_209 and AS sets as
+        # 13335,209 or {13335,209}, the first ASN is used for both
+        return int(asn.strip('{}').replace('_', ',').split(',')[0])
+
+    @classmethod
+    def load(cls, path):
+        '''
+            Loads a table from a text file, gzipped if the path ends in .gz,
+            with a prefix and its ASN on each line. Lines are either in the
+            CAIDA prefix2as format of "address<tab>length<tab>asn" or in the
+            format "address/length asn". Blank lines and lines starting with
+            # are skipped.
+        '''
+        table = cls()
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for line_num, line in enumerate(f, 1):
+                parts = line.split()
+                if not parts or parts[0].startswith('#'):
+                    continue
+                try:
+                    if '/' in parts[0]:
+                        prefix, asn = parts[0], parts[1]
+                    else:
+                        prefix, asn = f'{parts[0]}/{parts[1]}', parts[2]
+                    table.add(prefix, cls.parse_asn(asn))
+                except (IndexError, ValueError) as e:
+                    raise MTRError(f'Invalid prefix on line {line_num} of '
+                                   f'{path}: {line.strip()} ({e})') from e
+        log.debug(f'Loaded {len(table)} prefixes from {path}')
+        return table
+
+
+class ASNEnricher:
+    '''
+        Decorates the hops of completed traces with the origin ASN and
+        prefix of each hop IP from a PrefixTable. The results of the last
+        "cache_size" lookups are cached as traces pass through the same hops
+        over and over.
+    '''
+
+    CACHE_SIZE = 65536    # Number of hop IP lookups to cache
+
+    def __init__(self, table, cache_size=None):
+        self.table = table
+        self.cache_size = (self.CACHE_SIZE if cache_size is None
+                           else cache_size)
+        if self.cache_size < 1:
+            raise MTRError(f'cache_size must be 1 or more, '
+                           f'got: {self.cache_size}')
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, hop_ip):
+        '''
+            Returns an (asn, prefix) tuple for a hop IP string, (None, None)
+            if it is not in any prefix.
+        '''
+        cache = self.cache
+        result = cache.get(hop_ip)
+        if result is not None:
+            cache.move_to_end(hop_ip)
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = self.table.lookup(hop_ip) or (None, None)
+        cache[hop_ip] = result
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+            self.evictions += 1
+        return result
+
+    def enrich(self, hops):
+        '''
+            Returns a list of EnrichedHop for the hops of a trace.
+        '''
+        enriched = []
+        for hop_num, hop_ip, rtt in hops:
+            if hop_ip is None:
+                enriched.append(EnrichedHop(hop_num, None, rtt, None, None))
+            else:
+                enriched.append(EnrichedHop(hop_num, hop_ip, rtt,
+                                            *self.lookup(hop_ip)))
+        return enriched
+
+    @staticmethod
+    def as_path(hops):
+        '''
+            Returns the AS path of a list of EnrichedHop as a list of (asn,
+            first_hop_num, last_hop_num) tuples, one for each run of hops in
+            the same ASN. Hops with no ASN don't break a run.
+        '''
+        path = []
+        for hop in hops:
+            if hop.asn is None:
+                continue
+            if path and path[-1][0] == hop.asn:
+                path[-1] = (hop.asn, path[-1][1], hop.hop_num)
+            else:
+                path.append((hop.asn, hop.hop_num, hop.hop_num))
+        return path
+
+    def wrap(self, callback):
+        '''
+            Returns a success callback for TraceRoute.trace() which calls
+            "callback" with the same arguments except that hops is a list of
+            EnrichedHop.
+        '''
+        def _got_result(ts, target_ip, protocol, port, hops):
+            callback(ts, target_ip, protocol, port, self.enrich(hops))
+        return _got_result
+
+    def stats(self):
+        '''
+            Returns a dict of the lookup cache hit, miss and eviction
+            counters.
+        '''
+        return {
+            'entries': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,126 @@
+import logging
+from collections import deque
+from twisted.internet import defer
+from .logger import get_logger
+from .errors import MTRError, SocketError
+from .utils import parse_ip
+
+
+log = get_logger('bulk', level=logging.INFO)
+
+
+class TraceMany:
+    '''
+        Traces every target in an iterable of targets while keeping at most
+        "concurrency" traces active at once. Targets are only taken from the
+        iterable when there is room for another trace, so generators of any
+        length can be used without them being loaded into memory. Completed
+        traces count towards "concurrency" until they are consumed so memory
+        use stays flat if results are consumed slower than they complete.
+
+        Results are consumed either with next(), which returns a Deferred that
+        fires with the next result or None when all targets are done, or with
+        "async for". Results are in the order traces complete and each one is
+        a (success, result) tuple. For a successful trace "result" is a
+        (timestamp, target_ip, protocol, port, hops) tuple as passed to the
+        trace() callback, for a failed trace it is a (target_ip, error) tuple.
+    '''
+
+    CONCURRENCY = 100     # Default maximum number of traces active at once
+
+    def __init__(self, tracer, targets, concurrency=None, protocol='icmp',
+                 port=-1, **trace_kwargs):
+        if concurrency is None:
+            concurrency = self.CONCURRENCY
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise MTRError(f'Concurrency must be an int of 1 or more, '
+                           f'got: {concurrency}')
+        self.tracer = tracer
+        self.targets = iter(targets)
+        self.concurrency = concurrency
+        self.protocol = protocol
+        self.port = port
+        self.trace_kwargs = trace_kwargs
+        self.active = 0
+        self.exhausted = False
+        self.results = deque()
+        self.waiting = deque()
+        self.fill()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        result = await self.next()
+        if result is None:
+            raise StopAsyncIteration
+        return result
+
+    def done(self):
+        '''
+            Returns True once every target has been traced and every result
+            has been consumed.
+        '''
+        return self.exhausted and not self.active and not self.results
+
+    def next(self):
+        '''
+            Returns a Deferred that fires with the next completed trace, or
+            None if there are no more targets to trace.
+        '''
+        if self.results:
+            result = self.results.popleft()
+            self.fill()
+            return defer.succeed(result)
+        if self.done():
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d
+
+    def fill(self):
+        # Hand buffered results to waiting consumers and start traces until
+        # the concurrency limit is reached or there are no more targets
+        while True:
+            while self.waiting and self.results:
+                self.waiting.popleft().callback(self.results.popleft())
+            if (self.exhausted or
+                    self.active + len(self.results) >= self.concurrency):
+                break
+            try:
+                target = next(self.targets)
+            except StopIteration:
+                self.exhausted = True
+                break
+            self.start(target)
+        if self.done():
+            # Tell anything still waiting that there are no more results
+            while self.waiting:
+                self.waiting.popleft().callback(None)
+
+    def start(self, target):
+        # Start a single trace to a target
+        self.active += 1
+
+        def _got_result(ts, target_ip, protocol, port, hops):
+            self.active -= 1
+            self.push((True, (ts, target_ip, protocol, port, hops)))
+
+        def _got_error(c, request, error, extra):
+            self.active -= 1
+            self.push((False, (target, error)))
+
+        try:
+            target = parse_ip(target)
+            self.tracer.trace(_got_result, _got_error, target,
+                              protocol=self.protocol, port=self.port,
+                              **self.trace_kwargs)
+        except (MTRError, SocketError) as e:
+            log.error(f'Failed to start trace to {target}: {e}')
+            self.active -= 1
+            self.results.append((False, (target, str(e))))
+
+    def push(self, result):
+        # Buffer a result, fill() passes it on to a waiting consumer
+        self.results.append(result)
+        self.fill()
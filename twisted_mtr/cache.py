@@ -0,0 +1,77 @@
+import logging
+from collections import OrderedDict
+from time import time
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('cache', level=logging.INFO)
+
+
+class TraceCache:
+    '''
+        In-memory cache of recently completed traces keyed by target IP,
+        protocol, port and starting TTL. Entries are fresh for "max_age"
+        seconds from the time their trace started. When more than
+        "max_entries" traces are cached the least recently used entry is
+        evicted.
+    '''
+
+    MAX_AGE = 60          # Seconds, how long a cached trace is fresh for
+    MAX_ENTRIES = 10000   # Maximum number of traces to cache
+
+    def __init__(self, max_age=None, max_entries=None):
+        self.max_age = self.MAX_AGE if max_age is None else max_age
+        self.max_entries = (self.MAX_ENTRIES if max_entries is None
+                            else max_entries)
+        if self.max_entries < 1:
+            raise MTRError(f'max_entries must be 1 or more, '
+                           f'got: {self.max_entries}')
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''
+            Returns a (timestamp, hops) tuple for a fresh cached trace or None
+            if there is no fresh trace cached for the key.
+        '''
+        entry = self.entries.get(key)
+        if entry is not None:
+            if time() - entry[0] < self.max_age:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            # Stale, drop it
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, ts, hops):
+        '''
+            Caches the hops for a completed trace which started at "ts".
+        '''
+        self.entries[key] = (ts, hops)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.evictions += 1
+            log.debug(f'Evicted cached trace: {evicted_key}')
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        '''
+            Returns a dict of the cache hit, miss and eviction counters.
+        '''
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
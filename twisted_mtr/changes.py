@@ -0,0 +1,203 @@
+import logging
+from array import array
+from collections import namedtuple
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('changes', level=logging.INFO)
+
+
+# A change to the path to a target. "kind" is one of the PathChangeDetector
+# event kinds, "hop_num" is None for length changes. "old" and "new" are hop
+# IPs for hop changes, path lengths for length changes and RTTs in
+# microseconds for RTT shifts
+PathChange = namedtuple('PathChange', ('ts', 'target_ip', 'protocol', 'port',
+                                       'kind', 'hop_num', 'old', 'new'))
+
+
+class PathFingerprint:
+    '''
+        The last known path to a target. Hop IPs are kept for each TTL, None
+        if the hop has never replied, with a count of traces in a row the hop
+        has not replied to and a smoothed RTT for each hop.
+    '''
+
+    __slots__ = ('ips', 'silent', 'srtt', 'strikes', 'short')
+
+    def __init__(self, ips, rtts):
+        self.ips = ips
+        self.silent = bytearray(len(ips))
+        self.srtt = array('d', (-1 if rtt is None else rtt for rtt in rtts))
+        self.strikes = bytearray(len(ips))
+        # Traces in a row which ended before the known path length
+        self.short = 0
+
+    def resize(self, length, ips, rtts):
+        del self.ips[length:]
+        del self.silent[length:]
+        del self.srtt[length:]
+        del self.strikes[length:]
+        for i in range(len(self.ips), len(ips)):
+            self.ips.append(ips[i])
+            self.silent.append(0)
+            self.srtt.append(-1 if rtts[i] is None else rtts[i])
+            self.strikes.append(0)
+
+
+class PathChangeDetector:
+    '''
+        Compares each completed trace of a target with a fingerprint of the
+        last known path to it and reports only what changed, as PathChange
+        events. update() takes the same arguments as the success callback of
+        TraceRoute.trace() so it can be used as one, it returns the list of
+        events and passes each one to "callback" if set. The first trace of a
+        target sets its fingerprint and reports nothing. Hops which do not
+        reply are tolerated: a hop is only reported removed once it has not
+        replied to "silent_limit" traces in a row, and a trace which ends
+        early without reaching the target only changes the path length once
+        "silent_limit" traces in a row have done so. An RTT shift is reported
+        when "rtt_samples" traces in a row see an RTT for a hop which differs
+        from its smoothed RTT by more than "rtt_threshold" as a fraction of
+        the smoothed RTT and by at least "min_rtt_shift" microseconds.
+    '''
+
+    HOP_ADDED = 'hop-added'        # A hop replied at a TTL for the first time
+    HOP_REMOVED = 'hop-removed'    # A hop stopped replying at a TTL
+    HOP_REPLACED = 'hop-replaced'  # A different hop replied at a TTL
+    LENGTH_CHANGED = 'length-changed'  # The number of hops changed
+    RTT_SHIFT = 'rtt-shift'        # The RTT of a hop moved to a new level
+
+    ALPHA = 1 / 8         # Gain for the smoothed RTT
+    RTT_THRESHOLD = 0.5   # Fractional RTT change counted towards a shift
+    MIN_RTT_SHIFT = 10000  # Microseconds, smallest RTT change for a shift
+    RTT_SAMPLES = 3       # Traces in a row with a changed RTT for a shift
+    SILENT_LIMIT = 3      # Traces in a row with no reply to remove a hop
+    MAX_TARGETS = 100000  # Maximum number of fingerprints to keep
+
+    def __init__(self, callback=None, rtt_threshold=None, min_rtt_shift=None,
+                 rtt_samples=None, silent_limit=None, max_targets=None):
+        self.callback = callback
+        self.rtt_threshold = (self.RTT_THRESHOLD if rtt_threshold is None
+                              else rtt_threshold)
+        self.min_rtt_shift = (self.MIN_RTT_SHIFT if min_rtt_shift is None
+                              else min_rtt_shift)
+        self.rtt_samples = (self.RTT_SAMPLES if rtt_samples is None
+                            else rtt_samples)
+        self.silent_limit = (self.SILENT_LIMIT if silent_limit is None
+                             else silent_limit)
+        for name in ('rtt_samples', 'silent_limit'):
+            value = getattr(self, name)
+            if not isinstance(value, int) or not 1 <= value <= 255:
+                raise MTRError(f'{name} must be an int between 1 and 255, '
+                               f'got: {value}')
+        self.max_targets = (self.MAX_TARGETS if max_targets is None
+                            else max_targets)
+        # Maps (target IP, protocol, port) to a PathFingerprint
+        self.fingerprints = {}
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def forget(self, target_ip, protocol='icmp', port=-1):
+        '''
+            Drops the fingerprint of a target, its next trace sets a new one.
+        '''
+        self.fingerprints.pop((str(target_ip), protocol, port), None)
+
+    def update(self, ts, target_ip, protocol, port, hops):
+        '''
+            Compares a completed trace with the last known path to the target
+            and returns a list of PathChange events.
+        '''
+        target = str(target_ip)
+        ips = []
+        rtts = []
+        for hop_num, hop_ip, rtt in hops:
+            while len(ips) < hop_num - 1:
+                ips.append(None)
+                rtts.append(None)
+            ips.append(hop_ip)
+            rtts.append(rtt)
+        # Trailing hops which did not reply are not part of the path length
+        length = len(ips)
+        while length and ips[length - 1] is None:
+            length -= 1
+        key = (target, protocol, port)
+        fingerprint = self.fingerprints.get(key)
+        if fingerprint is None:
+            self.fingerprints[key] = PathFingerprint(ips[:length],
+                                                     rtts[:length])
+            if len(self.fingerprints) > self.max_targets:
+                del self.fingerprints[next(iter(self.fingerprints))]
+            return []
+        events = []
+
+        def _event(kind, hop_num, old, new):
+            events.append(PathChange(ts, target_ip, protocol, port, kind,
+                                     hop_num, old, new))
+
+        known = fingerprint.ips
+        for i in range(min(length, len(known))):
+            old_ip, new_ip = known[i], ips[i]
+            if new_ip is None:
+                if old_ip is None:
+                    continue
+                fingerprint.silent[i] += 1
+                if fingerprint.silent[i] >= self.silent_limit:
+                    _event(self.HOP_REMOVED, i + 1, old_ip, None)
+                    known[i] = None
+                    fingerprint.silent[i] = 0
+                    fingerprint.srtt[i] = -1
+                continue
+            fingerprint.silent[i] = 0
+            rtt = rtts[i]
+            if new_ip != old_ip:
+                _event(self.HOP_ADDED if old_ip is None else
+                       self.HOP_REPLACED, i + 1, old_ip, new_ip)
+                known[i] = new_ip
+                fingerprint.srtt[i] = -1 if rtt is None else rtt
+                fingerprint.strikes[i] = 0
+            elif rtt is not None:
+                self.check_rtt(fingerprint, i, rtt, _event)
+        if length > len(known):
+            _event(self.LENGTH_CHANGED, None, len(known), length)
+            fingerprint.resize(length, ips, rtts)
+            fingerprint.short = 0
+        elif length < len(known):
+            # A shorter trace which reached the target is a shorter path,
+            # otherwise the last hops may just not have replied this time
+            fingerprint.short += 1
+            if (ips[length - 1:length] == [target] or
+                    fingerprint.short >= self.silent_limit):
+                _event(self.LENGTH_CHANGED, None, len(known), length)
+                fingerprint.resize(length, ips, rtts)
+                fingerprint.short = 0
+        else:
+            fingerprint.short = 0
+        if events:
+            log.debug(f'{len(events)} path changes to {target}')
+            if self.callback is not None:
+                for event in events:
+                    self.callback(event)
+        return events
+
+    def check_rtt(self, fingerprint, i, rtt, _event):
+        # Smooth the RTT of a hop and report a shift once enough samples in
+        # a row have moved away from it
+        srtt = fingerprint.srtt[i]
+        if srtt < 0:
+            fingerprint.srtt[i] = rtt
+            return
+        change = abs(rtt - srtt)
+        if (change > srtt * self.rtt_threshold and
+                change >= self.min_rtt_shift):
+            fingerprint.strikes[i] += 1
+            if fingerprint.strikes[i] >= self.rtt_samples:
+                _event(self.RTT_SHIFT, i + 1, round(srtt), rtt)
+                # Start smoothing from the new level
+                fingerprint.srtt[i] = rtt
+                fingerprint.strikes[i] = 0
+            return
+        fingerprint.strikes[i] = 0
+        fingerprint.srtt[i] = (1 - self.ALPHA) * srtt + self.ALPHA * rtt
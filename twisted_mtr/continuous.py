@@ -0,0 +1,230 @@
+import math
+import logging
+from twisted.internet import reactor, task
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('continuous', level=logging.INFO)
+
+
+class HopStats:
+    '''
+        Running statistics for a single hop in a continuous trace. Every
+        statistic is updated in constant time and memory per probe. RTTs are
+        in microseconds. Jitter is the difference between consecutive RTTs as
+        reported by mtr. "sent" only counts probes once they have a reply,
+        no-reply, error or timeout, so probes in flight are never counted as
+        lost.
+    '''
+
+    __slots__ = ('hop_num', 'hop_ip', 'sent', 'received', 'last', 'best',
+                 'worst', 'mean', 'm2', 'jitter', 'jitter_mean',
+                 'jitter_worst')
+
+    def __init__(self, hop_num):
+        self.hop_num = hop_num
+        self.hop_ip = None
+        self.sent = 0
+        self.received = 0
+        self.last = None
+        self.best = None
+        self.worst = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.jitter = None
+        self.jitter_mean = 0.0
+        self.jitter_worst = None
+
+    def add(self, hop_ip, rtt):
+        # Add a reply, the running mean and variance use Welford's algorithm
+        self.hop_ip = hop_ip
+        self.received += 1
+        if self.last is not None:
+            self.jitter = abs(rtt - self.last)
+            self.jitter_mean += ((self.jitter - self.jitter_mean) /
+                                 (self.received - 1))
+            if self.jitter_worst is None or self.jitter > self.jitter_worst:
+                self.jitter_worst = self.jitter
+        self.last = rtt
+        if self.best is None or rtt < self.best:
+            self.best = rtt
+        if self.worst is None or rtt > self.worst:
+            self.worst = rtt
+        delta = rtt - self.mean
+        self.mean += delta / self.received
+        self.m2 += delta * (rtt - self.mean)
+
+    def loss(self):
+        '''
+            Returns the percentage of probes with no reply.
+        '''
+        if not self.sent:
+            return 0.0
+        return (self.sent - self.received) / self.sent * 100
+
+    def stddev(self):
+        '''
+            Returns the standard deviation of the RTTs.
+        '''
+        if not self.received:
+            return 0.0
+        return math.sqrt(self.m2 / self.received)
+
+    def snapshot(self):
+        '''
+            Returns the current statistics as a dict.
+        '''
+        return {
+            'hop_num': self.hop_num,
+            'hop_ip': self.hop_ip,
+            'sent': self.sent,
+            'received': self.received,
+            'loss': self.loss(),
+            'last': self.last,
+            'best': self.best,
+            'avg': self.mean if self.received else None,
+            'worst': self.worst,
+            'stddev': self.stddev(),
+            'jitter': self.jitter,
+            'jitter_avg': self.jitter_mean if self.received > 1 else None,
+            'jitter_worst': self.jitter_worst,
+        }
+
+
+class ContinuousTrace:
+    '''
+        Repeatedly probes every hop on the path to a target, like mtr does,
+        keeping running statistics for each hop. The path is first discovered
+        with a parallel trace, after that one probe is sent to every hop each
+        "interval" seconds. If the target replies at a lower TTL than before
+        the path is shortened, if the last hop stops being the target the path
+        is extended by a hop.
+    '''
+
+    INTERVAL = 1          # Seconds, time between probing every hop
+
+    def __init__(self, tracer, ip_address, protocol='icmp', port=-1,
+                 interval=None):
+        self.tracer = tracer
+        self.ip_address = ip_address
+        self.target_ip = str(ip_address)
+        self.protocol = protocol
+        self.port = tracer.check_protocol(protocol, port)
+        self.interval = self.INTERVAL if interval is None else interval
+        if self.interval <= 0:
+            raise MTRError(f'Interval must be more than 0, '
+                           f'got: {self.interval}')
+        self.hops = []
+        self.rounds = 0
+        self.looper = None
+        # Encoded send-probe requests up to the TTL by timeout, only the
+        # timeout and TTL differ between the probes of a continuous trace
+        self.templates = {}
+
+    def start(self):
+        '''
+            Discovers the path to the target then starts probing it.
+        '''
+        if self.looper is not None:
+            raise MTRError('Continuous trace is already running')
+        self.looper = task.LoopingCall(self.probe_hops)
+        self.looper.clock = reactor
+        self.tracer.trace(self._got_path, self._got_path_error,
+                          self.ip_address, protocol=self.protocol,
+                          port=self.port, mode='parallel')
+
+    def stop(self):
+        '''
+            Stops probing, the statistics are kept.
+        '''
+        if self.looper is not None:
+            if self.looper.running:
+                self.looper.stop()
+            self.looper = None
+
+    def _got_path(self, ts, target_ip, protocol, port, hops):
+        if self.looper is None:
+            # Stopped before the path was discovered
+            return
+        self.hops = [HopStats(hop_num) for hop_num, _, _ in hops]
+        for stats, (hop_num, hop_ip, rtt) in zip(self.hops, hops):
+            stats.sent += 1
+            if hop_ip is not None:
+                stats.add(hop_ip, rtt)
+        log.debug(f'Discovered {len(self.hops)} hop path to {target_ip}, '
+                  f'probing every {self.interval} seconds')
+        self.looper.start(self.interval, now=False)
+
+    def _got_path_error(self, c, request, error, extra):
+        log.error(f'Failed to discover path to {self.ip_address}: {error}')
+        self.stop()
+
+    def probe_hops(self):
+        '''
+            Sends one probe to every hop on the path.
+        '''
+        self.rounds += 1
+        for stats in self.hops:
+            timeout, wait = self.tracer.probe_timeout(self.target_ip,
+                                                      stats.hop_num)
+            template = self.templates.get(timeout)
+            if template is None:
+                template = self.tracer.probe_template(
+                    self.ip_address, self.protocol, self.port, timeout)
+                self.templates[timeout] = template
+            self.tracer.mtr_request(self._got_probe, self._got_probe_error,
+                                    template + b'%d' % stats.hop_num, stats,
+                                    wait)
+
+    def _got_probe(self, c, request, line, stats):
+        stats.sent += 1
+        if not line:
+            return
+        response_type = line[0]
+        if response_type not in ('ttl-expired', 'reply'):
+            # no-reply and errors count as lost probes
+            return
+        stats.add(line[2], int(line[4]))
+        hop_num, num_hops = stats.hop_num, len(self.hops)
+        if num_hops < hop_num or self.hops[hop_num - 1] is not stats:
+            # The hop was removed from the path while the probe was in flight
+            return
+        if response_type == 'reply' and hop_num < num_hops:
+            # The path got shorter, stop probing hops past the target
+            del self.hops[hop_num:]
+        elif (response_type == 'ttl-expired' and hop_num == num_hops and
+                hop_num < self.tracer.MAX_TTL):
+            # The path got longer, start probing the next hop too
+            self.hops.append(HopStats(hop_num + 1))
+
+    def _got_probe_error(self, c, request, error, stats):
+        # Timeouts count as lost probes
+        stats.sent += 1
+
+    def snapshot(self):
+        '''
+            Returns a list of dicts of the statistics of every hop on the
+            path.
+        '''
+        return [stats.snapshot() for stats in self.hops]
+
+    def report(self):
+        '''
+            Returns the statistics as text in the style of "mtr --report",
+            times are in milliseconds.
+        '''
+
+        def _ms(us):
+            return '' if us is None else f'{us / 1000:.1f}'
+
+        lines = [f'{"":4} {"Host":<40} {"Loss%":>6} {"Snt":>5} {"Last":>7} '
+                 f'{"Avg":>7} {"Best":>7} {"Wrst":>7} {"StDev":>7}']
+        for hop in self.snapshot():
+            host = hop['hop_ip'] or '???'
+            lines.append(f'{hop["hop_num"]:>3}. {host:<40} '
+                         f'{hop["loss"]:>5.1f}% {hop["sent"]:>5} '
+                         f'{_ms(hop["last"]):>7} {_ms(hop["avg"]):>7} '
+                         f'{_ms(hop["best"]):>7} {_ms(hop["worst"]):>7} '
+                         f'{_ms(hop["stddev"]):>7}')
+        return '\n'.join(lines)
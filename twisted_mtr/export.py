@@ -0,0 +1,303 @@
+import sys
+import json
+import struct
+import logging
+from array import array
+from twisted.internet import defer, reactor, threads
+from .logger import get_logger
+from .errors import MTRError
+from .store import PROTOCOLS
+
+
+log = get_logger('export', level=logging.INFO)
+
+
+# Columns of the flattened hop rows of a TraceBatch as (name, array
+# typecode). "trace" numbers each exported trace, "target" and "hop_ip" are
+# indexes into the strings of the batch, "protocol" is an index into
+# PROTOCOLS and "rtt" is -1 for hops which did not reply
+COLUMNS = (('trace', 'Q'), ('ts', 'd'), ('target', 'I'), ('protocol', 'B'),
+           ('port', 'i'), ('ttl', 'B'), ('hop_ip', 'I'), ('rtt', 'i'))
+# Batch header: magic, format version, row count, length of the strings
+BATCH_HEADER = struct.Struct('<4sBII')
+BATCH_MAGIC = b'MTRB'
+BATCH_VERSION = 1
+
+
+class TraceBatch:
+    '''
+        A batch of completed traces stored as columns of flattened hop rows,
+        one row for each hop of each trace, in typed arrays. Target and hop
+        IPs are dictionary encoded as indexes into "strings", where index 0
+        is the empty string for hops which did not reply. Traces with no hops
+        have no rows.
+    '''
+
+    def __init__(self, strings=None, columns=None):
+        self.strings = [''] if strings is None else strings
+        self.string_index = {string: i for i, string in
+                             enumerate(self.strings)}
+        if columns is None:
+            columns = {name: array(typecode) for name, typecode in COLUMNS}
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns['trace'])
+
+    def intern(self, string):
+        i = self.string_index.get(string)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(string)
+            self.string_index[string] = i
+        return i
+
+    def add(self, trace, ts, target_ip, protocol, port, hops):
+        '''
+            Appends a row for each hop of a trace numbered "trace".
+        '''
+        if not hops:
+            return
+        columns = self.columns
+        hop_nums, hop_ips, rtts = zip(*hops)
+        count = len(hop_nums)
+        # Columns with the same value for every hop are extended with a
+        # repeated array, which is copied without iterating
+        for name, typecode, value in (
+                ('trace', 'Q', trace), ('ts', 'd', ts),
+                ('target', 'I', self.intern(str(target_ip))),
+                ('protocol', 'B', PROTOCOLS.index(protocol)),
+                ('port', 'i', port)):
+            columns[name].extend(array(typecode, (value,)) * count)
+        columns['ttl'].extend(hop_nums)
+        string_index = self.string_index
+        columns['hop_ip'].extend([
+            0 if hop_ip is None else
+            string_index.get(hop_ip) or self.intern(hop_ip)
+            for hop_ip in hop_ips])
+        columns['rtt'].extend([-1 if rtt is None else rtt for rtt in rtts])
+
+    def traces(self):
+        '''
+            Yields each trace in the batch as a (ts, target_ip, protocol,
+            port, hops) tuple, with target_ip as a string and hops as a list
+            of (hop_num, hop_ip, rtt) tuples.
+        '''
+        columns = self.columns
+        strings = self.strings
+        trace = None
+        hops = []
+        for i in range(len(self)):
+            if columns['trace'][i] != trace:
+                if hops:
+                    yield (ts, target_ip, protocol, port, hops)
+                trace = columns['trace'][i]
+                ts = columns['ts'][i]
+                target_ip = strings[columns['target'][i]]
+                protocol = PROTOCOLS[columns['protocol'][i]]
+                port = columns['port'][i]
+                hops = []
+            rtt = columns['rtt'][i]
+            hops.append((columns['ttl'][i],
+                         strings[columns['hop_ip'][i]] or None,
+                         None if rtt == -1 else rtt))
+        if hops:
+            yield (ts, target_ip, protocol, port, hops)
+
+    def encode(self):
+        '''
+            Returns the batch as bytes: a BATCH_HEADER, the strings joined by
+            newlines and encoded as UTF-8, then the raw little endian bytes
+            of each column in COLUMNS order.
+        '''
+        strings = '\n'.join(self.strings).encode()
+        parts = [BATCH_HEADER.pack(BATCH_MAGIC, BATCH_VERSION, len(self),
+                                   len(strings)), strings]
+        for name, typecode in COLUMNS:
+            column = self.columns[name]
+            if sys.byteorder == 'big':
+                column = array(typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        return b''.join(parts)
+
+
+def read_batches(path):
+    '''
+        Yields each TraceBatch written to a file by a ColumnarWriter.
+    '''
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(BATCH_HEADER.size)
+            if not header:
+                return
+            if len(header) < BATCH_HEADER.size:
+                raise MTRError(f'Truncated batch header in {path}')
+            magic, version, rows, strings_length = \
+                BATCH_HEADER.unpack(header)
+            if magic != BATCH_MAGIC or version != BATCH_VERSION:
+                raise MTRError(f'Unknown batch format in {path}: {magic} '
+                               f'version {version}')
+            strings = f.read(strings_length).decode().split('\n')
+            columns = {}
+            for name, typecode in COLUMNS:
+                column = array(typecode)
+                data = f.read(rows * column.itemsize)
+                if len(data) < rows * column.itemsize:
+                    raise MTRError(f'Truncated batch column {name} in '
+                                   f'{path}')
+                column.frombytes(data)
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                columns[name] = column
+            yield TraceBatch(strings, columns)
+
+
+class ColumnarWriter:
+    '''
+        Appends batches to a file in the columnar format of
+        TraceBatch.encode(). Columns are written as raw typed arrays so
+        writing costs about the same however many rows a batch has, and they
+        can be read back with read_batches() and handed straight to numpy or
+        Arrow without parsing each row.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+
+    def write(self, batch):
+        self.file.write(batch.encode())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NDJSONWriter:
+    '''
+        Appends batches to a file as newline delimited JSON, one object of
+        ts, target_ip, protocol, port and hops for each trace.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'at')
+
+    def write(self, batch):
+        lines = []
+        for ts, target_ip, protocol, port, hops in batch.traces():
+            lines.append(json.dumps({'ts': ts, 'target_ip': target_ip,
+                                     'protocol': protocol, 'port': port,
+                                     'hops': hops}))
+        if lines:
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TraceExporter:
+    '''
+        Buffers completed traces and writes them in bulk as a TraceBatch with
+        "writer", such as a ColumnarWriter or NDJSONWriter, once they have
+        "max_rows" hops or "max_delay" seconds after the first trace was
+        added, whichever comes first. add() takes the same arguments as the
+        success callback of TraceRoute.trace() so it can be used as one, it
+        only keeps a reference to the trace. Batches are built, encoded and
+        written in a thread, one at a time in order, so exporting never
+        blocks the reactor. Set "threaded" to False to write in the reactor
+        thread instead.
+    '''
+
+    MAX_ROWS = 65536      # Hop rows in a batch before it is written
+    MAX_DELAY = 5         # Seconds before a batch is written
+
+    def __init__(self, writer, max_rows=None, max_delay=None,
+                 threaded=True):
+        self.writer = writer
+        self.max_rows = self.MAX_ROWS if max_rows is None else max_rows
+        if not isinstance(self.max_rows, int) or self.max_rows < 1:
+            raise MTRError(f'max_rows must be an int of 1 or more, '
+                           f'got: {self.max_rows}')
+        self.max_delay = self.MAX_DELAY if max_delay is None else max_delay
+        self.threaded = threaded
+        # Completed traces waiting to be written as (trace, ts, target_ip,
+        # protocol, port, hops) tuples and their number of hops
+        self.pending = []
+        self.rows = 0
+        self.traces = 0
+        self.flush_call = None
+        # Fires when every batch handed to the writer has been written
+        self.writing = defer.succeed(None)
+        self.batches_written = 0
+        self.rows_written = 0
+
+    def add(self, ts, target_ip, protocol, port, hops):
+        '''
+            Adds a completed trace to the next batch.
+        '''
+        self.pending.append((self.traces, ts, target_ip, protocol, port,
+                             hops))
+        self.traces += 1
+        self.rows += len(hops)
+        if self.rows >= self.max_rows:
+            self.flush()
+        elif self.flush_call is None:
+            self.flush_call = reactor.callLater(self.max_delay, self.flush)
+
+    def flush(self):
+        '''
+            Hands the waiting traces to the writer. Returns a Deferred which
+            fires once they, and every batch before them, have been written.
+        '''
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+        pending, self.pending = self.pending, []
+        self.rows = 0
+        if pending:
+            self.writing.addCallback(self.write, pending)
+        return self.wait()
+
+    def write_batch(self, pending):
+        # Runs in the writer thread
+        batch = TraceBatch()
+        for trace in pending:
+            batch.add(*trace)
+        self.writer.write(batch)
+        return len(batch)
+
+    def write(self, _, pending):
+        if self.threaded:
+            d = threads.deferToThread(self.write_batch, pending)
+        else:
+            d = defer.maybeDeferred(self.write_batch, pending)
+
+        def _got_written(rows):
+            self.batches_written += 1
+            self.rows_written += rows
+
+        def _got_error(failure):
+            log.error(f'Failed to export batch of {len(pending)} traces: '
+                      f'{failure.getErrorMessage()}')
+
+        return d.addCallbacks(_got_written, _got_error)
+
+    def wait(self):
+        # A new Deferred chained to the writes so callers can't change the
+        # result the next write is chained to
+        d = defer.Deferred()
+        self.writing.addCallback(lambda _: d.callback(None))
+        return d
+
+    def close(self):
+        '''
+            Writes the waiting traces then closes the writer. Returns a
+            Deferred which fires once the writer is closed.
+        '''
+        d = self.flush()
+        d.addCallback(lambda _: self.writer.close())
+        return d
@@ -0,0 +1,184 @@
+import logging
+from bisect import bisect_left
+from time import time
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('metrics', level=logging.INFO)
+
+
+class Histogram:
+    '''
+        Counts observed values in fixed buckets. "buckets" is a sorted
+        sequence of inclusive upper bounds, values above the last bound are
+        only counted in the total.
+    '''
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        if list(self.buckets) != sorted(set(self.buckets)):
+            raise MTRError(f'Histogram buckets must be sorted and unique, '
+                           f'got: {buckets}')
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        '''
+            Returns a dict of the cumulative count for each bucket bound, the
+            sum and the count of observed values.
+        '''
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+    def prometheus(self, name, scale=1):
+        '''
+            Returns a list of Prometheus text exposition lines for the
+            histogram, with bounds and the sum multiplied by "scale".
+        '''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound * scale:g}"}} '
+                         f'{cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum {self.sum * scale:g}')
+        lines.append(f'{name}_count {self.count}')
+        return lines
+
+
+class Metrics:
+    '''
+        Counters and histograms for the probe engine. Pass an instance as the
+        "metrics" argument of TraceRoute or TraceRoutePool to collect them,
+        one instance can be shared by any number of TraceRoute instances.
+        With no metrics set TraceRoute skips collecting them entirely.
+    '''
+
+    # Microseconds, bounds of the probe RTT histogram
+    RTT_BUCKETS = (1000, 5000, 10000, 25000, 50000, 100000, 250000, 500000,
+                   1000000, 2500000, 5000000)
+    # Seconds, bounds of the request write to response parse histogram
+    LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                       2.5, 5, 10)
+    PREFIX = 'twisted_mtr'  # Prefix of Prometheus metric names
+
+    def __init__(self, rtt_buckets=None, latency_buckets=None, prefix=None):
+        self.rtt = Histogram(self.RTT_BUCKETS if rtt_buckets is None
+                             else rtt_buckets)
+        self.latency = Histogram(self.LATENCY_BUCKETS
+                                 if latency_buckets is None
+                                 else latency_buckets)
+        self.prefix = self.PREFIX if prefix is None else prefix
+        self.in_flight = 0
+        self.probes_sent = 0
+        self.responses = {}
+        self.timeouts = 0
+        self.retries = 0
+        self.last_snapshot = (time(), 0)
+
+    def sent(self):
+        self.in_flight += 1
+        self.probes_sent += 1
+
+    def received(self, response_type, rtt, latency):
+        '''
+            Records a response of "response_type" parsed "latency" seconds
+            after its request was written. "rtt" is the round trip time
+            reported by mtr-packet in microseconds or None.
+        '''
+        self.in_flight -= 1
+        self.responses[response_type] = \
+            self.responses.get(response_type, 0) + 1
+        self.latency.observe(latency)
+        if rtt is not None:
+            self.rtt.observe(rtt)
+
+    def retried(self):
+        # A request resent after probes-exhausted or a trace probe resent
+        # after it timed out
+        self.retries += 1
+
+    def timed_out(self):
+        self.in_flight -= 1
+        self.timeouts += 1
+
+    def abandoned(self, count):
+        # Requests lost when mtr-packet was reconnected
+        self.in_flight -= count
+
+    def snapshot(self):
+        '''
+            Returns a dict of the current value of every metric. Probes sent
+            per second is averaged since the previous snapshot.
+        '''
+        now = time()
+        last_ts, last_sent = self.last_snapshot
+        self.last_snapshot = (now, self.probes_sent)
+        elapsed = now - last_ts
+        rate = (self.probes_sent - last_sent) / elapsed if elapsed > 0 else 0
+        return {
+            'in_flight': self.in_flight,
+            'probes_sent': self.probes_sent,
+            'probes_per_second': rate,
+            'responses': dict(self.responses),
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'rtt': self.rtt.snapshot(),
+            'latency': self.latency.snapshot(),
+        }
+
+    def prometheus(self):
+        '''
+            Returns the metrics in the Prometheus text exposition format. RTTs
+            and latencies are exposed in seconds.
+        '''
+        p = self.prefix
+        lines = [
+            f'# HELP {p}_in_flight Requests written to mtr-packet awaiting '
+            f'a response.',
+            f'# TYPE {p}_in_flight gauge',
+            f'{p}_in_flight {self.in_flight}',
+            f'# HELP {p}_probes_sent_total Requests written to mtr-packet.',
+            f'# TYPE {p}_probes_sent_total counter',
+            f'{p}_probes_sent_total {self.probes_sent}',
+            f'# HELP {p}_responses_total Responses from mtr-packet by type.',
+            f'# TYPE {p}_responses_total counter',
+        ]
+        for response_type, count in sorted(self.responses.items()):
+            lines.append(f'{p}_responses_total{{type="{response_type}"}} '
+                         f'{count}')
+        lines += [
+            f'# HELP {p}_timeouts_total Requests mtr-packet never answered.',
+            f'# TYPE {p}_timeouts_total counter',
+            f'{p}_timeouts_total {self.timeouts}',
+            f'# HELP {p}_retries_total Requests retried after '
+            f'probes-exhausted or a timeout.',
+            f'# TYPE {p}_retries_total counter',
+            f'{p}_retries_total {self.retries}',
+            f'# HELP {p}_rtt_seconds Probe round trip times.',
+            f'# TYPE {p}_rtt_seconds histogram',
+        ]
+        lines += self.rtt.prometheus(f'{p}_rtt_seconds', scale=1e-6)
+        lines += [
+            f'# HELP {p}_response_latency_seconds Time from writing a '
+            f'request to parsing its response.',
+            f'# TYPE {p}_response_latency_seconds histogram',
+        ]
+        lines += self.latency.prometheus(f'{p}_response_latency_seconds')
+        return '\n'.join(lines) + '\n'
@@ -1,8 +1,16 @@
 import logging
+from collections import deque
 from time import time
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, task
+from twisted.internet.error import ProcessDone
+from twisted.python.failure import Failure
 from .logger import get_logger
 from .errors import MTRError
+from .bulk import TraceMany
+from .continuous import ContinuousTrace
+from .multipath import MultipathTrace
+from .timeouts import TimeoutWheel
+from .results import AddressTable, TraceResult
 
 
 log = get_logger('mtr', level=logging.INFO)
@@ -15,13 +23,80 @@ class TraceRoute(protocol.ProcessProtocol):
     RETRY_WAIT = 3        # Seconds, time to wait before retrying requests
     MAX_TTL = 50          # Maximum TTL, this also sets as max route hops
     NO_REPLY_MAX_TTL = 5  # Maximum number of hops to try after a no-reply
+    PARALLEL_WINDOW = 10  # Default number of TTLs probed at once in parallel
+    MAX_LINE_LENGTH = 4096  # Bytes, longest partial response line buffered
+    INITIAL_INFLIGHT = 64  # Starting number of requests allowed in flight
+    MIN_INFLIGHT = 1      # Smallest the in flight window can shrink to
+    MAX_INFLIGHT = 1024   # Largest the in flight window can grow to
+    WRITE_BUFFER_SIZE = 65536  # Bytes, requests buffered before a write
+    RESPAWN_DELAY = 1     # Seconds, wait before the first respawn attempt
+    MAX_RESPAWN_DELAY = 60  # Seconds, longest wait between respawn attempts
+    MAX_RESPAWNS = 5      # Respawns in a row without a passing health check
+    HEALTH_CHECK_INTERVAL = 30  # Seconds, time between check-support requests
+    ADDRESS_TABLE_SIZE = 65536  # Addresses interned by compact results
     # NOTE: WAIT_TIMEOUT must be greater than REQUEST_TIMEOUT
     # NOTE: (REQUEST_TIMEOUT * NO_REPLY_MAX_TTL) should be LESS than 60
 
-    def __init__(self, mtr_binary_path=None, local_ipv4=None, local_ipv6=None):
+    def __init__(self, mtr_binary_path=None, local_ipv4=None, local_ipv6=None,
+                 timeout_manager=None, cache=None, coalesce=True,
+                 stop_set=None, rtt_estimator=None, compact=False,
+                 metrics=None, coalesce_writes=True, respawn=False,
+                 health_check_interval=None, rate_limiter=None):
         self.request_counter = 0
         self.requests = {}
+        self.queue = deque()
+        self.retries = deque()
+        self.inflight_window = self.INITIAL_INFLIGHT
+        self.slow_start = True
+        self.decrease_mark = 0
+        self.buffer = b''
+        self.coalesce_writes = coalesce_writes
+        self.write_buffer = []
+        self.write_size = 0
+        # Counters of the buffered request lines, only kept when collecting
+        # metrics so they are timed from when they are written
+        self.write_counters = []
+        self.flush_call = None
+        self.paused = False
+        self.rate_limiter = rate_limiter
+        self.rate_call = None
+        self.rtt_estimator = rtt_estimator
+        # Time to wait for mtr-packet to respond after its own timeout
+        self.wait_margin = self.WAIT_TIMEOUT - self.REQUEST_TIMEOUT
+        max_wait = self.WAIT_TIMEOUT
+        if rtt_estimator is not None:
+            max_wait = max(max_wait, rtt_estimator.ceiling + self.wait_margin)
+        if timeout_manager is None:
+            timeout_manager = TimeoutWheel
+        self.timeouts = timeout_manager(max_wait, self.check_timeout)
+        self.cache = cache
+        self.coalesce = coalesce
+        self.traces = {}
+        self.stop_set = stop_set
+        self.compact = compact
+        # Hop addresses of compact results, a new table is started once it
+        # has ADDRESS_TABLE_SIZE addresses so it can't grow without limit
+        self.address_table = AddressTable(self.ADDRESS_TABLE_SIZE)
+        self.metrics = metrics
+        # Maps request counters to the time they were written, or None while
+        # they are buffered, only kept when collecting metrics
+        self.sent_at = {}
         self.mtr_binary_path = mtr_binary_path
+        # mtr-packet can only be respawned if we know where it is
+        self.respawn = respawn and bool(mtr_binary_path)
+        self.health_check_interval = (self.HEALTH_CHECK_INTERVAL
+                                      if health_check_interval is None
+                                      else health_check_interval)
+        self.health_check = None
+        # Counter of the check-support request in flight, health checks are
+        # sent outside of the in flight window and rate limiter
+        self.health_request = None
+        self.health_timeout = None
+        self.respawn_delay = self.RESPAWN_DELAY
+        self.respawns = 0
+        self.respawn_call = None
+        self.respawning = False
+        self.stopping = False
         self.local_ipv4 = local_ipv4
         self.local_ipv6 = local_ipv6
         if not self.local_ipv4 and not self.local_ipv6:
@@ -31,6 +106,23 @@ class TraceRoute(protocol.ProcessProtocol):
     def reset(self):
         self.request_counter = 0
         self.requests = {}
+        self.queue = deque()
+        self.retries = deque()
+        self.inflight_window = self.INITIAL_INFLIGHT
+        self.slow_start = True
+        self.decrease_mark = 0
+        self.buffer = b''
+        self.write_buffer = []
+        self.write_size = 0
+        self.write_counters = []
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        self.paused = False
+        self.timeouts.clear()
+        if self.metrics is not None:
+            self.metrics.abandoned(len(self.sent_at))
+        self.sent_at = {}
 
     def inc_counter(self):
         self.request_counter += 1
@@ -43,13 +135,221 @@ class TraceRoute(protocol.ProcessProtocol):
                                f'request with id 0 is still outstanding. '
                                f'This is a bug, please report it.')
             self.request_counter = 0
+            self.decrease_mark = 0
+
+    def window_size(self):
+        '''
+            Returns the number of requests currently allowed in flight.
+        '''
+        return int(self.inflight_window)
+
+    def queue_length(self):
+        '''
+            Returns the number of requests waiting for room in the window.
+        '''
+        return len(self.retries) + len(self.queue)
+
+    def outstanding(self):
+        '''
+            Returns the number of requests either in flight or queued.
+        '''
+        return len(self.requests) + len(self.retries) + len(self.queue)
+
+    def increase_window(self):
+        # Slow start until the first decrease, the window grows by one for
+        # every answered request and so doubles for every window's worth.
+        # After that additive increase, the window grows by one for every
+        # window's worth of answered requests
+        if self.slow_start:
+            increase = 1
+        else:
+            increase = 1 / self.inflight_window
+        self.inflight_window = min(self.inflight_window + increase,
+                                   self.MAX_INFLIGHT)
+
+    def decrease_window(self, c):
+        # Multiplicative decrease, only requests sent after the last decrease
+        # shrink the window again so a burst of failures for requests that
+        # were all in flight at the same time only halves it once
+        if c < self.decrease_mark:
+            return
+        self.inflight_window = max(self.inflight_window / 2,
+                                   self.MIN_INFLIGHT)
+        self.slow_start = False
+        self.decrease_mark = self.request_counter
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'Decreased in flight window to {self.window_size()}')
 
     def connectionMade(self, *a, **k):
-        self.reset()
+        if self.respawning:
+            # Keep the requests replayed from the previous mtr-packet process
+            self.respawning = False
+            self.buffer = b''
+            self.paused = False
+        else:
+            self.reset()
+        # Register as a producer for the stdin of mtr-packet so requests stop
+        # being sent when the pipe is full rather than building up in the
+        # transport buffer
+        register_producer = getattr(self.transport, 'registerProducer', None)
+        if register_producer is not None:
+            register_producer(self, True)
         log.debug(f'Connected to subprocess of: {self.mtr_binary_path}')
+        if self.respawn and self.health_check_interval:
+            self.health_check = task.LoopingCall(self.check_health)
+            self.health_check.clock = reactor
+            self.health_check.start(self.health_check_interval, now=True)
+        self.send_queued()
+
+    def spawn(self):
+        '''
+            Spawns an mtr-packet process from mtr_binary_path attached to
+            this protocol.
+        '''
+        if not self.mtr_binary_path:
+            raise MTRError('mtr_binary_path must be set to spawn mtr-packet')
+        self.stopping = False
+        reactor.spawnProcess(self, self.mtr_binary_path,
+                             [self.mtr_binary_path], {})
+
+    def stop(self):
+        '''
+            Closes the connection to mtr-packet, which causes it to exit,
+            without respawning it.
+        '''
+        self.stopping = True
+        self.stop_health_check()
+        if self.respawn_call is not None and self.respawn_call.active():
+            self.respawn_call.cancel()
+        self.respawn_call = None
+        if self.transport:
+            self.transport.loseConnection()
+
+    def check_health(self):
+        '''
+            Sends a check-support request to mtr-packet. If it is not
+            answered within WAIT_TIMEOUT seconds mtr-packet is assumed to be
+            hung and is killed, which respawns it. The request is written
+            straight away, it does not use a slot of the in flight window or
+            a token from the rate limiter.
+        '''
+        if self.health_request is not None:
+            # The last health check is still waiting for an answer
+            return
+        c = self.request_counter
+        self.inc_counter()
+        self.health_request = c
+        self.health_timeout = reactor.callLater(self.WAIT_TIMEOUT,
+                                                self.health_check_failed)
+        self.transport.write(b'%d check-support feature send-probe\n' % c)
+
+    def got_health_check(self, line):
+        self.health_request = None
+        if self.health_timeout is not None and self.health_timeout.active():
+            self.health_timeout.cancel()
+        self.health_timeout = None
+        if line[-1:] == ['ok']:
+            # mtr-packet is working, start respawn backoff again
+            self.respawn_delay = self.RESPAWN_DELAY
+            self.respawns = 0
+        else:
+            log.error(f'Unexpected health check response: {line}')
+
+    def health_check_failed(self):
+        self.health_request = None
+        self.health_timeout = None
+        log.error(f'mtr-packet did not answer a health check within '
+                  f'{self.WAIT_TIMEOUT} seconds, killing it')
+        try:
+            self.transport.signalProcess('KILL')
+        except Exception as e:
+            log.error(f'Failed to kill mtr-packet: {e}')
+
+    def stop_health_check(self):
+        if self.health_check is not None and self.health_check.running:
+            self.health_check.stop()
+        self.health_check = None
+        if self.health_timeout is not None and self.health_timeout.active():
+            self.health_timeout.cancel()
+        self.health_timeout = None
+        self.health_request = None
+
+    def replay_requests(self):
+        '''
+            Moves every request in flight to the front of the retry queue, in
+            the order they were sent, to be sent again under new counters to
+            a new mtr-packet process. The callbacks and state of each request
+            are kept so traces carry on where they were.
+        '''
+        replay = list(self.requests.values())
+        self.retries.extendleft(reversed(replay))
+        self.requests = {}
+        self.timeouts.clear()
+        if self.metrics is not None:
+            self.metrics.abandoned(len(self.sent_at))
+        self.sent_at = {}
+        self.write_buffer = []
+        self.write_size = 0
+        self.write_counters = []
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        # Hold requests until the new process is connected
+        self.paused = True
+        log.debug(f'Replaying {len(replay)} MTR requests')
+
+    def pauseProducing(self):
+        '''
+            Called by the transport when the stdin pipe of mtr-packet is
+            full. Queued requests are held until resumeProducing() is called.
+        '''
+        self.paused = True
+        log.debug('Paused sending MTR requests')
+
+    def resumeProducing(self):
+        '''
+            Called by the transport when the stdin pipe of mtr-packet has
+            drained, sends held requests.
+        '''
+        self.paused = False
+        log.debug('Resumed sending MTR requests')
+        self.send_queued()
+
+    def stopProducing(self):
+        self.paused = True
 
     def outReceived(self, data):
-        self.got_mtr_line(data.decode().split())
+        '''
+            Called with chunks of output from mtr-packet. A chunk may contain
+            any number of response lines and the last line may be split across
+            chunks, so incomplete lines are carried over in a buffer until the
+            rest of the line arrives. All complete lines in a chunk are decoded
+            in a single batch.
+        '''
+        end = data.rfind(b'\n')
+        if end == -1:
+            # No complete line in this chunk, buffer it all
+            self.buffer += data
+            self.check_buffer()
+            return
+        if self.buffer:
+            data = self.buffer + data
+            end += len(self.buffer)
+        self.buffer = data[end + 1:]
+        # The incomplete line left after the last line ending is limited too
+        self.check_buffer()
+        for line in data[:end].decode().splitlines():
+            parts = line.split()
+            if parts:
+                self.got_mtr_line(parts)
+
+    def check_buffer(self):
+        # Discard a partial line longer than MAX_LINE_LENGTH so output with
+        # no line endings can't grow the buffer without limit
+        if len(self.buffer) > self.MAX_LINE_LENGTH:
+            log.error(f'Discarding {len(self.buffer)} bytes of MTR output '
+                      f'with no line ending')
+            self.buffer = b''
 
     def errReceived(self, data):
         log.error(f'Recieved error from process: {data}')
@@ -68,6 +368,38 @@ class TraceRoute(protocol.ProcessProtocol):
 
     def processEnded(self, reason):
         log.debug(f'Child processed ended, reason: {reason}')
+        self.stop_health_check()
+        if self.stopping or not self.respawn:
+            return
+        if isinstance(reason, Failure) and reason.check(ProcessDone):
+            # mtr-packet exited cleanly, such as when its stdin was closed,
+            # only crashes, kills and failures to spawn are respawned
+            log.debug('mtr-packet exited cleanly, not respawning it')
+            return
+        if self.respawns >= self.MAX_RESPAWNS:
+            log.error(f'mtr-packet exited unexpectedly {self.respawns} times '
+                      f'in a row, giving up respawning it')
+            return
+        # mtr-packet died, respawn it with exponential backoff and send the
+        # requests it never answered again
+        self.respawns += 1
+        self.replay_requests()
+        delay = self.respawn_delay
+        self.respawn_delay = min(self.respawn_delay * 2,
+                                 self.MAX_RESPAWN_DELAY)
+        log.error(f'mtr-packet exited unexpectedly, respawning it in '
+                  f'{delay} seconds')
+        self.respawning = True
+        self.respawn_call = reactor.callLater(delay, self.restart)
+
+    def restart(self):
+        self.respawn_call = None
+        try:
+            self.spawn()
+        except Exception as e:
+            # Spawning failed outright, try again after a longer wait
+            log.error(f'Failed to respawn mtr-packet: {e}')
+            self.processEnded(e)
 
     def send_mtr_line(self, line=[]):
         log.debug(f'Writing MTR command: {line}')
@@ -77,76 +409,192 @@ class TraceRoute(protocol.ProcessProtocol):
         '''
             Called when a line is recieved from MTR. The first part of the line
             is the request counter. If the counter is for an expected request
-            cancel the timeout check and call the requests callback, otherwise
+            cancel the timeout and call the requests callback, otherwise
             log the line as an unexpected response
         '''
         if len(line) == 0:
             log.error('Recieved MTR response with no content')
+            return
         try:
             c = int(line[0])
         except (ValueError, TypeError) as e:
             log.error(f'Failed to parse first part of MTR reponse as a '
                       f'counter: {line} ({e})')
             return
+        if c == self.health_request:
+            self.got_health_check(line[1:])
+            return
         if c not in self.requests:
             log.error(f'Recieved MTR response for an unknown request: {line}')
             return
-        callback, errback, timeout_check, request, extra = self.requests[c]
-        del self.requests[c]
-        timeout_check.cancel()
-        log.debug(f'{len(self.requests)} requests expected')
-        joined_request = ' '.join(request[1:])
-        joined_response = ' '.join(line[1:])
-        log.debug(f'Recieved MTR response for "{c} {joined_request}" '
-                  f'-> "{c} {joined_response}"')
+        queued = self.requests.pop(c)
+        callback, errback, request, extra, wait = queued
+        self.timeouts.cancel(c)
+        if self.metrics is not None:
+            self.record_response(c, line)
+        if len(line) > 1 and line[1] == 'probes-exhausted':
+            # mtr-packet has too many probes in flight, shrink the window and
+            # queue the request to be retried ahead of new requests
+            self.decrease_window(c)
+            self.retries.append(queued)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f'Requeued MTR request {c} after '
+                          f'probes-exhausted')
+            if not self.requests:
+                # Nothing in flight to make room for the request, try again
+                # after a short wait
+                reactor.callLater(self.RETRY_WAIT, self.send_queued)
+            return
+        self.increase_window()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'{len(self.requests)} requests expected')
+            joined_request = self.format_request(request)
+            joined_response = ' '.join(line[1:])
+            log.debug(f'Recieved MTR response for "{c} {joined_request}" '
+                      f'-> "{c} {joined_response}"')
+        self.send_queued()
         callback(c, request, line[1:], extra)
 
     def check_timeout(self, c):
         '''
-            Fired after TIMEOUT seconds to verify a response has been recieved
-            for an MTR request. If a response has not been recieved log it and
-            cancel the request.
+            Fired by the timeout manager WAIT_TIMEOUT seconds, or the wait
+            passed to mtr_request(), after an MTR request was made if no
+            response has been recieved. Log it and cancel the request.
         '''
         if c not in self.requests:
             log.error(f'Timeout check fired for a request which no '
                       f'longer exists: {c}')
             return
-        callback, errback, timeout_check, request, extra = self.requests[c]
-        del self.requests[c]
-        joined_request = ' '.join(request[1:])
-        log.debug(f'MTR request "{c} {joined_request}" timed out '
-                  f'after {self.WAIT_TIMEOUT} seconds')
+        callback, errback, request, extra, wait = self.requests.pop(c)
+        if self.metrics is not None:
+            self.sent_at.pop(c, None)
+            self.metrics.timed_out()
+        self.decrease_window(c)
+        if log.isEnabledFor(logging.DEBUG):
+            joined_request = self.format_request(request)
+            log.debug(f'MTR request "{c} {joined_request}" timed out '
+                      f'after {wait or self.WAIT_TIMEOUT} seconds')
+        self.send_queued()
         errback(c, request, 'timeout', extra)
 
-    def mtr_request(self, callback, errback, request, extra):
+    def record_response(self, c, line):
+        # Collect metrics for a response line to request c
+        sent_at = self.sent_at.pop(c, None)
+        latency = 0 if sent_at is None else time() - sent_at
+        response_type = line[1] if len(line) > 1 else 'unknown'
+        rtt = None
+        if len(line) > 5 and line[4] == 'round-trip-time':
+            try:
+                rtt = int(line[5])
+            except ValueError:
+                pass
+        self.metrics.received(response_type, rtt, latency)
+        if response_type == 'probes-exhausted':
+            self.metrics.retried()
+
+    def mtr_request(self, callback, errback, request, extra, wait=None):
         '''
-            Makes a a request to MTR. This writes the line to the stdin of the
-            mtr-packet process with a counter for the line, then waits to see
-            if a response line is received within the timeout window. "extra"
-            is an arbitrary value to pass on to the callbacks if additional
-            state information is required.
+            Makes a request to MTR. The request is queued and sent once there
+            is room in the in flight window. "request" is either a list of
+            strings or the bytes of a request line without the counter and
+            trailing new line, as made by probe_request(). "extra" is an
+            arbitrary value to pass on to the callbacks if additional state
+            information is required. "wait" is the number of seconds to wait
+            for a response before timing out, defaulting to WAIT_TIMEOUT.
         '''
-        joined_request = ' '.join(request)
-        c = self.request_counter
-        self.inc_counter()
-        self.requests[c] = (
-            callback,
-            errback,
-            reactor.callLater(self.WAIT_TIMEOUT, self.check_timeout, c),
-            request,
-            extra
-        )
-        line = f'{c} {joined_request}\n'
-        log.debug(f'Sending MTR request "{line.strip()}"')
-        self.transport.write(line.encode())
+        self.queue.append((callback, errback, request, extra, wait))
+        self.send_queued()
 
-    def trace(self, callback, errback, ip_address, protocol='icmp', port=-1,
-              ttl=1, extra=None):
+    def send_queued(self):
         '''
-            A higher level method that chains send-probe requests with
-            increasing TTLs until an error is recieved or the responding IP is
-            that of the target IP. Note that unlike lower level methods
-            ip_address here is an IPAddress object not a string.
+            Sends queued requests in order, retries first, for as long as
+            there is room in the in flight window and the transport is not
+            paused. This writes each line to the stdin of the mtr-packet
+            process with a counter for the line, then waits to see if a
+            response line is received within the timeout window. If
+            "coalesce_writes" is set lines are buffered and written at once
+            at the end of the reactor iteration or when WRITE_BUFFER_SIZE
+            bytes are buffered. If a rate limiter is set each request uses a
+            token from it and requests wait in the queue until one is free.
+        '''
+        while (len(self.requests) < self.inflight_window and
+               not self.paused):
+            if not self.retries and not self.queue:
+                break
+            if self.rate_limiter is not None and not self.rate_limiter.take():
+                # Out of tokens, carry on once the next one is available
+                if self.rate_call is None:
+                    self.rate_call = reactor.callLater(
+                        self.rate_limiter.delay(), self.tokens_available)
+                break
+            if self.retries:
+                queued = self.retries.popleft()
+            else:
+                queued = self.queue.popleft()
+            request, wait = queued[2], queued[4]
+            if not isinstance(request, bytes):
+                request = ' '.join(request).encode()
+            c = self.request_counter
+            self.inc_counter()
+            self.requests[c] = queued
+            self.timeouts.schedule(c, wait)
+            line = b'%d %b\n' % (c, request)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f'Sending MTR request "{line.decode().strip()}"')
+            if self.metrics is not None:
+                self.metrics.sent()
+            if self.coalesce_writes:
+                if self.metrics is not None:
+                    self.sent_at[c] = None
+                    self.write_counters.append(c)
+                self.write_buffer.append(line)
+                self.write_size += len(line)
+                if self.write_size >= self.WRITE_BUFFER_SIZE:
+                    self.flush_writes()
+            else:
+                self.transport.write(line)
+                if self.metrics is not None:
+                    self.sent_at[c] = time()
+        if self.write_buffer and self.flush_call is None:
+            self.flush_call = reactor.callLater(0, self.flush_writes)
+
+    def tokens_available(self):
+        self.rate_call = None
+        self.send_queued()
+
+    def flush_writes(self):
+        '''
+            Writes all buffered request lines to mtr-packet at once.
+        '''
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+        if not self.write_buffer:
+            return
+        data = b''.join(self.write_buffer)
+        self.write_buffer = []
+        self.write_size = 0
+        self.transport.write(data)
+        if self.write_counters:
+            # Time the requests from when they were actually written
+            self.sent_at.update(dict.fromkeys(self.write_counters, time()))
+            self.write_counters = []
+
+    def format_request(self, request):
+        '''
+            Returns a request, either bytes or a list of strings, as a string
+            for logging.
+        '''
+        if isinstance(request, bytes):
+            return request.decode()
+        return ' '.join(request)
+
+    @staticmethod
+    def check_protocol(protocol, port):
+        '''
+            Validates a protocol and port, returns the port as an int or -1
+            if the protocol does not use ports.
         '''
         if protocol not in ('icmp', 'tcp', 'udp'):
             raise MTRError(f'Protocol must be one of icmp, tcp or udp, '
@@ -163,153 +611,442 @@ class TraceRoute(protocol.ProcessProtocol):
                 raise MTRError(f'Port must be between 0-65535, got: {port}')
         else:
             port = -1
-        if not isinstance(ttl, int):
-            raise MTRError(f'TTL must be an int, got: {type(ttl)}')
-        hops = []
-        if ttl > 1:
-            # Pad the skipped hops with empty results
-            for i in range(1, ttl):
-                hops.append((i, None, None))
+        return port
+
+    def get_families(self, ip_address):
+        '''
+            Returns a (local_family, local_ip, target_family) tuple of the
+            send-probe arguments for the address family of ip_address.
+        '''
         if ip_address.version == 4:
             if not self.local_ipv4:
                 raise MTRError('Trace to an IPv4 address was requested but '
                                'no local IPv4 origin has been specified. Set '
                                'the local_ipv4 argument.')
-            local_family = 'local-ip-4'
-            local_ip = str(self.local_ipv4)
-            target_family = 'ip-4'
+            return 'local-ip-4', str(self.local_ipv4), 'ip-4'
         else:
             if not self.local_ipv6:
                 raise MTRError('Trace to an IPv6 address was requested but '
                                'no local IPv6 origin has been specified. Set '
                                'the local_ipv6 argument.')
-            local_family = 'local-ip-6'
-            local_ip = str(self.local_ipv6)
-            target_family = 'ip-6'
+            return 'local-ip-6', str(self.local_ipv6), 'ip-6'
+
+    def probe_timeout(self, target_ip, ttl):
+        '''
+            Returns a (timeout, wait) tuple of the timeout to pass to
+            mtr-packet for a probe to target_ip with a TTL and the number of
+            seconds to wait for a response, as passed to mtr_request().
+        '''
+        if self.rtt_estimator is None:
+            return self.REQUEST_TIMEOUT, None
+        timeout = self.rtt_estimator.timeout(target_ip, ttl)
+        return timeout, timeout + self.wait_margin
+
+    def probe_template(self, ip_address, protocol, port, timeout,
+                       extra_args=None):
+        '''
+            Returns the bytes of a send-probe request to ip_address up to and
+            including the "ttl" argument name. Only the TTL differs between
+            the probes of a trace, so a trace encodes this once and appends
+            the TTL to it for each probe. "extra_args" is an optional list of
+            additional send-probe argument names and values.
+        '''
+        local_family, local_ip, target_family = self.get_families(ip_address)
+        request = [
+            'send-probe',
+            local_family, local_ip,
+            target_family, str(ip_address),
+            'timeout', str(timeout),
+            'protocol', protocol
+        ]
+        if protocol in ('tcp', 'udp'):
+            request += ['port', str(port)]
+        if extra_args:
+            request += extra_args
+        request.append('ttl ')
+        return ' '.join(request).encode()
+
+    def probe_request(self, ip_address, protocol, port, ttl):
+        '''
+            Returns a (request, wait) tuple of the bytes of a send-probe
+            request to ip_address with a TTL and the number of seconds to
+            wait for a response, as passed to mtr_request().
+        '''
+        timeout, wait = self.probe_timeout(str(ip_address), ttl)
+        template = self.probe_template(ip_address, protocol, port, timeout)
+        return template + b'%d' % ttl, wait
+
+    def probe(self, callback, errback, ip_address, protocol='icmp', port=-1,
+              ttl=1, extra=None):
+        '''
+            Sends a single send-probe request to ip_address with a TTL. The
+            callbacks are called as for mtr_request(). Note that unlike
+            mtr_request() ip_address here is an IPAddress object.
+        '''
+        port = self.check_protocol(protocol, port)
+        request, wait = self.probe_request(ip_address, protocol, port, ttl)
+        self.mtr_request(callback, errback, request, extra, wait)
+
+    def compact_result(self, ts, ip_address, protocol, port, hops):
+        '''
+            Returns the hops of a completed trace as a TraceResult with its
+            addresses in the current address table.
+        '''
+        self.address_table = self.address_table.rotated()
+        return TraceResult.from_hops(ts, ip_address, protocol, port, hops,
+                                     self.address_table)
+
+    @classmethod
+    def check_trace(cls, ttl, mode, window):
+        '''
+            Validates the TTL, mode and window of a trace, returns the number
+            of TTLs to probe at once.
+        '''
+        if not isinstance(ttl, int):
+            raise MTRError(f'TTL must be an int, got: {type(ttl)}')
+        if not 1 <= ttl <= cls.MAX_TTL:
+            raise MTRError(f'TTL must be between 1-{cls.MAX_TTL}, '
+                           f'got: {ttl}')
+        if mode == 'sequential':
+            return 1
+        if mode == 'parallel':
+            if window is None:
+                window = cls.PARALLEL_WINDOW
+            if not isinstance(window, int) or window < 1:
+                raise MTRError(f'Window must be an int of 1 or more, '
+                               f'got: {window}')
+            return window
+        raise MTRError(f'Mode must be one of sequential or parallel, '
+                       f'got: {mode}')
+
+    def trace_key(self, ip_address, protocol, port, ttl, stop_hop=None,
+                  on_hop=None, keep_hops=True):
+        '''
+            Returns the key identical traces share while one is in flight,
+            "port" must already be checked with check_protocol().
+        '''
+        if stop_hop is None and on_hop is None and keep_hops:
+            return (ip_address, protocol, port, ttl)
+        # Traces which stop early or stream their hops are only identical to
+        # each other if they stop and stream in the same way
+        return (ip_address, protocol, port, ttl, stop_hop, on_hop, keep_hops)
+
+    def trace(self, callback, errback, ip_address, protocol='icmp', port=-1,
+              ttl=1, extra=None, mode='sequential', window=None,
+              stop_hop=None, on_hop=None, keep_hops=True):
+        '''
+            A higher level method that chains send-probe requests with
+            increasing TTLs until an error is recieved or the responding IP is
+            that of the target IP. Note that unlike lower level methods
+            ip_address here is an IPAddress object not a string. In the
+            default 'sequential' mode one TTL is probed at a time. In
+            'parallel' mode up to "window" TTLs are probed at once and the
+            replies are reassembled in hop order, the completed hops are
+            identical to those of a sequential trace. "stop_hop" is an
+            optional callable taking (hop_num, hop_ip), if it returns True
+            the trace completes at that hop. If a stop set is set and "ttl"
+            is 1 the trace is made with the Doubletree algorithm, see
+            StopSet.trace(). "on_hop" is an optional callable taking
+            (target_ip, hop_num, hop_ip, rtt) which is called for each hop in
+            order as soon as it is known. If "keep_hops" is False the hops are
+            not collected and the success callback is passed an empty list.
+        '''
+        port = self.check_protocol(protocol, port)
+        window = self.check_trace(ttl, mode, window)
+        hops = []
+        if ttl > 1 and keep_hops:
+            # Pad the skipped hops with empty results
+            for i in range(1, ttl):
+                hops.append((i, None, None))
+        # Raises an MTRError if there's no local IP for the target family
+        self.get_families(ip_address)
+        cache_key = (ip_address, protocol, port, ttl)
+        trace_key = self.trace_key(ip_address, protocol, port, ttl,
+                                   stop_hop, on_hop, keep_hops)
+        if self.cache is not None and stop_hop is None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                # A recent trace to the same target is cached, return its hops
+                # with the timestamp of when it was originally traced
+                cached_ts, cached_hops = cached
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f'Returning cached {protocol}:{port} trace to '
+                              f'{ip_address}')
+                if on_hop is not None:
+                    for hop_num, hop_ip, rtt in cached_hops[ttl - 1:]:
+                        on_hop(ip_address, hop_num, hop_ip, rtt)
+                if not keep_hops:
+                    cached_hops = []
+                elif not isinstance(cached_hops, TraceResult):
+                    cached_hops = list(cached_hops)
+                callback(cached_ts, ip_address, protocol, port, cached_hops)
+                return
+        # Callbacks to fire when the trace completes, identical traces started
+        # while this one is in flight subscribe to it rather than probing
+        subscribers = [(callback, errback)]
+        if self.coalesce:
+            in_flight = self.traces.get(trace_key)
+            if in_flight is not None:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug(f'Joining in flight {protocol}:{port} trace to '
+                              f'{ip_address}')
+                in_flight.append((callback, errback))
+                return
+            self.traces[trace_key] = subscribers
+
+        def _finished():
+            # Stop new identical traces subscribing to this one
+            if self.traces.get(trace_key) is subscribers:
+                del self.traces[trace_key]
+
+        if self.stop_set is not None and ttl == 1 and stop_hop is None:
+
+            def _got_doubletree_trace(ts, ip_address, protocol, port, hops):
+                _finished()
+                # Doubletree hops are only known in order once both the
+                # forward and backward probing is done
+                if on_hop is not None:
+                    for hop_num, hop_ip, rtt in hops:
+                        on_hop(ip_address, hop_num, hop_ip, rtt)
+                if not keep_hops:
+                    hops = []
+                else:
+                    if self.compact:
+                        hops = self.compact_result(ts, ip_address, protocol,
+                                                   port, hops)
+                    if self.cache is not None:
+                        self.cache.put(cache_key, ts, hops if self.compact
+                                       else tuple(hops))
+                for subscriber_callback, _ in subscribers:
+                    subscriber_callback(ts, ip_address, protocol, port, hops)
+
+            def _got_doubletree_error(c, request, error, extra):
+                _finished()
+                for _, subscriber_errback in subscribers:
+                    subscriber_errback(c, request, error, extra)
+
+            return self.stop_set.trace(self, _got_doubletree_trace,
+                                       _got_doubletree_error, ip_address,
+                                       protocol=protocol, port=port,
+                                       mode=mode, window=window)
+
+        target_ip = str(ip_address)
+        ts = time()
+        # Responses waiting to be processed in hop order, keyed by TTL
+        responses = {}
+        # Trace state shared by the closures below
+        next_ttl = ttl           # Next TTL to process a response for
+        next_send = ttl          # Next TTL to send a probe for
+        no_reply_hops = 0        # Number of hops that had no reply
+        done = False             # Set when the trace completes or errors
+        templates = {}           # Encoded send-probe requests by timeout
 
         def _got_reply(c, request, line, extra):
-            # Callback for a single request response
-            ts, hop_num, no_reply_hops, protocol, port, attempts = extra
-            send_next = False
-            trace_complete = False
-            ttl = None
-            if not line:
-                _got_error(c, request, 'no response line', extra)
+            # Callback for a single request response, responses are buffered
+            # and processed in hop order so parallel traces are identical to
+            # sequential ones
+            if done:
+                # The trace already completed at a lower TTL, ignore this
                 return
-            response_type = line[0]
-            if response_type == 'ttl-expired':
-                # Not reached the end of the trace yet, expiry notice from hop:
-                #   ttl-expired ip-4 10.0.0.1 round-trip-time 400
-                hops.append((hop_num, line[2], int(line[4])))
-                # Flag to trace to the next hop as we're not done
-                send_next = True
-                ttl = int(request[-1])
-            elif response_type == 'reply':
-                # Reached the end of the trace, reply from the target IP
-                #   reply ip-4 1.2.3.4 round-trip-time 254144
-                hops.append((hop_num, line[2], int(line[4])))
-                # Mark the trace as complete
-                trace_complete = True
-            elif response_type == 'no-reply':
-                # No reply from IP
-                #    no-reply
-                hops.append((hop_num, None, None))
-                no_reply_hops += 1
-                # Check if we should try additional hops
-                if no_reply_hops >= self.NO_REPLY_MAX_TTL:
-                    # We've already tried a additional hops, we're done
+            # probes-exhausted responses are requeued by got_mtr_line() and
+            # never reach here
+            ts, hop_num, _, protocol, port, attempts = extra
+            responses[hop_num] = (c, request, line, extra)
+            _process_responses()
+
+        def _process_responses():
+            # Consume buffered responses for as long as the next hop in order
+            # is available, then top up the window of probes in flight
+            nonlocal next_ttl, no_reply_hops, done
+            while next_ttl in responses:
+                c, request, line, extra = responses.pop(next_ttl)
+                hop_num = next_ttl
+                next_ttl += 1
+                trace_complete = False
+                if not line:
+                    _got_error(c, request, 'no response line', extra)
+                    return
+                response_type = line[0]
+                if response_type == 'ttl-expired':
+                    # Not reached the end of the trace yet, expiry notice from
+                    # hop:
+                    #   ttl-expired ip-4 10.0.0.1 round-trip-time 400
+                    hop_ip, rtt = line[2], int(line[4])
+                    if self.rtt_estimator is not None and not extra[5]:
+                        # Only sample RTTs of probes that were not retried
+                        self.rtt_estimator.update(target_ip, hop_num, rtt)
+                elif response_type == 'reply':
+                    # Reached the end of the trace, reply from the target IP
+                    #   reply ip-4 1.2.3.4 round-trip-time 254144
+                    hop_ip, rtt = line[2], int(line[4])
+                    if self.rtt_estimator is not None and not extra[5]:
+                        self.rtt_estimator.update(target_ip, hop_num, rtt,
+                                                  reply=True)
+                    # Mark the trace as complete
                     trace_complete = True
+                elif response_type == 'no-reply':
+                    # No reply from IP
+                    #    no-reply
+                    hop_ip, rtt = None, None
+                    no_reply_hops += 1
+                    # Check if we should try additional hops
+                    if no_reply_hops >= self.NO_REPLY_MAX_TTL:
+                        # We've already tried a additional hops, we're done
+                        trace_complete = True
+                elif response_type == 'no-route':
+                    # There was no route to the host used in a send-probe
+                    # request
+                    _got_error(c, request,
+                               (f'failed to send-probe to {ip_address}: no '
+                                f'route to host'),
+                               extra)
+                    return
+                elif response_type == 'network-down':
+                    # A probe could not be sent because the network is down
+                    _got_error(c, request,
+                               (f'failed to send-probe to {ip_address}: '
+                                f'network is down'),
+                               extra)
+                    return
+                elif response_type == 'permission-denied':
+                    # The operating system denied permission to send the probe
+                    # with the specified options
+                    _got_error(c, request,
+                               (f'failed to send-probe to {ip_address}: '
+                                f'permission denied'),
+                               extra)
+                    return
                 else:
-                    # Try the next hop
-                    send_next = True
-                    ttl = int(request[-1])
-            elif response_type == 'no-route':
-                # There was no route to the host used in a send-probe request
-                _got_error(c, request,
-                           (f'failed to send-probe to {ip_address}: no '
-                            f'route to host'),
-                           extra)
-                return
-            elif response_type == 'network-down':
-                # A probe could not be sent because the network is down
-                _got_error(c, request,
-                           (f'failed to send-probe to {ip_address}: '
-                            f'network is down'),
-                           extra)
-                return
-            elif response_type == 'probes-exhausted':
-                # A probe could not be sent because there are already too many
-                # unresolved probes already in flight
-                log.error(f'Failed to send probe to {ip_address} with TTL '
-                          f'{ttl}: too many probes in flight, will retry in '
-                          f'{self.RETRY_WAIT} seconds...')
-                reactor.callLater(self.RETRY_WAIT, trace_to_hop,
-                                  str(ip_address), ttl, protocol, port, extra)
-                return
-            elif response_type == 'permission-denied':
-                # The operating system denied permission to send the probe with
-                # the specified options
-                _got_error(c, request,
-                           (f'failed to send-probe to {ip_address}: '
-                            f'permission denied'),
-                           extra)
-                return
-            else:
-                # Unknown reply
-                _got_error(c, request,
-                           f'unknown response type: {response_type}',
-                           extra)
-                return
-            if trace_complete:
-                # We're all done, fire the upstream callback
-                hops_log = ' '.join(f'{hop}|{ip},{ms}' for hop, ip, ms in hops)
-                log.debug(f'Completed {protocol}:{port} trace to '
-                          f'{ip_address}: {hops_log}')
-                callback(ts, ip_address, protocol, port, hops)
-            elif send_next:
-                # Send the request to the next hop
-                trace_to_hop(
-                    str(ip_address),
-                    ttl + 1,
-                    protocol,
-                    port,
-                    (ts, hop_num + 1, no_reply_hops, protocol, port, 0),
-                )
+                    # Unknown reply
+                    _got_error(c, request,
+                               f'unknown response type: {response_type}',
+                               extra)
+                    return
+                if keep_hops:
+                    hops.append((hop_num, hop_ip, rtt))
+                if on_hop is not None:
+                    on_hop(ip_address, hop_num, hop_ip, rtt)
+                if stop_hop is not None and stop_hop(hop_num, hop_ip):
+                    # The caller asked for the trace to stop at this hop
+                    trace_complete = True
+                if hop_num >= self.MAX_TTL:
+                    # Reached the maximum number of hops we trace to
+                    trace_complete = True
+                if trace_complete:
+                    # We're all done, any responses or probes still in flight
+                    # for higher TTLs are ignored, fire the upstream callback
+                    done = True
+                    responses.clear()
+                    if log.isEnabledFor(logging.DEBUG):
+                        hops_log = ' '.join(f'{hop}|{ip},{ms}'
+                                            for hop, ip, ms in hops)
+                        log.debug(f'Completed {protocol}:{port} trace to '
+                                  f'{ip_address}: {hops_log}')
+                    if stop_hop is not None or not keep_hops:
+                        result = hops
+                    elif self.compact:
+                        result = self.compact_result(ts, ip_address,
+                                                     protocol, port, hops)
+                        if self.cache is not None:
+                            self.cache.put(cache_key, ts, result)
+                    else:
+                        result = hops
+                        if self.cache is not None:
+                            self.cache.put(cache_key, ts, tuple(hops))
+                    _finished()
+                    for subscriber_callback, _ in subscribers:
+                        subscriber_callback(ts, ip_address, protocol, port,
+                                            result)
+                    return
+            _fill_window()
 
         def _got_error(c, request, error, extra):
             # Error callback for a single request response
-            ts, hop_num, no_reply_hops, protocol, port, attempts = extra
+            nonlocal done
+            if done:
+                return
+            ts, hop_num, _, protocol, port, attempts = extra
             attempts += 1
             if error == 'timeout':
                 # This is a timeout where mtr-packet didn't respond at all
-                target_ip = request[4]
-                ttl = int(request[-1])
+                if self.metrics is not None:
+                    self.metrics.retried()
                 extra = (ts, hop_num, no_reply_hops, protocol, port, attempts)
-                log.error(f'Probe to {target_ip} with TTL {ttl} had no '
-                            f'reply from mtr, retry '
-                            f'attempt {attempts}...')
-                reactor.callLater(self.RETRY_WAIT, trace_to_hop,
-                                  target_ip, ttl, protocol, port, extra)
+                log.error(f'Probe to {target_ip} with TTL {hop_num} had no '
+                          f'reply from mtr, retry attempt {attempts}...')
+                reactor.callLater(self.RETRY_WAIT, trace_to_hop, hop_num,
+                                  extra)
             else:
                 # Something else went wrong, send it to the upstream errback()
-                errback(c, request, error, extra)
+                done = True
+                responses.clear()
+                _finished()
+                for _, subscriber_errback in subscribers:
+                    subscriber_errback(c, request, error, extra)
 
-        def trace_to_hop(target_ip, ttl, protocol, port, extra):
+        def _fill_window():
+            # Send probes for TTLs until the window is full
+            nonlocal next_send
+            while next_send < next_ttl + window and next_send <= self.MAX_TTL:
+                trace_to_hop(
+                    next_send,
+                    (ts, next_send, no_reply_hops, protocol, port, 0)
+                )
+                next_send += 1
+
+        def trace_to_hop(ttl, extra):
             # Make a single send-probe request
-            request = [
-                'send-probe',
-                local_family, local_ip,
-                target_family, target_ip,
-                'timeout', str(self.REQUEST_TIMEOUT),
-                'protocol', protocol
-            ]
-            if protocol == 'tcp':
-                request += ['port', str(port)]
-            request += ['ttl', str(ttl)]
-            self.mtr_request(_got_reply, _got_error, request, extra)
-
-        # Start the trace off, (hop_num, no_reply_hops) stored in "extra"
-        log.debug(f'Starting trace to: {ip_address}')
-        hop_num, no_reply_hops = ttl, 0
-        extra = (time(), hop_num, no_reply_hops, protocol, port, 0)
-        trace_to_hop(str(ip_address), ttl, protocol, port, extra)
+            if done:
+                return
+            timeout, wait = self.probe_timeout(target_ip, ttl)
+            template = templates.get(timeout)
+            if template is None:
+                template = self.probe_template(ip_address, protocol, port,
+                                               timeout)
+                templates[timeout] = template
+            self.mtr_request(_got_reply, _got_error, template + b'%d' % ttl,
+                             extra, wait)
+
+        # Start the trace off, (ts, hop_num, no_reply_hops, protocol, port,
+        # attempts) are stored in "extra" for each probe
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'Starting {mode} trace to: {ip_address}')
+        _fill_window()
+
+    def trace_many(self, targets, concurrency=None, protocol='icmp', port=-1,
+                   **trace_kwargs):
+        '''
+            Traces every target in an iterable of IP addresses with at most
+            "concurrency" traces active at once. Returns a TraceMany instance
+            which yields results as traces complete. Any other keyword
+            arguments are passed to trace().
+        '''
+        return TraceMany(self, targets, concurrency=concurrency,
+                         protocol=protocol, port=port, **trace_kwargs)
+
+    def trace_multipath(self, callback, errback, ip_address, protocol='udp',
+                        port=None, confidence=None, max_probes=None,
+                        window=None):
+        '''
+            Finds every load balanced path to ip_address with the Multipath
+            Detection Algorithm, see MultipathTrace. "protocol" must be udp
+            or tcp, "port" defaults to 33434. Returns the started
+            MultipathTrace.
+        '''
+        multipath = MultipathTrace(self, ip_address, protocol=protocol,
+                                   port=port, confidence=confidence,
+                                   max_probes=max_probes, window=window)
+        multipath.start(callback, errback)
+        return multipath
+
+    def trace_continuous(self, ip_address, protocol='icmp', port=-1,
+                         interval=None):
+        '''
+            Starts probing every hop on the path to ip_address every
+            "interval" seconds. Returns a ContinuousTrace which keeps running
+            statistics for each hop, call its stop() method to stop probing.
+        '''
+        continuous = ContinuousTrace(self, ip_address, protocol=protocol,
+                                     port=port, interval=interval)
+        continuous.start()
+        return continuous
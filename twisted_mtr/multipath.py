@@ -0,0 +1,235 @@
+import logging
+from functools import lru_cache
+from math import comb
+from time import time
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('multipath', level=logging.INFO)
+
+
+@lru_cache(maxsize=None)
+def probes_needed(interfaces, confidence):
+    '''
+        Returns the number of probes with different flow identifiers which
+        have to be sent to a hop, having found "interfaces" interfaces, to
+        rule out there being one more load balanced interface with
+        "confidence" (the MDA stopping rule). Assumes load balancers spread
+        flows evenly over their next hops.
+    '''
+    k = interfaces + 1
+    alpha = 1 - confidence
+    probes = k
+    while True:
+        # Chance of not seeing every one of k interfaces with "probes" probes
+        missed = sum((-1) ** (i + 1) * comb(k, i) * ((k - i) / k) ** probes
+                     for i in range(1, k))
+        if missed <= alpha:
+            return probes
+        probes += 1
+
+
+class MultipathHop:
+    '''
+        Interfaces found at a single TTL of a multipath trace.
+    '''
+
+    __slots__ = ('hop_num', 'sent', 'answered', 'interfaces', 'reached')
+
+    def __init__(self, hop_num):
+        self.hop_num = hop_num
+        self.sent = 0
+        self.answered = 0
+        # Maps interface IPs to the lowest RTT seen from them
+        self.interfaces = {}
+        self.reached = False
+
+    def add(self, hop_ip, rtt):
+        best = self.interfaces.get(hop_ip)
+        if best is None or rtt < best:
+            self.interfaces[hop_ip] = rtt
+
+    def result(self):
+        return (self.hop_num, tuple(sorted(self.interfaces.items())))
+
+
+class MultipathTrace:
+    '''
+        Finds every load balanced path to a target with the Multipath
+        Detection Algorithm (MDA). Each probe carries a flow identifier, its
+        source port, which stays the same for every TTL so per-flow load
+        balancers send each flow along a single path as Paris traceroute
+        does. Only udp and tcp probes are supported: mtr-packet gives every
+        icmp probe a new sequence number, and so a new checksum, which
+        per-flow load balancers hash, so icmp flows can't be kept on one
+        path. Each TTL is probed with different flows until enough
+        probes have been answered to rule out another interface with
+        "confidence", and up to "window" TTLs are probed at once. No more
+        than "max_probes" probes are sent for a whole trace. The success
+        callback is passed (ts, target_ip, protocol, port, hops) where hops
+        is a list of (hop_num, ((hop_ip, rtt), ...)) tuples of the
+        interfaces found at each TTL, which are empty if none replied.
+    '''
+
+    CONFIDENCE = 0.95     # Chance that no load balanced interface is missed
+    MAX_PROBES = 2000     # Default probe budget for a whole trace
+    BASE_PORT = 33000     # First source port used as a flow identifier
+    PORT = 33434          # Default udp destination port
+
+    def __init__(self, tracer, ip_address, protocol='udp', port=None,
+                 confidence=None, max_probes=None, window=None):
+        self.tracer = tracer
+        self.ip_address = ip_address
+        self.target_ip = str(ip_address)
+        self.protocol = protocol
+        if protocol not in ('tcp', 'udp'):
+            raise MTRError(f'Multipath traces need a udp or tcp flow '
+                           f'identifier, icmp probes can not be kept on one '
+                           f'path, got: {protocol}')
+        self.port = tracer.check_protocol(
+            protocol, self.PORT if port is None else port)
+        self.confidence = (self.CONFIDENCE if confidence is None
+                           else confidence)
+        if not 0 < self.confidence < 1:
+            raise MTRError(f'confidence must be between 0 and 1, '
+                           f'got: {self.confidence}')
+        self.max_probes = (self.MAX_PROBES if max_probes is None
+                           else max_probes)
+        if not isinstance(self.max_probes, int) or self.max_probes < 1:
+            raise MTRError(f'max_probes must be an int of 1 or more, '
+                           f'got: {self.max_probes}')
+        self.window = tracer.PARALLEL_WINDOW if window is None else window
+        if not isinstance(self.window, int) or self.window < 1:
+            raise MTRError(f'Window must be an int of 1 or more, '
+                           f'got: {self.window}')
+        # Raises an MTRError if there's no local IP for the target family
+        tracer.get_families(ip_address)
+        self.hops = []
+        self.probes = 0
+        self.templates = {}
+        self.next_done = 0
+        self.silent_hops = 0
+        self.done = False
+        self.ts = None
+        self.callback = None
+        self.errback = None
+
+    def start(self, callback, errback):
+        '''
+            Starts the trace, "callback" and "errback" are called as for
+            TraceRoute.trace().
+        '''
+        if self.ts is not None:
+            raise MTRError('Multipath trace has already been started')
+        self.callback = callback
+        self.errback = errback
+        self.ts = time()
+        log.debug(f'Starting multipath trace to: {self.ip_address}')
+        self.open_hops()
+
+    def flow_argument(self, flow):
+        # The source port, with the fixed destination port, keeps the flow
+        # of the probe the same at every TTL
+        return ['local-port', str(self.BASE_PORT + flow)]
+
+    def probe(self, hop, flow):
+        # Send one probe for a flow to a hop, the send-probe request is
+        # encoded once for each flow and timeout
+        timeout, wait = self.tracer.probe_timeout(self.target_ip,
+                                                  hop.hop_num)
+        template = self.templates.get((flow, timeout))
+        if template is None:
+            template = self.tracer.probe_template(
+                self.ip_address, self.protocol, self.port, timeout,
+                extra_args=self.flow_argument(flow))
+            self.templates[(flow, timeout)] = template
+        hop.sent += 1
+        self.probes += 1
+        self.tracer.mtr_request(self._got_reply, self._got_error,
+                                template + b'%d' % hop.hop_num, (hop, flow),
+                                wait)
+
+    def top_up(self, hop):
+        # Send enough probes to the hop to satisfy the stopping rule for the
+        # interfaces found so far, all at once
+        needed = probes_needed(max(len(hop.interfaces), 1), self.confidence)
+        while hop.sent < needed and self.probes < self.max_probes:
+            self.probe(hop, hop.sent)
+
+    def open_hops(self):
+        # Start probing TTLs until "window" incomplete TTLs are in flight
+        while (len(self.hops) < self.next_done + self.window and
+               len(self.hops) < self.tracer.MAX_TTL and
+               self.probes < self.max_probes):
+            hop = MultipathHop(len(self.hops) + 1)
+            self.hops.append(hop)
+            self.top_up(hop)
+
+    def _got_reply(self, c, request, line, extra):
+        if self.done:
+            return
+        hop, flow = extra
+        hop.answered += 1
+        response_type = line[0] if line else None
+        if response_type in ('ttl-expired', 'reply'):
+            hop.add(line[2], int(line[4]))
+            if response_type == 'reply' or line[2] == self.target_ip:
+                hop.reached = True
+        elif response_type in ('no-route', 'network-down',
+                               'permission-denied'):
+            error = response_type.replace('-', ' ')
+            self.fail(c, request,
+                      f'failed to send-probe to {self.ip_address}: {error}',
+                      extra)
+            return
+        elif response_type != 'no-reply':
+            self.fail(c, request, f'unknown response type: {response_type}',
+                      extra)
+            return
+        self.top_up(hop)
+        self.check_done()
+
+    def _got_error(self, c, request, error, extra):
+        if self.done:
+            return
+        if error != 'timeout':
+            self.fail(c, request, error, extra)
+            return
+        # mtr-packet never answered, count the probe as having no reply
+        hop, flow = extra
+        hop.answered += 1
+        self.check_done()
+
+    def check_done(self):
+        # Move past every TTL in order which has all of its probes answered
+        while self.next_done < len(self.hops):
+            hop = self.hops[self.next_done]
+            if hop.answered < hop.sent:
+                break
+            self.next_done += 1
+            if hop.interfaces:
+                self.silent_hops = 0
+            else:
+                self.silent_hops += 1
+            if (hop.reached or
+                    self.silent_hops >= self.tracer.NO_REPLY_MAX_TTL or
+                    hop.hop_num >= self.tracer.MAX_TTL):
+                self.finish(hop.hop_num)
+                return
+        self.open_hops()
+        if self.next_done == len(self.hops):
+            # Out of probe budget with no TTLs left in flight
+            self.finish(len(self.hops))
+
+    def finish(self, last_hop):
+        self.done = True
+        hops = [hop.result() for hop in self.hops[:last_hop]]
+        log.debug(f'Completed multipath trace to {self.ip_address} with '
+                  f'{self.probes} probes')
+        self.callback(self.ts, self.ip_address, self.protocol, self.port,
+                      hops)
+
+    def fail(self, c, request, error, extra):
+        self.done = True
+        self.errback(c, request, error, extra)
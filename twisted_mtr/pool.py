@@ -0,0 +1,120 @@
+import logging
+from .logger import get_logger
+from .errors import MTRError
+from .mtr import TraceRoute
+from .bulk import TraceMany
+
+
+log = get_logger('pool', level=logging.INFO)
+
+
+class TraceRoutePool:
+    '''
+        Spreads traces over a number of mtr-packet processes, each with its
+        own TraceRoute protocol. Each mtr-packet process limits the number of
+        probes it will have in flight, so a pool allows more probes per second
+        from a single reactor. Traces are sent to the process with the fewest
+        outstanding requests, except that a trace identical to one already in
+        flight is sent to the same process so the two are coalesced. If a
+        TraceCache is passed as "cache", a StopSet as "stop_set", an
+        RTTEstimator as "rtt_estimator", Metrics as "metrics" or a TokenBucket
+        as "rate_limiter" they are shared by every process in the pool.
+    '''
+
+    POOL_SIZE = 4         # Default number of mtr-packet processes to spawn
+
+    def __init__(self, mtr_binary_path=None, local_ipv4=None, local_ipv6=None,
+                 size=None, timeout_manager=None, cache=None, coalesce=True,
+                 stop_set=None, rtt_estimator=None, compact=False,
+                 metrics=None, coalesce_writes=True, respawn=False,
+                 health_check_interval=None, rate_limiter=None):
+        if size is None:
+            size = self.POOL_SIZE
+        if not isinstance(size, int) or size < 1:
+            raise MTRError(f'Pool size must be an int of 1 or more, '
+                           f'got: {size}')
+        self.mtr_binary_path = mtr_binary_path
+        self.coalesce = coalesce
+        self.workers = [
+            TraceRoute(mtr_binary_path=mtr_binary_path, local_ipv4=local_ipv4,
+                       local_ipv6=local_ipv6, timeout_manager=timeout_manager,
+                       cache=cache, coalesce=coalesce, stop_set=stop_set,
+                       rtt_estimator=rtt_estimator, compact=compact,
+                       metrics=metrics, coalesce_writes=coalesce_writes,
+                       respawn=respawn,
+                       health_check_interval=health_check_interval,
+                       rate_limiter=rate_limiter)
+            for _ in range(size)
+        ]
+
+    def start(self):
+        '''
+            Spawns an mtr-packet process for every TraceRoute in the pool.
+        '''
+        if not self.mtr_binary_path:
+            raise MTRError('mtr_binary_path must be set to start the pool')
+        for worker in self.workers:
+            worker.spawn()
+        log.debug(f'Spawned {len(self.workers)} mtr-packet processes')
+
+    def stop(self):
+        '''
+            Closes the connection to every mtr-packet process in the pool
+            which causes them to exit.
+        '''
+        for worker in self.workers:
+            worker.stop()
+
+    def queue_depths(self):
+        '''
+            Returns a list of the number of outstanding requests, both in
+            flight and queued, for each mtr-packet process in the pool.
+        '''
+        return [worker.outstanding() for worker in self.workers]
+
+    def get_worker(self):
+        '''
+            Returns the TraceRoute in the pool with the fewest outstanding
+            requests.
+        '''
+        return min(self.workers, key=lambda worker: worker.outstanding())
+
+    def get_trace_worker(self, ip_address, protocol, port, ttl, stop_hop,
+                         on_hop, keep_hops):
+        '''
+            Returns the TraceRoute with an identical trace in flight, so the
+            trace joins it, or the least busy TraceRoute.
+        '''
+        if self.coalesce:
+            port = self.workers[0].check_protocol(protocol, port)
+            trace_key = self.workers[0].trace_key(ip_address, protocol, port,
+                                                  ttl, stop_hop, on_hop,
+                                                  keep_hops)
+            for worker in self.workers:
+                if trace_key in worker.traces:
+                    return worker
+        return self.get_worker()
+
+    def trace(self, callback, errback, ip_address, protocol='icmp', port=-1,
+              ttl=1, extra=None, mode='sequential', window=None,
+              stop_hop=None, on_hop=None, keep_hops=True):
+        '''
+            Starts a trace on the least busy mtr-packet process, or the one
+            with an identical trace in flight, takes the same arguments as
+            TraceRoute.trace().
+        '''
+        worker = self.get_trace_worker(ip_address, protocol, port, ttl,
+                                       stop_hop, on_hop, keep_hops)
+        return worker.trace(callback, errback, ip_address, protocol=protocol,
+                            port=port, ttl=ttl, extra=extra, mode=mode,
+                            window=window, stop_hop=stop_hop, on_hop=on_hop,
+                            keep_hops=keep_hops)
+
+    def trace_many(self, targets, concurrency=None, protocol='icmp', port=-1,
+                   **trace_kwargs):
+        '''
+            Traces every target in an iterable over the pool, takes the same
+            arguments as TraceRoute.trace_many().
+        '''
+        return TraceMany(self, targets, concurrency=concurrency,
+                         protocol=protocol, port=port, **trace_kwargs)
@@ -0,0 +1,142 @@
+import socket
+from array import array
+from collections import namedtuple
+
+
+# A single hop as yielded by a TraceResult, compatible with the plain
+# (hop_num, hop_ip, rtt) tuples traces return by default
+Hop = namedtuple('Hop', ('hop_num', 'hop_ip', 'rtt'))
+
+
+class AddressTable:
+    '''
+        Interns IP addresses as packed 4 byte (IPv4) or 16 byte (IPv6) strings
+        and hands out a small integer index for each one. Index 0 is reserved
+        for hops with no address. Tables are shared between results so every
+        unique address is only stored once. Entries are never removed, so a
+        table only grows, see rotated() to bound it at "max_size" addresses.
+    '''
+
+    MAX_SIZE = 65536      # Default number of addresses before rotating
+
+    def __init__(self, max_size=None):
+        self.max_size = self.MAX_SIZE if max_size is None else max_size
+        self.packed = [None]
+        self.indexes = {}
+
+    def __len__(self):
+        return len(self.packed) - 1
+
+    def rotated(self):
+        '''
+            Returns this table, or a new empty table with the same max_size
+            once this one is full. Results keep a reference to the table
+            their addresses are in, so a full table is freed along with the
+            last result using it.
+        '''
+        if len(self) < self.max_size:
+            return self
+        return AddressTable(self.max_size)
+
+    def intern(self, ip):
+        '''
+            Returns the index for an IP address string, or 0 for None.
+        '''
+        if ip is None:
+            return 0
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        packed = socket.inet_pton(family, ip)
+        index = self.indexes.get(packed)
+        if index is None:
+            index = len(self.packed)
+            self.packed.append(packed)
+            self.indexes[packed] = index
+        return index
+
+    def address(self, index):
+        '''
+            Returns the IP address string for an index, or None for 0.
+        '''
+        packed = self.packed[index]
+        if packed is None:
+            return None
+        family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+        return socket.inet_ntop(family, packed)
+
+
+class TraceResult:
+    '''
+        Compact storage for the hops of a completed trace. Hop numbers are
+        stored in an array('I'), RTTs in an array('i') with -1 for hops with
+        no reply and hop addresses as indexes into an AddressTable, which is
+        shared with other results if it is passed to from_hops(). Iterating
+        or indexing a TraceResult lazily creates Hop tuples so it can be used
+        anywhere the default list of (hop_num, hop_ip, rtt) tuples is.
+    '''
+
+    __slots__ = ('ts', 'target_ip', 'protocol', 'port', 'hop_nums',
+                 'addresses', 'rtts', 'table')
+
+    def __init__(self, ts, target_ip, protocol, port, hop_nums, addresses,
+                 rtts, table):
+        self.ts = ts
+        self.target_ip = target_ip
+        self.protocol = protocol
+        self.port = port
+        self.hop_nums = hop_nums
+        self.addresses = addresses
+        self.rtts = rtts
+        self.table = table
+
+    @classmethod
+    def from_hops(cls, ts, target_ip, protocol, port, hops, table=None):
+        '''
+            Creates a TraceResult from a list of (hop_num, hop_ip, rtt)
+            tuples. "target_ip" is an IPAddress object. Hop addresses are
+            interned in "table", or a new AddressTable if it is not set.
+        '''
+        table = AddressTable() if table is None else table
+        hop_nums = array('I')
+        addresses = array('I')
+        rtts = array('i')
+        for hop_num, hop_ip, rtt in hops:
+            hop_nums.append(hop_num)
+            addresses.append(table.intern(hop_ip))
+            rtts.append(-1 if rtt is None else rtt)
+        return cls(ts, target_ip, protocol, port, hop_nums, addresses, rtts,
+                   table)
+
+    def hop(self, i):
+        '''
+            Returns the Hop at position "i".
+        '''
+        rtt = self.rtts[i]
+        return Hop(self.hop_nums[i], self.table.address(self.addresses[i]),
+                   None if rtt == -1 else rtt)
+
+    def __len__(self):
+        return len(self.hop_nums)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.hop(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('TraceResult index out of range')
+        return self.hop(i)
+
+    def __iter__(self):
+        for i in range(len(self.hop_nums)):
+            yield self.hop(i)
+
+    def __eq__(self, other):
+        if isinstance(other, TraceResult):
+            return list(self) == list(other)
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return (f'<TraceResult {self.protocol}:{self.port} to '
+                f'{self.target_ip} with {len(self)} hops>')
@@ -0,0 +1,88 @@
+import math
+import logging
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('rtt', level=logging.INFO)
+
+
+class RTTEstimator:
+    '''
+        Estimates the timeout to use for probes from previously observed
+        round trip times, in the same way as TCP retransmission timeouts
+        (RFC 6298). A smoothed RTT and RTT variation are kept for each hop
+        (target IP and TTL) and for each target from its replies. Probes to a
+        hop with no samples use the estimate for the target, and probes to a
+        target with no samples use the ceiling. Timeouts are whole seconds as
+        that's what mtr-packet accepts, limited to between the floor and the
+        ceiling.
+    '''
+
+    ALPHA = 1 / 8         # Gain for the smoothed RTT
+    BETA = 1 / 4          # Gain for the RTT variation
+    K = 4                 # Multiplier of the RTT variation in the timeout
+    FLOOR = 1             # Seconds, shortest timeout
+    CEILING = 5           # Seconds, longest timeout
+    MAX_ENTRIES = 100000  # Maximum number of hops and targets to track
+
+    def __init__(self, floor=None, ceiling=None, max_entries=None):
+        self.floor = self.FLOOR if floor is None else floor
+        self.ceiling = self.CEILING if ceiling is None else ceiling
+        if not isinstance(self.floor, int) or self.floor < 1:
+            raise MTRError(f'floor must be an int of 1 or more, '
+                           f'got: {self.floor}')
+        if not isinstance(self.ceiling, int) or self.ceiling < self.floor:
+            raise MTRError(f'ceiling must be an int of at least the floor, '
+                           f'got: {self.ceiling}')
+        self.max_entries = (self.MAX_ENTRIES if max_entries is None
+                            else max_entries)
+        # Maps target IPs and (target IP, TTL) tuples to [srtt, rttvar] in
+        # microseconds
+        self.estimates = {}
+
+    def __len__(self):
+        return len(self.estimates)
+
+    def sample(self, key, rtt):
+        # Update the estimate for a key with an RTT sample in microseconds
+        estimate = self.estimates.get(key)
+        if estimate is None:
+            self.estimates[key] = [rtt, rtt / 2]
+            if len(self.estimates) > self.max_entries:
+                del self.estimates[next(iter(self.estimates))]
+            return
+        srtt, rttvar = estimate
+        estimate[1] = (1 - self.BETA) * rttvar + self.BETA * abs(srtt - rtt)
+        estimate[0] = (1 - self.ALPHA) * srtt + self.ALPHA * rtt
+
+    def update(self, target_ip, ttl, rtt, reply=False):
+        '''
+            Adds an RTT sample in microseconds for the hop at "ttl" on the way
+            to "target_ip", "reply" is True if the sample is from the target.
+        '''
+        self.sample((target_ip, ttl), rtt)
+        if reply:
+            self.sample(target_ip, rtt)
+
+    def rto(self, target_ip, ttl):
+        '''
+            Returns the unclamped timeout in seconds for a probe to a hop, or
+            None if there are no samples for the hop or the target.
+        '''
+        estimate = self.estimates.get((target_ip, ttl))
+        if estimate is None:
+            estimate = self.estimates.get(target_ip)
+            if estimate is None:
+                return None
+        srtt, rttvar = estimate
+        return (srtt + self.K * rttvar) / 1000000
+
+    def timeout(self, target_ip, ttl):
+        '''
+            Returns the timeout in whole seconds for a probe to a hop.
+        '''
+        rto = self.rto(target_ip, ttl)
+        if rto is None:
+            return self.ceiling
+        return min(max(int(math.ceil(rto)), self.floor), self.ceiling)
@@ -0,0 +1,302 @@
+import heapq
+import random
+import logging
+from collections import deque
+from twisted.internet import reactor
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('scheduler', level=logging.INFO)
+
+
+class TokenBucket:
+    '''
+        Limits a rate of events to "rate" per second on average with bursts
+        of at most "burst" events. Pass an instance as the "rate_limiter"
+        argument of TraceRoute or TraceRoutePool to limit the number of
+        probes sent per second, one instance can be shared to set a global
+        limit. A small burst keeps the rate of probes smooth.
+    '''
+
+    BURST = 0.1           # Seconds, default burst size as time at "rate"
+
+    def __init__(self, rate, burst=None):
+        if not isinstance(rate, (int, float)) or rate <= 0:
+            raise MTRError(f'rate must be a number above 0, got: {rate}')
+        self.rate = rate
+        self.burst = max(1, rate * self.BURST) if burst is None else burst
+        if self.burst < 1:
+            raise MTRError(f'burst must be 1 or more, got: {self.burst}')
+        self.tokens = self.burst
+        self.updated = reactor.seconds()
+
+    def refill(self):
+        now = reactor.seconds()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, count=1):
+        '''
+            Returns True and uses "count" tokens if they are available,
+            otherwise returns False.
+        '''
+        self.refill()
+        if self.tokens >= count:
+            self.tokens -= count
+            return True
+        return False
+
+    def delay(self, count=1):
+        '''
+            Returns the number of seconds until "count" tokens are available.
+        '''
+        self.refill()
+        return max(0, (count - self.tokens) / self.rate)
+
+
+class ScheduledTarget:
+    '''
+        A target traced every "interval" seconds by a TraceScheduler.
+    '''
+
+    __slots__ = ('key', 'interval', 'priority', 'callback', 'errback',
+                 'trace_kwargs', 'due', 'removed')
+
+    def __init__(self, key, interval, priority, callback, errback,
+                 trace_kwargs):
+        self.key = key
+        self.interval = interval
+        self.priority = priority
+        self.callback = callback
+        self.errback = errback
+        self.trace_kwargs = trace_kwargs
+        self.due = None
+        self.removed = False
+
+
+class TraceScheduler:
+    '''
+        Traces a large inventory of targets on fixed intervals. Each target
+        is first traced at a random time within its interval and then every
+        "interval" seconds, give or take "jitter" as a fraction of the
+        interval, so traces are spread evenly over time rather than started
+        in bursts. At most "max_active" traces run at once, due traces wait
+        in a queue for each priority class and lower priority values are
+        always started first, so on demand traces from trace() start ahead
+        of any waiting periodic traces. "tracer" is a TraceRoute or
+        TraceRoutePool, set a TokenBucket as its "rate_limiter" to also
+        limit the number of probes sent per second.
+    '''
+
+    ON_DEMAND = 0         # Priority of traces started with trace()
+    BACKGROUND = 1        # Default priority of periodic traces
+    INTERVAL = 300        # Seconds, default time between traces of a target
+    JITTER = 0.1          # Fraction of the interval to randomise by
+    MAX_ACTIVE = 100      # Default maximum number of traces running at once
+
+    def __init__(self, tracer, interval=None, jitter=None, max_active=None,
+                 seed=None):
+        self.tracer = tracer
+        self.interval = self.INTERVAL if interval is None else interval
+        self.jitter = self.JITTER if jitter is None else jitter
+        if not 0 <= self.jitter < 1:
+            raise MTRError(f'jitter must be between 0 and 1, '
+                           f'got: {self.jitter}')
+        self.max_active = (self.MAX_ACTIVE if max_active is None
+                           else max_active)
+        if not isinstance(self.max_active, int) or self.max_active < 1:
+            raise MTRError(f'max_active must be an int of 1 or more, '
+                           f'got: {self.max_active}')
+        self.random = random.Random(seed)
+        self.targets = {}
+        # Heap of (due, sequence, ScheduledTarget) for periodic targets
+        # waiting for their next trace
+        self.timers = []
+        self.sequence = 0
+        # Queues of traces ready to start keyed by priority, each item is a
+        # (callback, errback, ip_address, protocol, port, trace_kwargs) tuple
+        self.ready = {}
+        self.active = 0
+        self.wakeup = None
+        self.running = True
+
+    def add(self, ip_address, protocol='icmp', port=-1, interval=None,
+            priority=None, callback=None, errback=None, **trace_kwargs):
+        '''
+            Traces ip_address every "interval" seconds, defaulting to the
+            interval of the scheduler. "callback" and "errback" are called
+            as for TraceRoute.trace() for every trace of the target. Any other
+            keyword arguments are passed to trace().
+        '''
+        key = (ip_address, protocol, port)
+        if key in self.targets:
+            raise MTRError(f'{protocol}:{port} traces to {ip_address} are '
+                           f'already scheduled')
+        interval = self.interval if interval is None else interval
+        if interval <= 0:
+            raise MTRError(f'interval must be above 0, got: {interval}')
+        priority = self.BACKGROUND if priority is None else priority
+        target = ScheduledTarget(key, interval, priority, callback, errback,
+                                 trace_kwargs)
+        self.targets[key] = target
+        # Start at a random point in the first interval to spread targets
+        # added at the same time
+        self.schedule(target, reactor.seconds() +
+                      self.random.uniform(0, interval))
+
+    def remove(self, ip_address, protocol='icmp', port=-1):
+        '''
+            Stops tracing ip_address, a trace already running completes.
+        '''
+        target = self.targets.pop((ip_address, protocol, port), None)
+        if target is not None:
+            target.removed = True
+
+    def __len__(self):
+        return len(self.targets)
+
+    def trace(self, callback, errback, ip_address, protocol='icmp', port=-1,
+              priority=None, **trace_kwargs):
+        '''
+            Traces ip_address once as soon as there is room, ahead of any
+            waiting traces with a higher priority value. Takes the same
+            arguments as TraceRoute.trace().
+        '''
+        priority = self.ON_DEMAND if priority is None else priority
+        self.enqueue(priority, (callback, errback, ip_address, protocol,
+                                port, trace_kwargs))
+        self.dispatch()
+
+    def queue_lengths(self):
+        '''
+            Returns a dict of the number of traces waiting to start keyed by
+            priority.
+        '''
+        return {priority: len(queue)
+                for priority, queue in sorted(self.ready.items())}
+
+    def schedule(self, target, due):
+        target.due = due
+        heapq.heappush(self.timers, (due, self.sequence, target))
+        self.sequence += 1
+        self.set_wakeup()
+
+    def set_wakeup(self):
+        # Wake up when the next periodic trace is due
+        if not self.timers or not self.running:
+            return
+        delay = max(0, self.timers[0][0] - reactor.seconds())
+        if self.wakeup is not None and self.wakeup.active():
+            if self.wakeup.getTime() <= self.timers[0][0]:
+                return
+            self.wakeup.cancel()
+        self.wakeup = reactor.callLater(delay, self.check_timers)
+
+    def check_timers(self):
+        '''
+            Moves every periodic trace which is due to its ready queue.
+        '''
+        self.wakeup = None
+        now = reactor.seconds()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, target = heapq.heappop(self.timers)
+            if target.removed:
+                continue
+            self.enqueue(target.priority, target)
+        self.set_wakeup()
+        self.dispatch()
+
+    def enqueue(self, priority, job):
+        queue = self.ready.get(priority)
+        if queue is None:
+            queue = deque()
+            self.ready[priority] = queue
+        queue.append(job)
+
+    def dispatch(self):
+        '''
+            Starts waiting traces, lowest priority value first, while fewer
+            than "max_active" traces are running.
+        '''
+        while self.running and self.active < self.max_active:
+            job = None
+            for priority in sorted(self.ready):
+                queue = self.ready[priority]
+                if queue:
+                    job = queue.popleft()
+                    break
+            if job is None:
+                return
+            if isinstance(job, ScheduledTarget):
+                if not job.removed:
+                    self.start_periodic(job)
+            else:
+                self.start(*job)
+
+    def start(self, callback, errback, ip_address, protocol, port,
+              trace_kwargs, on_done=None):
+        self.active += 1
+        released = False
+
+        def _release():
+            # Free the active slot of the trace, exactly once
+            nonlocal released
+            released = True
+            self.finished(on_done)
+
+        def _got_result(*a):
+            _release()
+            if callback is not None:
+                callback(*a)
+
+        def _got_error(*a):
+            _release()
+            if errback is not None:
+                errback(*a)
+
+        try:
+            self.tracer.trace(_got_result, _got_error, ip_address,
+                              protocol=protocol, port=port, **trace_kwargs)
+        except Exception as e:
+            if released:
+                # The trace completed and the error was raised by one of its
+                # callbacks, the slot is already free
+                raise
+            # Any failure to start the trace frees its slot or the scheduler
+            # would stall once max_active slots leaked
+            log.error(f'Failed to start trace to {ip_address}: {e}')
+            _got_error(None, None, str(e), None)
+
+    def start_periodic(self, target):
+        started = reactor.seconds()
+
+        def _reschedule():
+            if target.removed or not self.running:
+                return
+            # The next trace is due one interval after this one started,
+            # randomised by the jitter
+            spread = self.random.uniform(-self.jitter, self.jitter)
+            self.schedule(target, max(started + target.interval *
+                                      (1 + spread), reactor.seconds()))
+
+        ip_address, protocol, port = target.key
+        self.start(target.callback, target.errback, ip_address, protocol,
+                   port, target.trace_kwargs, on_done=_reschedule)
+
+    def finished(self, on_done):
+        self.active -= 1
+        if on_done is not None:
+            on_done()
+        # Start waiting traces once the current callbacks have finished
+        reactor.callLater(0, self.dispatch)
+
+    def stop(self):
+        '''
+            Stops starting traces, traces already running complete.
+        '''
+        self.running = False
+        if self.wakeup is not None and self.wakeup.active():
+            self.wakeup.cancel()
+        self.wakeup = None
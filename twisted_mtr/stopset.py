@@ -0,0 +1,193 @@
+import logging
+import ipaddress
+from time import time
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('stopset', level=logging.INFO)
+
+
+class StopSet:
+    '''
+        Stop sets for Doubletree style tracing from a single vantage point.
+        The local stop set maps (ttl, hop_ip) pairs seen in earlier traces to
+        the hops leading up to them, the global stop set maps (hop_ip,
+        destination prefix) pairs to the hops seen after them towards that
+        prefix. Traces start at "start_ttl" and probe forwards towards the
+        target and backwards towards the vantage point at the same time.
+        Backward probing stops at the first hop in the local stop set and the
+        known hops before it are stitched into the trace. Forward probing
+        stops at the first hop in the global stop set for the target prefix
+        and the known hops after it are stitched into the trace. A reply from
+        the previously traced target is only stitched in if it is the same
+        target, so traces to other targets in the same prefix which stop at a
+        global stop set hop do not end with the target.
+    '''
+
+    START_TTL = 6         # TTL traces start probing at
+    IPV4_PREFIX = 24      # Prefix length of IPv4 destination prefixes
+    IPV6_PREFIX = 48      # Prefix length of IPv6 destination prefixes
+    MAX_ENTRIES = 100000  # Maximum number of entries in each stop set
+
+    def __init__(self, start_ttl=None, max_entries=None, use_global=True):
+        self.start_ttl = self.START_TTL if start_ttl is None else start_ttl
+        if not isinstance(self.start_ttl, int) or self.start_ttl < 2:
+            raise MTRError(f'start_ttl must be an int of 2 or more, '
+                           f'got: {self.start_ttl}')
+        self.max_entries = (self.MAX_ENTRIES if max_entries is None
+                            else max_entries)
+        self.use_global = use_global
+        self.local_stops = {}
+        self.global_stops = {}
+        self.local_hits = 0
+        self.global_hits = 0
+
+    def destination_prefix(self, ip_address):
+        '''
+            Returns the network prefix an IP address is grouped into for the
+            global stop set.
+        '''
+        if ip_address.version == 4:
+            prefix_length = self.IPV4_PREFIX
+        else:
+            prefix_length = self.IPV6_PREFIX
+        return ipaddress.ip_network((ip_address, prefix_length), strict=False)
+
+    def add(self, stops, key, hops):
+        # Add an entry to a stop set, evicting the oldest entry if it's full
+        stops.pop(key, None)
+        stops[key] = hops
+        if len(stops) > self.max_entries:
+            del stops[next(iter(stops))]
+
+    def learn(self, ip_address, hops):
+        '''
+            Adds every responding hop of a completed trace to the stop sets.
+        '''
+        target_ip = str(ip_address)
+        hops = tuple(hops)
+        reached = bool(hops) and hops[-1][1] == target_ip
+        dest_prefix = self.destination_prefix(ip_address)
+        for i, (hop_num, hop_ip, ms) in enumerate(hops):
+            if hop_ip is None or hop_ip == target_ip:
+                continue
+            self.add(self.local_stops, (hop_num, hop_ip), hops[:i + 1])
+            if reached and self.use_global:
+                self.add(self.global_stops, (hop_ip, dest_prefix),
+                         hops[i + 1:])
+
+    def stats(self):
+        '''
+            Returns a dict of the stop set sizes and hit counters.
+        '''
+        return {
+            'local_entries': len(self.local_stops),
+            'global_entries': len(self.global_stops),
+            'local_hits': self.local_hits,
+            'global_hits': self.global_hits,
+        }
+
+    def trace(self, tracer, callback, errback, ip_address, protocol='icmp',
+              port=-1, **trace_kwargs):
+        '''
+            Traces to ip_address with a TraceRoute using the Doubletree
+            algorithm. Takes the same callbacks as TraceRoute.trace(), any
+            other keyword arguments are passed on to the forward trace.
+        '''
+        ts = time()
+        target_ip = str(ip_address)
+        dest_prefix = self.destination_prefix(ip_address)
+        start_ttl = self.start_ttl
+        # Hops found probing backwards from start_ttl - 1, keyed by TTL
+        backward = {}
+        forward = None
+        prefix = None
+        done = False
+
+        def _global_stop(hop_num, hop_ip):
+            # Stop the forward trace at a hop already known to lead to the
+            # target prefix
+            if not self.use_global or hop_ip is None:
+                return False
+            return (hop_ip, dest_prefix) in self.global_stops
+
+        def _got_forward(_ts, _ip_address, _protocol, _port, hops):
+            nonlocal forward
+            if done:
+                return
+            forward = [hop for hop in hops if hop[0] >= start_ttl]
+            hop_num, hop_ip, ms = forward[-1]
+            if hop_ip != target_ip and _global_stop(hop_num, hop_ip):
+                # Stitch on the known hops after the global stop, a reply from
+                # another target in the same prefix is left off
+                self.global_hits += 1
+                suffix = self.global_stops[(hop_ip, dest_prefix)]
+                if suffix and suffix[-1][1] != target_ip:
+                    suffix = suffix[:-1]
+                for i, (_, suffix_ip, suffix_ms) in enumerate(suffix, 1):
+                    forward.append((hop_num + i, suffix_ip, suffix_ms))
+            _finish()
+
+        def _probe_backward(ttl):
+            # Probe a single TTL, stopping at the first hop
+            tracer.trace(_got_backward, _got_error, ip_address,
+                         protocol=protocol, port=port, ttl=ttl,
+                         stop_hop=_stop_first)
+
+        def _stop_first(hop_num, hop_ip):
+            return True
+
+        def _got_backward(_ts, _ip_address, _protocol, _port, hops):
+            nonlocal prefix
+            if done:
+                return
+            hop = hops[-1]
+            hop_num, hop_ip, ms = hop
+            known = None
+            if hop_ip is not None and hop_ip != target_ip:
+                known = self.local_stops.get((hop_num, hop_ip))
+            if known is not None:
+                # Reached a known hop, stitch in the hops before it
+                self.local_hits += 1
+                prefix = known[:-1] + (hop,)
+            elif hop_num <= 1:
+                prefix = (hop,)
+            else:
+                backward[hop_num] = hop
+                _probe_backward(hop_num - 1)
+                return
+            _finish()
+
+        def _got_error(c, request, error, extra):
+            nonlocal done
+            if done:
+                return
+            done = True
+            errback(c, request, error, extra)
+
+        def _finish():
+            nonlocal done
+            if done or forward is None or prefix is None:
+                return
+            done = True
+            hops = list(prefix)
+            hops.extend(backward[ttl] for ttl in sorted(backward))
+            hops.extend(forward)
+            # The target may be closer than start_ttl, cut the trace at the
+            # first reply from the target
+            for i, (hop_num, hop_ip, ms) in enumerate(hops):
+                if hop_ip == target_ip:
+                    del hops[i + 1:]
+                    break
+            self.learn(ip_address, hops)
+            log.debug(f'Completed Doubletree {protocol}:{port} trace to '
+                      f'{ip_address} with {len(hops)} hops')
+            callback(ts, ip_address, protocol, port, hops)
+
+        log.debug(f'Starting Doubletree trace to {ip_address} at TTL '
+                  f'{start_ttl}')
+        tracer.trace(_got_forward, _got_error, ip_address, protocol=protocol,
+                     port=port, ttl=start_ttl, stop_hop=_global_stop,
+                     **trace_kwargs)
+        _probe_backward(start_ttl - 1)
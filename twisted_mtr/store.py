@@ -0,0 +1,444 @@
+import os
+import mmap
+import struct
+import logging
+import ipaddress
+from collections import OrderedDict, deque
+from time import time
+from .logger import get_logger
+from .errors import MTRError
+
+
+log = get_logger('store', level=logging.INFO)
+
+
+# Record header: magic, length of the whole record, timestamp, target IP
+# version, packed target IP padded to 16 bytes, protocol, port, hop count
+RECORD_HEADER = struct.Struct('<HIdB16sBiH')
+# Hop header: hop number and hop IP version, 0 if the hop did not reply,
+# followed by the 4 or 16 byte packed hop IP then HOP_RTT
+HOP_HEADER = struct.Struct('<HB')
+HOP_RTT = struct.Struct('<i')
+MAGIC = 0x544d
+PROTOCOLS = ('icmp', 'tcp', 'udp')
+ADDRESS_LENGTHS = {0: 0, 4: 4, 6: 16}
+
+
+def encode_record(ts, target_ip, protocol, port, hops):
+    '''
+        Returns the bytes of a record of a completed trace.
+    '''
+    target_ip = ipaddress.ip_address(target_ip)
+    parts = [b'']
+    for hop_num, hop_ip, rtt in hops:
+        if hop_ip is None:
+            parts.append(HOP_HEADER.pack(hop_num, 0))
+        else:
+            hop_address = ipaddress.ip_address(hop_ip)
+            parts.append(HOP_HEADER.pack(hop_num, hop_address.version))
+            parts.append(hop_address.packed)
+        parts.append(HOP_RTT.pack(-1 if rtt is None else rtt))
+    body = b''.join(parts)
+    try:
+        protocol_code = PROTOCOLS.index(protocol)
+    except ValueError as e:
+        raise MTRError(f'Unknown protocol: {protocol}') from e
+    header = RECORD_HEADER.pack(MAGIC, RECORD_HEADER.size + len(body), ts,
+                                target_ip.version, target_ip.packed,
+                                protocol_code, port, len(hops))
+    return header + body
+
+
+def decode_record(buffer, offset=0):
+    '''
+        Decodes the record at "offset" in a bytes-like buffer, such as a
+        memoryview of an mmap, without copying the record. Returns a (ts,
+        target_ip, protocol, port, hops) tuple as passed to the success
+        callback of TraceRoute.trace().
+    '''
+    (magic, length, ts, version, packed, protocol_code, port,
+     hop_count) = RECORD_HEADER.unpack_from(buffer, offset)
+    if magic != MAGIC:
+        raise MTRError(f'No trace record at offset {offset}')
+    target_ip = ipaddress.ip_address(
+        bytes(packed[:ADDRESS_LENGTHS[version]]))
+    hops = []
+    pos = offset + RECORD_HEADER.size
+    for _ in range(hop_count):
+        hop_num, hop_version = HOP_HEADER.unpack_from(buffer, pos)
+        pos += HOP_HEADER.size
+        address_length = ADDRESS_LENGTHS[hop_version]
+        hop_ip = None
+        if address_length:
+            hop_ip = str(ipaddress.ip_address(
+                bytes(buffer[pos:pos + address_length])))
+            pos += address_length
+        rtt, = HOP_RTT.unpack_from(buffer, pos)
+        pos += HOP_RTT.size
+        hops.append((hop_num, hop_ip, None if rtt == -1 else rtt))
+    return ts, target_ip, PROTOCOLS[protocol_code], port, hops
+
+
+class Segment:
+    '''
+        A single append-only segment file of trace records. Records are
+        appended through a buffered file and read through a read-only mmap
+        of the file which is remapped as it grows.
+    '''
+
+    def __init__(self, path, segment_id):
+        self.path = path
+        self.segment_id = segment_id
+        self.file = None
+        self.map = None
+        self.view = None
+        self.mapped = 0
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def open_for_append(self):
+        self.file = open(self.path, 'ab')
+
+    def append(self, record):
+        offset = self.size
+        self.file.write(record)
+        self.size += len(record)
+        return offset
+
+    def buffer(self, end):
+        '''
+            Returns a memoryview of the segment covering at least the first
+            "end" bytes.
+        '''
+        if end > self.mapped:
+            if self.file is not None:
+                self.file.flush()
+            self.unmap()
+            # The mmap keeps its own handle on the file once created
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+            self.mapped = len(self.map)
+        return self.view
+
+    def unmap(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.mapped = 0
+
+    def scan(self):
+        '''
+            Yields (offset, length) for every complete record in the segment.
+            A partly written record at the end, from a crash while writing,
+            is truncated.
+        '''
+        if not self.size:
+            return
+        self.buffer(self.size)
+        offset = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            # Fetch the view each time as reads between records can remap
+            view = self.buffer(offset + RECORD_HEADER.size)
+            magic, length = struct.unpack_from('<HI', view, offset)
+            if (magic != MAGIC or length < RECORD_HEADER.size or
+                    offset + length > self.size):
+                break
+            yield offset, length
+            offset += length
+        if offset < self.size:
+            log.error(f'Truncating {self.size - offset} bytes of incomplete '
+                      f'records from {self.path}')
+            self.unmap()
+            os.truncate(self.path, offset)
+            self.size = offset
+
+    def close(self):
+        self.unmap()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TraceStore:
+    '''
+        Stores completed traces in append-only segment files in "directory"
+        in a compact binary format. A new segment is started once the
+        current one reaches "segment_size" bytes. Records are read straight
+        from memory mapped segments so traces are never all loaded into
+        memory, only the last "MAX_MAPPED" segments read from are kept
+        mapped. Two indexes are kept in memory and rebuilt from the segments
+        when the store is opened: the locations of the latest
+        "latest_records" records for each target and the targets whose
+        traces passed through each hop IP. add() takes the same arguments as
+        the success callback of TraceRoute.trace() so it can be used as one.
+    '''
+
+    SEGMENT_SIZE = 67108864  # Bytes, size at which a new segment is started
+    LATEST_RECORDS = 16   # Records indexed per target
+    SEGMENT_NAME = 'segment-{:08d}.mtr'  # Segment file names
+    MAX_MAPPED = 8        # Segments kept memory mapped for reads
+
+    def __init__(self, directory, segment_size=None, latest_records=None):
+        self.directory = directory
+        self.segment_size = (self.SEGMENT_SIZE if segment_size is None
+                             else segment_size)
+        self.latest_records = (self.LATEST_RECORDS if latest_records is None
+                               else latest_records)
+        os.makedirs(directory, exist_ok=True)
+        self.segments = {}
+        self.active = None
+        self.target_index = {}
+        self.hop_index = {}
+        self.records = 0
+        # Segments mapped for reads, least recently read first, each mapped
+        # segment holds a file handle open
+        self.mapped = OrderedDict()
+        self.open()
+
+    def open(self):
+        # Finish any compaction interrupted after its compacted segment was
+        # written, a compacted segment with no marker was never finished
+        # being written so the segments it was made from are kept
+        names = os.listdir(self.directory)
+        for name in names:
+            if name.startswith('compacted-'):
+                self.finish_compaction(int(name[10:]))
+        for name in names:
+            if name.endswith('.mtr.compact') and os.path.exists(
+                    os.path.join(self.directory, name)):
+                log.error(f'Removing incomplete compacted segment {name}')
+                os.unlink(os.path.join(self.directory, name))
+        # Load every existing segment and rebuild the indexes from them
+        segment_ids = []
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and name.endswith('.mtr'):
+                segment_ids.append(int(name[8:-4]))
+        for segment_id in sorted(segment_ids):
+            segment = Segment(self.segment_path(segment_id), segment_id)
+            self.segments[segment_id] = segment
+            self.index_segment(segment)
+        self.active = self.segments[max(segment_ids)] if segment_ids else None
+        if self.active is None or self.active.size >= self.segment_size:
+            self.rollover()
+        else:
+            self.active.open_for_append()
+        log.debug(f'Opened trace store {self.directory} with {self.records} '
+                  f'records in {len(self.segments)} segments')
+
+    def sync_directory(self):
+        # Make renames and unlinks in the store directory durable
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def finish_compaction(self, compacted_id):
+        '''
+            Replaces segment "compacted_id" with its fsynced compacted copy
+            and removes every segment before it. A marker file records that
+            the compacted copy is complete until the old segments are gone,
+            so open() can finish the job after a crash at any step.
+        '''
+        marker_path = os.path.join(self.directory,
+                                   f'compacted-{compacted_id}')
+        compacted_path = self.segment_path(compacted_id) + '.compact'
+        if not os.path.exists(marker_path):
+            open(marker_path, 'wb').close()
+            self.sync_directory()
+        if os.path.exists(compacted_path):
+            os.replace(compacted_path, self.segment_path(compacted_id))
+            self.sync_directory()
+        for name in os.listdir(self.directory):
+            if (name.startswith('segment-') and name.endswith('.mtr') and
+                    int(name[8:-4]) < compacted_id):
+                os.unlink(os.path.join(self.directory, name))
+        os.unlink(marker_path)
+        self.sync_directory()
+
+    def segment_path(self, segment_id):
+        return os.path.join(self.directory,
+                            self.SEGMENT_NAME.format(segment_id))
+
+    def rollover(self):
+        '''
+            Starts a new segment for appending records.
+        '''
+        if self.active is not None and self.active.file is not None:
+            self.active.file.close()
+            self.active.file = None
+        segment_id = max(self.segments) + 1 if self.segments else 1
+        segment = Segment(self.segment_path(segment_id), segment_id)
+        segment.open_for_append()
+        self.segments[segment_id] = segment
+        self.active = segment
+
+    def index_segment(self, segment):
+        for offset, length in segment.scan():
+            self.index_record(segment, offset, decode_record(
+                segment.buffer(offset + length), offset))
+        self.release(segment)
+
+    def release(self, segment):
+        # Unmap a segment after scanning it unless it's mapped for reads
+        if segment.segment_id not in self.mapped:
+            segment.unmap()
+
+    def map_segment(self, segment, end):
+        # Map a segment for reads, unmapping the least recently read segment
+        # once more than MAX_MAPPED are mapped
+        view = segment.buffer(end)
+        self.mapped[segment.segment_id] = segment
+        self.mapped.move_to_end(segment.segment_id)
+        if len(self.mapped) > self.MAX_MAPPED:
+            _, oldest = self.mapped.popitem(last=False)
+            oldest.unmap()
+        return view
+
+    def index_record(self, segment, offset, record):
+        ts, target_ip, protocol, port, hops = record
+        target = str(target_ip)
+        locations = self.target_index.get(target)
+        if locations is None:
+            locations = deque(maxlen=self.latest_records)
+            self.target_index[target] = locations
+        locations.append((segment.segment_id, offset))
+        for hop_num, hop_ip, rtt in hops:
+            if hop_ip is not None and hop_ip != target:
+                targets = self.hop_index.get(hop_ip)
+                if targets is None:
+                    targets = set()
+                    self.hop_index[hop_ip] = targets
+                targets.add(target)
+        self.records += 1
+
+    def add(self, ts, target_ip, protocol, port, hops):
+        '''
+            Appends a completed trace to the store.
+        '''
+        record = encode_record(ts, target_ip, protocol, port, hops)
+        if self.active.size and \
+                self.active.size + len(record) > self.segment_size:
+            self.rollover()
+        offset = self.active.append(record)
+        self.index_record(self.active, offset,
+                          (ts, target_ip, protocol, port, hops))
+
+    def read(self, location):
+        '''
+            Returns the trace stored at a (segment_id, offset) location.
+        '''
+        segment_id, offset = location
+        segment = self.segments[segment_id]
+        return decode_record(
+            self.map_segment(segment, offset + RECORD_HEADER.size), offset)
+
+    def latest(self, target_ip):
+        '''
+            Returns the latest stored trace to target_ip or None.
+        '''
+        locations = self.target_index.get(str(target_ip))
+        if not locations:
+            return None
+        return self.read(locations[-1])
+
+    def history(self, target_ip):
+        '''
+            Yields the indexed traces to target_ip, newest first.
+        '''
+        for location in reversed(self.target_index.get(str(target_ip), ())):
+            yield self.read(location)
+
+    def targets_via(self, hop_ip):
+        '''
+            Returns a set of the target IPs of stored traces which passed
+            through hop_ip.
+        '''
+        return set(self.hop_index.get(str(hop_ip), ()))
+
+    def scan(self):
+        '''
+            Yields every stored trace, oldest first.
+        '''
+        for segment_id in sorted(self.segments):
+            segment = self.segments[segment_id]
+            if segment is self.active and segment.file is not None:
+                segment.file.flush()
+                segment.size = os.path.getsize(segment.path)
+            for offset, length in segment.scan():
+                yield decode_record(segment.buffer(offset + length), offset)
+            self.release(segment)
+
+    def flush(self):
+        if self.active.file is not None:
+            self.active.file.flush()
+
+    def compact(self, keep=None, max_age=None):
+        '''
+            Rewrites every segment other than the active one into a single
+            segment, dropping all but the newest "keep" records of each
+            target and any records older than "max_age" seconds, then
+            rebuilds the indexes. This reads and writes every record so it
+            should be run when the store is quiet.
+        '''
+        old_ids = [segment_id for segment_id in sorted(self.segments)
+                   if self.segments[segment_id] is not self.active]
+        if not old_ids:
+            return
+        keep = self.latest_records if keep is None else keep
+        cutoff = None if max_age is None else time() - max_age
+        # Count the records of each target in the segments being kept so the
+        # newest records are the ones that survive
+        newer = {}
+        for offset, length in self.active.scan():
+            record = decode_record(self.active.buffer(offset + length),
+                                   offset)
+            target = str(record[1])
+            newer[target] = newer.get(target, 0) + 1
+        self.release(self.active)
+        kept = []
+        for segment_id in reversed(old_ids):
+            segment = self.segments[segment_id]
+            locations = list(segment.scan())
+            for offset, length in reversed(locations):
+                record = decode_record(segment.buffer(offset + length),
+                                       offset)
+                target = str(record[1])
+                count = newer.get(target, 0)
+                if count >= keep or (cutoff is not None and
+                                     record[0] < cutoff):
+                    continue
+                newer[target] = count + 1
+                kept.append(segment.view[offset:offset + length].tobytes())
+            self.release(segment)
+        # Write the kept records, oldest first, to a new segment numbered
+        # below the active one and make sure it's on disk before any old
+        # segment is removed
+        compacted_id = old_ids[-1]
+        compacted_path = self.segment_path(compacted_id) + '.compact'
+        with open(compacted_path, 'wb') as f:
+            for record in reversed(kept):
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        for segment_id in old_ids:
+            self.mapped.pop(segment_id, None)
+            self.segments.pop(segment_id).close()
+        self.finish_compaction(compacted_id)
+        self.segments[compacted_id] = Segment(
+            self.segment_path(compacted_id), compacted_id)
+        self.target_index = {}
+        self.hop_index = {}
+        self.records = 0
+        for segment_id in sorted(self.segments):
+            self.index_segment(self.segments[segment_id])
+        log.debug(f'Compacted {len(old_ids)} segments to {len(kept)} '
+                  f'records')
+
+    def close(self):
+        self.mapped.clear()
+        for segment in self.segments.values():
+            segment.close()
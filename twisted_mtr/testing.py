@@ -0,0 +1,230 @@
+import zlib
+import random
+import logging
+from twisted.internet import reactor
+from .logger import get_logger
+
+
+log = get_logger('testing', level=logging.INFO)
+
+
+class Topology:
+    '''
+        Scriptable network topology for FakeMTRPacket. "paths" maps target IP
+        strings to a list of (hop_ip, rtt) tuples for every hop before the
+        target, hop_ip is None for hops which never reply and rtt is in
+        microseconds. A hop may instead be a list of (hop_ip, rtt) tuples of
+        load balanced interfaces, one of which is picked for each probe from
+        its flow identifier, or at random for probes without one. The target
+        replies at the TTL after the last hop with "target_rtt" microseconds
+        added to the RTT of the last hop. Paths for targets not in "paths"
+        are generated from the target IP, the first "shared" hops are the
+        same for every generated path.
+    '''
+
+    HOPS = (8, 16)        # Range of number of hops in generated paths
+    SHARED = 4            # Hops shared by every generated path
+    RTT_STEP = 2000       # Microseconds, RTT added by each generated hop
+    SILENT = 0.1          # Chance of a generated hop never replying
+
+    def __init__(self, paths=None, hops=None, shared=None, rtt_step=None,
+                 silent=None, target_rtt=None, seed=0):
+        self.paths = dict(paths or {})
+        self.hops = self.HOPS if hops is None else hops
+        self.shared = self.SHARED if shared is None else shared
+        self.rtt_step = self.RTT_STEP if rtt_step is None else rtt_step
+        self.silent = self.SILENT if silent is None else silent
+        self.target_rtt = self.rtt_step if target_rtt is None else target_rtt
+        self.seed = seed
+
+    def path(self, target_ip):
+        '''
+            Returns the list of (hop_ip, rtt) tuples before target_ip.
+        '''
+        path = self.paths.get(target_ip)
+        if path is None:
+            path = self.generate(target_ip)
+            self.paths[target_ip] = path
+        return path
+
+    def generate(self, target_ip):
+        # Generate a path which is always the same for the same target
+        rand = random.Random(f'{self.seed}-{target_ip}')
+        shared_rand = random.Random(f'{self.seed}-shared')
+        num_hops = rand.randint(*self.hops)
+        ipv6 = ':' in target_ip
+        path = []
+        for ttl in range(1, num_hops + 1):
+            hop_rand = shared_rand if ttl <= self.shared else rand
+            if ipv6:
+                hop_ip = f'fd00:{ttl:x}::{hop_rand.randrange(1, 65535):x}'
+            else:
+                hop_ip = f'10.{ttl}.{hop_rand.randrange(256)}.' \
+                         f'{hop_rand.randrange(1, 255)}'
+            if hop_rand.random() < self.silent:
+                hop_ip = None
+            rtt = ttl * self.rtt_step + hop_rand.randrange(self.rtt_step)
+            path.append((hop_ip, rtt))
+        return path
+
+    def response(self, target_ip, ttl, flow=None):
+        '''
+            Returns a (response_type, hop_ip, rtt) tuple for a probe with an
+            optional flow identifier.
+        '''
+        path = self.path(target_ip)
+        if ttl > len(path):
+            last = path[-1] if path else (None, 0)
+            if isinstance(last, list):
+                last = last[0]
+            rtt = (last[1] or 0) + self.target_rtt
+            return 'reply', target_ip, rtt
+        hop = path[ttl - 1]
+        if isinstance(hop, list):
+            # Per-flow load balancing, a flow always takes the same interface
+            flow = random.random() if flow is None else flow
+            hop = hop[zlib.crc32(f'{flow}-{ttl}'.encode()) % len(hop)]
+        hop_ip, rtt = hop
+        if hop_ip is None:
+            return 'no-reply', None, None
+        return 'ttl-expired', hop_ip, rtt
+
+
+class FakeMTRPacket:
+    '''
+        In-process stand-in for an mtr-packet process. It is used as the
+        transport of a TraceRoute and answers send-probe requests from a
+        Topology after the RTT of the hop, so traces can be tested and
+        benchmarked without mtr-packet or a network. "time_scale" multiplies
+        every delay. "loss" is the chance of a probe getting no reply,
+        "jitter" is the maximum microseconds randomly added to each RTT which
+        reorders responses, "max_probes" is the number of probes allowed in
+        flight before probes-exhausted is returned. Responses due at the same
+        time are written in a single chunk if "coalesce" is set and chunks
+        are split at random points if "split" is set. The check-support
+        command is answered as supported.
+    '''
+
+    def __init__(self, protocol, topology=None, clock=None, time_scale=1.0,
+                 loss=0.0, jitter=0, max_probes=None, coalesce=True,
+                 split=False, seed=0):
+        self.protocol = protocol
+        self.topology = Topology() if topology is None else topology
+        self.clock = reactor if clock is None else clock
+        self.time_scale = time_scale
+        self.loss = loss
+        self.jitter = jitter
+        self.max_probes = max_probes
+        self.coalesce = coalesce
+        self.split = split
+        self.random = random.Random(seed)
+        self.buffer = b''
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.probes = 0
+        self.writes = 0
+        self.pending = []
+        self.flush_call = None
+        self.connected = True
+        self.producer = None
+        protocol.makeConnection(self)
+
+    def write(self, data):
+        self.writes += 1
+        data = self.buffer + data
+        lines = data.split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if line:
+                self.handle(line.decode())
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.connected = False
+
+    def closeStdin(self):
+        self.connected = False
+
+    def signalProcess(self, signal):
+        self.connected = False
+
+    def handle(self, line):
+        # Answer a single request line
+        parts = line.split()
+        c, command = parts[0], parts[1]
+        if command == 'check-support':
+            self.respond(f'{c} feature-support support ok', 0)
+            return
+        if command != 'send-probe':
+            self.respond(f'{c} unknown-command', 0)
+            return
+        args = dict(zip(parts[2::2], parts[3::2]))
+        target_ip = args.get('ip-4') or args.get('ip-6')
+        ttl = int(args.get('ttl', 64))
+        timeout = int(args.get('timeout', 10))
+        self.probes += 1
+        if self.max_probes is not None and self.in_flight >= self.max_probes:
+            self.respond(f'{c} probes-exhausted', 0)
+            return
+        # Like mtr-packet only the source port keeps a flow on one path, icmp
+        # probes get a new sequence number and checksum for every probe
+        flow = args.get('local-port')
+        if flow is None:
+            flow = self.random.random()
+        response_type, hop_ip, rtt = self.topology.response(target_ip, ttl,
+                                                            flow)
+        if response_type != 'no-reply' and self.random.random() < self.loss:
+            response_type = 'no-reply'
+        if response_type == 'no-reply':
+            self.respond(f'{c} no-reply', timeout * 1000000, probe=True)
+            return
+        if self.jitter:
+            rtt += self.random.randrange(self.jitter)
+        family = 'ip-6' if ':' in hop_ip else 'ip-4'
+        self.respond(f'{c} {response_type} {family} {hop_ip} '
+                     f'round-trip-time {rtt}', rtt, probe=True)
+
+    def respond(self, line, delay, probe=False):
+        # Write a response line after "delay" microseconds
+        if probe:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.clock.callLater(delay / 1000000 * self.time_scale, self.deliver,
+                             line.encode() + b'\n', probe)
+
+    def deliver(self, data, probe):
+        if probe:
+            self.in_flight -= 1
+        if not self.connected:
+            return
+        if not self.coalesce:
+            self.output(data)
+            return
+        # Collect every response due in this reactor iteration
+        self.pending.append(data)
+        if self.flush_call is None:
+            self.flush_call = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        self.flush_call = None
+        data = b''.join(self.pending)
+        self.pending = []
+        self.output(data)
+
+    def output(self, data):
+        # Hand output to the protocol, optionally split into random pieces
+        if not self.split:
+            self.protocol.outReceived(data)
+            return
+        while data:
+            size = self.random.randint(1, len(data))
+            self.protocol.outReceived(data[:size])
+            data = data[size:]
@@ -0,0 +1,123 @@
+import math
+import logging
+from twisted.internet import reactor, task
+from .logger import get_logger
+
+
+log = get_logger('timeouts', level=logging.INFO)
+
+
+class CallLaterTimeouts:
+    '''
+        Timeout manager which schedules one reactor.callLater() for every
+        request. Timeouts fire precisely but each request costs a timer heap
+        insert and removal in the reactor.
+    '''
+
+    def __init__(self, timeout, callback):
+        self.timeout = timeout
+        self.callback = callback
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _fire(self, c):
+        del self.pending[c]
+        self.callback(c)
+
+    def schedule(self, c, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        self.pending[c] = reactor.callLater(timeout, self._fire, c)
+
+    def cancel(self, c):
+        delayed_call = self.pending.pop(c, None)
+        if delayed_call is not None:
+            delayed_call.cancel()
+
+    def clear(self):
+        for delayed_call in self.pending.values():
+            delayed_call.cancel()
+        self.pending = {}
+
+
+class TimeoutWheel:
+    '''
+        Timeout manager which places requests into a ring of buckets keyed by
+        request counter. A single coarse periodic tick advances around the
+        ring and fires the callback for every request in the bucket it lands
+        on as a batch. Scheduling and cancelling are dict operations with no
+        reactor timers involved. Timeouts fire between "timeout" and
+        "timeout" + "tick" seconds after being scheduled. Requests can be
+        scheduled with a shorter timeout than the wheel was created with but
+        not a longer one. The tick only runs while there are requests
+        pending.
+    '''
+
+    TICK = 0.5            # Seconds, interval between advancing the wheel
+
+    def __init__(self, timeout, callback, tick=None):
+        self.timeout = timeout
+        self.callback = callback
+        self.tick_interval = tick or self.TICK
+        self.size = int(math.ceil(timeout / self.tick_interval)) + 1
+        self.buckets = [{} for _ in range(self.size)]
+        self.position = 0
+        self.pending = {}
+        self.looper = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def schedule(self, c, timeout=None):
+        # The bucket "ticks" ahead of the current position fires after between
+        # "ticks" - 1 and "ticks" tick intervals. The bucket at the current
+        # position has already fired and next fires after a full turn of the
+        # wheel, which is at least the timeout the wheel was created with
+        if timeout is None:
+            ticks = self.size
+        else:
+            ticks = min(int(math.ceil(timeout / self.tick_interval)) + 1,
+                        self.size)
+        bucket = self.buckets[(self.position + ticks) % self.size]
+        bucket[c] = None
+        self.pending[c] = bucket
+        if self.looper is None:
+            self.looper = task.LoopingCall.withCount(self.tick)
+            self.looper.clock = reactor
+            self.looper.start(self.tick_interval, now=False)
+
+    def cancel(self, c):
+        bucket = self.pending.pop(c, None)
+        if bucket is not None:
+            del bucket[c]
+
+    def clear(self):
+        self.buckets = [{} for _ in range(self.size)]
+        self.pending = {}
+        self.stop()
+
+    def stop(self):
+        if self.looper is not None:
+            self.looper.stop()
+            self.looper = None
+
+    def tick(self, count=1):
+        # "count" is the number of ticks elapsed since the last call, it is
+        # more than 1 if the reactor was too busy to run every tick
+        expired = []
+        for _ in range(min(count, self.size)):
+            self.position = (self.position + 1) % self.size
+            bucket = self.buckets[self.position]
+            if bucket:
+                self.buckets[self.position] = {}
+                expired.extend(bucket)
+        if expired:
+            for c in expired:
+                del self.pending[c]
+            log.debug(f'{len(expired)} requests timed out')
+            for c in expired:
+                self.callback(c)
+        if not self.pending:
+            self.stop()
@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import struct
+import logging
+import ipaddress
+from twisted.internet import reactor, protocol, stdio
+from twisted.protocols import basic
+from .logger import get_logger
+from .errors import MTRError
+from .mtr import TraceRoute
+from .bulk import TraceMany
+from .results import AddressTable, TraceResult
+from .store import encode_record, decode_record
+
+
+log = get_logger('workers', level=logging.INFO)
+
+
+# Result frame header: request ID, 1 if the trace succeeded or 0 if it
+# failed, length of the payload which follows
+RESULT_HEADER = struct.Struct('<QBI')
+
+
+def encode_result(request_id, success, payload):
+    '''
+        Returns the bytes of a result frame. "payload" is a record encoded
+        with store.encode_record() for a completed trace or the UTF-8 error
+        for a failed one.
+    '''
+    return RESULT_HEADER.pack(request_id, success, len(payload)) + payload
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    '''
+        Supervisor side of a worker process. Trace requests are written to
+        the stdin of the worker, one JSON array per line:
+
+            [request_id, ip_address, protocol, port, ttl, mode, window]
+
+        Results are read from its stdout as binary frames of a RESULT_HEADER
+        followed by the payload, the trace packed as a store record with
+        hop IPs as 4 or 16 byte addresses, or the error of a failed trace.
+    '''
+
+    MAX_RESULT_LENGTH = 1048576  # Bytes, longest result payload accepted
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.requests = {}
+        self.buffer = b''
+
+    def outstanding(self):
+        return len(self.requests)
+
+    def send_request(self, request_id, request, callbacks):
+        self.requests[request_id] = (request, callbacks)
+        self.transport.write(json.dumps(request).encode() + b'\n')
+
+    def outReceived(self, data):
+        data = self.buffer + data if self.buffer else data
+        offset = 0
+        while len(data) - offset >= RESULT_HEADER.size:
+            request_id, success, length = RESULT_HEADER.unpack_from(data,
+                                                                    offset)
+            if length > self.MAX_RESULT_LENGTH:
+                # The stream can't be framed again after a corrupt header
+                log.error(f'Discarding {len(data) - offset} bytes of worker '
+                          f'output with a {length} byte result')
+                self.buffer = b''
+                return
+            start = offset + RESULT_HEADER.size
+            end = start + length
+            if len(data) < end:
+                break
+            self.got_result(request_id, success, data[start:end])
+            offset = end
+        self.buffer = data[offset:]
+
+    def got_result(self, request_id, success, payload):
+        if request_id not in self.requests:
+            log.error(f'Recieved worker result for an unknown request: '
+                      f'{request_id}')
+            return
+        request, callbacks = self.requests.pop(request_id)
+        try:
+            if success:
+                result = decode_record(payload)
+            else:
+                result = payload.decode()
+        except (MTRError, ValueError, KeyError, IndexError,
+                struct.error) as e:
+            log.error(f'Failed to decode worker result for request '
+                      f'{request_id}: {e}')
+            success, result = False, f'invalid worker result: {e}'
+        self.supervisor.got_result(request_id, request, callbacks, success,
+                                   result)
+
+    def errReceived(self, data):
+        log.error(f'Recieved error from worker: {data}')
+
+    def processEnded(self, reason):
+        log.debug(f'Worker process ended, reason: {reason}')
+        # Fail every request the worker never answered
+        requests, self.requests = self.requests, {}
+        for request_id, (request, callbacks) in requests.items():
+            self.supervisor.got_result(request_id, request, callbacks, False,
+                                       'worker exited')
+
+
+class TraceSupervisor:
+    '''
+        Spreads traces over a number of worker processes, each running its
+        own reactor, TraceRoute and mtr-packet process, so parsing responses
+        and handling results is spread over more than one CPU core. Targets
+        are sent to the worker with the fewest outstanding traces over its
+        stdin and results are streamed back over its stdout. Callbacks are
+        called in the supervisor process as for TraceRoute.trace(), the error
+        callback is passed the request ID in place of the request counter.
+    '''
+
+    WORKERS = os.cpu_count() or 1  # Default number of worker processes
+
+    def __init__(self, mtr_binary_path=None, local_ipv4=None, local_ipv6=None,
+                 workers=None, compact=False, python_binary_path=None):
+        if workers is None:
+            workers = self.WORKERS
+        if not isinstance(workers, int) or workers < 1:
+            raise MTRError(f'Number of workers must be an int of 1 or more, '
+                           f'got: {workers}')
+        if not local_ipv4 and not local_ipv6:
+            raise MTRError('At least one of local_ipv4 or local_ipv6 '
+                           'must be set, preferably both if available')
+        self.mtr_binary_path = mtr_binary_path
+        self.local_ipv4 = local_ipv4
+        self.local_ipv6 = local_ipv6
+        self.compact = compact
+        # Hop addresses of compact results, rotated once full
+        self.address_table = AddressTable()
+        self.python_binary_path = python_binary_path or sys.executable
+        self.request_counter = 0
+        self.workers = [WorkerProcess(self) for _ in range(workers)]
+
+    def worker_config(self):
+        '''
+            Returns the JSON encoded TraceRoute arguments passed to each
+            worker process.
+        '''
+        return json.dumps({
+            'mtr_binary_path': self.mtr_binary_path,
+            'local_ipv4': str(self.local_ipv4) if self.local_ipv4 else None,
+            'local_ipv6': str(self.local_ipv6) if self.local_ipv6 else None,
+        })
+
+    def start(self):
+        '''
+            Spawns every worker process.
+        '''
+        if not self.mtr_binary_path:
+            raise MTRError('mtr_binary_path must be set to start workers')
+        args = [self.python_binary_path, '-m', 'twisted_mtr.workers',
+                self.worker_config()]
+        for worker in self.workers:
+            reactor.spawnProcess(worker, self.python_binary_path, args,
+                                 dict(os.environ))
+        log.debug(f'Spawned {len(self.workers)} worker processes')
+
+    def stop(self):
+        '''
+            Closes the stdin of every worker process which causes them to
+            exit.
+        '''
+        for worker in self.workers:
+            if worker.transport:
+                worker.transport.closeStdin()
+
+    def queue_depths(self):
+        '''
+            Returns a list of the number of outstanding traces for each
+            worker process.
+        '''
+        return [worker.outstanding() for worker in self.workers]
+
+    def get_worker(self):
+        '''
+            Returns the worker with the fewest outstanding traces.
+        '''
+        return min(self.workers, key=lambda worker: worker.outstanding())
+
+    def trace(self, callback, errback, ip_address, protocol='icmp', port=-1,
+              ttl=1, extra=None, mode='sequential', window=None):
+        '''
+            Starts a trace on the least busy worker. Takes the same arguments
+            as TraceRoute.trace() except the callables, which can not be sent
+            to another process. The arguments are validated here so invalid
+            ones raise an MTRError rather than failing in the worker.
+        '''
+        port = TraceRoute.check_protocol(protocol, port)
+        TraceRoute.check_trace(ttl, mode, window)
+        if ip_address.version == 4 and not self.local_ipv4:
+            raise MTRError('Trace to an IPv4 address was requested but '
+                           'no local IPv4 origin has been specified. Set '
+                           'the local_ipv4 argument.')
+        if ip_address.version == 6 and not self.local_ipv6:
+            raise MTRError('Trace to an IPv6 address was requested but '
+                           'no local IPv6 origin has been specified. Set '
+                           'the local_ipv6 argument.')
+        request_id = self.request_counter
+        self.request_counter += 1
+        request = [request_id, str(ip_address), protocol, port, ttl, mode,
+                   window]
+        self.get_worker().send_request(request_id, request,
+                                       (callback, errback, ip_address))
+
+    def got_result(self, request_id, request, callbacks, success, result):
+        callback, errback, ip_address = callbacks
+        if not success:
+            errback(request_id, request, result, None)
+            return
+        ts, _, protocol, port, hops = result
+        if self.compact:
+            self.address_table = self.address_table.rotated()
+            hops = TraceResult.from_hops(ts, ip_address, protocol, port, hops,
+                                         self.address_table)
+        callback(ts, ip_address, protocol, port, hops)
+
+    def trace_many(self, targets, concurrency=None, protocol='icmp', port=-1,
+                   **trace_kwargs):
+        '''
+            Traces every target in an iterable over the workers, takes the
+            same arguments as TraceRoute.trace_many().
+        '''
+        return TraceMany(self, targets, concurrency=concurrency,
+                         protocol=protocol, port=port, **trace_kwargs)
+
+
+class TraceWorker(basic.LineOnlyReceiver):
+    '''
+        Worker side of a worker process. Reads trace requests from stdin,
+        traces them with a TraceRoute and writes the results to stdout as the
+        binary frames described in WorkerProcess.
+    '''
+
+    delimiter = b'\n'
+    MAX_LENGTH = 65536
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def lineReceived(self, line):
+        try:
+            request = json.loads(line)
+            request_id, ip, protocol, port, ttl, mode, window = request
+        except (ValueError, TypeError) as e:
+            log.error(f'Failed to parse worker request: {line} ({e})')
+            return
+
+        def _got_result(ts, ip_address, protocol, port, hops):
+            self.send_result(encode_result(
+                request_id, 1,
+                encode_record(ts, ip_address, protocol, port, hops)))
+
+        def _got_error(c, request, error, extra):
+            self.send_result(encode_result(request_id, 0,
+                                           str(error).encode()))
+
+        try:
+            ip_address = ipaddress.ip_address(ip)
+            self.tracer.trace(_got_result, _got_error, ip_address,
+                              protocol=protocol, port=port, ttl=ttl,
+                              mode=mode, window=window)
+        except (ValueError, MTRError) as e:
+            _got_error(None, request, e, None)
+
+    def send_result(self, frame):
+        self.transport.write(frame)
+
+    def connectionLost(self, reason):
+        # The supervisor closed stdin, stop the worker
+        log.debug(f'Supervisor connection lost, reason: {reason}')
+        self.tracer.stop()
+        if reactor.running:
+            reactor.stop()
+
+
+def main(config):
+    '''
+        Entry point of a worker process, spawned by TraceSupervisor.start()
+        with its JSON encoded config.
+    '''
+    config = json.loads(config)
+    local_ipv4, local_ipv6 = config['local_ipv4'], config['local_ipv6']
+    mtr_binary_path = config['mtr_binary_path']
+    tracer = TraceRoute(
+        mtr_binary_path=mtr_binary_path,
+        local_ipv4=ipaddress.IPv4Address(local_ipv4) if local_ipv4 else None,
+        local_ipv6=ipaddress.IPv6Address(local_ipv6) if local_ipv6 else None
+    )
+    tracer.spawn()
+    stdio.StandardIO(TraceWorker(tracer))
+    reactor.run()
+
+
+if __name__ == '__main__':
+
+    main(sys.argv[1])